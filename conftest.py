@@ -1,33 +1,148 @@
 import pytest
 import os
-from distutils.dir_util import copy_tree
+import json
 import logging
 import sys
 import socket
-import hashlib
-from jinja2 import Template
+import tempfile
+import time
 from zappa_e2e import (
     PreservableTemporaryDirectory,
     DeployedZappaApp,
+    PackageStore,
+    RunScheduler,
+    VenvStore,
+    Wheelhouse,
+    ZappaWorker,
+    benchmark,
+    cold_start_probe,
+    deployment_fingerprint,
+    OUTPUT_LOGS,
+    PROCESS_ENGINE,
+    LocalAWS,
+    LocalGateway,
+    PerfDB,
+    analyze_package,
+    app_budget,
+    budget_violations,
+    format_package_analysis,
+    package_diff,
+    WorkspaceSync,
+    clone_venv,
+    render_settings,
+    app_runtimes,
+    format_regression,
+    git_commit,
+    installed_version,
+    keep_local_package,
+    new_run_id,
+    override_revision,
+    select_apps,
+    parse_shard,
+    partition,
+    shard_plan,
+    load_settings,
+    settings_matrix,
+    variant_name,
+    force_lambda_cold_start,
+    zappa_cmd,
+    requirements_path,
+    zappa_requirement,
     venv_cmd,
-    chdir,
     ENV_CONFIG,
+    RATE_LIMITER,
+    TRACER,
     python_executables,
+    python_version_string,
 )
-import subprocess
-import time
+import shutil
+from contextlib import ExitStack
 
 
 DIR = os.path.realpath(os.path.dirname(__file__))
 APPS_PREFIX = os.path.join(DIR, "apps")
 logger = logging.getLogger()
 
-ZAPPA_S3_BUCKET = os.environ.get(
-    "ZAPPA_S3_BUCKET",
-    "zappa-e2e-" + str(hashlib.md5(socket.gethostname().encode()).hexdigest()),
-)
+ZAPPA_S3_BUCKET = ENV_CONFIG["s3_bucket"]
 logger.debug("Zappa E2E: using s3 bucket " + ZAPPA_S3_BUCKET)
 
+# every run collected this session, for the cross-app summaries
+APP_RUNS = []
+
+PERF_DB = PerfDB()
+GIT_COMMIT = git_commit(DIR)
+# recorded with every run's metrics, so --affected can tell when the override moved on
+ZAPPA_OVERRIDE_REVISION = override_revision(ENV_CONFIG["zappa_override"])
+
+# (index, count, estimated seconds, shard_plan()) when running one shard of the suite with --shard i/N
+SHARD = None
+# {app name: why it runs, or None} when selecting apps with --affected RANGE
+AFFECTED = None
+# node id -> passed/failed/skipped, for the shard report
+ITEM_OUTCOMES = {}
+SESSION_STARTED = time.time()
+
+SCHEDULER = RunScheduler(ENV_CONFIG["workers"], ENV_CONFIG["stage_workers"])
+
+if ENV_CONFIG["sleep_between"]:
+    logger.warn(
+        "ZAPPA_E2E_SLEEP_BETWEEN is ignored: zappa calls are rate limited adaptively instead "
+        "(see ZAPPA_E2E_ZAPPA_CALLS_PER_SECOND), and deploys are probed until they answer "
+        "(see ZAPPA_E2E_READINESS_TIMEOUT)"
+    )
+
+if ENV_CONFIG["update_over_deploy"] and not ENV_CONFIG["preserve_temp"]:
+    logger.warn(
+        "ZAPPA_E2E_UPDATE_OVER_DEPLOY without ZAPPA_E2E_PRESERVE_TEMP: deployment fingerprints are kept in the apps' "
+        "temp dirs, which are removed at teardown, so the next run cannot skip an unchanged update"
+    )
+if ENV_CONFIG["backend"] not in ("aws", "local"):
+    raise ValueError(
+        "ZAPPA_E2E_BACKEND must be aws or local; got {!r}".format(ENV_CONFIG["backend"])
+    )
+# started for the session by pytest_sessionstart
+LOCAL_AWS = LocalAWS() if ENV_CONFIG["backend"] == "local" else None
+VENV_STORE = VenvStore()
+WHEELHOUSE = Wheelhouse()
+PACKAGE_STORE = PackageStore()
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--venv-cache-stats",
+        action="store_true",
+        help="report virtualenv cache hits, misses and bytes reclaimed",
+    )
+    parser.addoption(
+        "--follow",
+        action="store_true",
+        help="print the output of every running app's commands live, prefixed with app and phase",
+    )
+    parser.addoption(
+        "--shard",
+        default=None,
+        metavar="i/N",
+        help="run only the i-th of N shards of the (app, python version) items, balanced by --shard-durations if given",
+    )
+    parser.addoption(
+        "--shard-durations",
+        default=None,
+        metavar="PATH",
+        help="balance shards with the durations in this merged shard report (the same file on every machine)",
+    )
+    parser.addoption(
+        "--shard-report",
+        default=None,
+        metavar="PATH",
+        help="where to write this shard's results (default: <tmp>/zappa-e2e/shards/shard-<i>-of-<N>.json)",
+    )
+    parser.addoption(
+        "--affected",
+        default=None,
+        metavar="RANGE",
+        help="run only the apps changed in this git diff range (everything if harness files or the Zappa override changed)",
+    )
+
 
 def _path_to_app(path):
     str_path = str(path)
@@ -43,6 +158,188 @@ def pytest_collect_file(parent, path):
         return ZappaAppFile(path, parent)
 
 
+def pytest_configure(config):
+    if config.getoption("follow"):
+        # output capturing is suspended while plugins are configured, so this is a dup of the real stderr,
+        # which the scheduler's threads can keep writing to while tests run under capture
+        OUTPUT_LOGS.follow(os.fdopen(os.dup(2), "w"))
+
+
+def pytest_sessionstart(session):
+    if LOCAL_AWS is not None:
+        LOCAL_AWS.start()
+
+
+def pytest_collection_modifyitems(session, config, items):
+    if config.getoption("affected"):
+        _select_affected(config, items)
+    if config.getoption("shard"):
+        _select_shard(config, items)
+
+
+def _deselect(config, items, keep):
+    deselected = [item for item in items if isinstance(item, ZappaAppTest) and not keep(item)]
+    if deselected:
+        config.hook.pytest_deselected(items=deselected)
+    items[:] = [item for item in items if not isinstance(item, ZappaAppTest) or keep(item)]
+
+
+def _select_affected(config, items):
+    global AFFECTED
+    try:
+        AFFECTED = select_apps(config.getoption("affected"), PERF_DB, ENV_CONFIG["zappa_override"])
+    except ValueError as e:
+        raise pytest.UsageError(str(e))
+    _deselect(config, items, lambda item: AFFECTED.get(item.app_name))
+
+
+def _select_shard(config, items):
+    global SHARD
+    try:
+        index, count = parse_shard(config.getoption("shard"))
+    except ValueError as e:
+        raise pytest.UsageError(str(e))
+
+    if config.getoption("shard_durations"):
+        with open(config.getoption("shard_durations")) as f:
+            durations = json.load(f)["durations"]
+    else:
+        # not the local perf DB: every machine has its own history, and would compute its own partition
+        durations = {}
+    app_items = [item.nodeid for item in items if isinstance(item, ZappaAppTest)]
+    shards, loads = partition(app_items, durations, count)
+    SHARD = (index, count, loads[index - 1], shard_plan(app_items, durations))
+
+    selected = set(shards[index - 1])
+    _deselect(config, items, lambda item: item.nodeid in selected)
+
+
+def pytest_collection_finish(session):
+    # hand every selected (app, python version) pair to the scheduler up front;
+    # with a single worker this is a no-op and each item runs inline as before
+    if session.config.option.collectonly:
+        return
+    for item in session.items:
+        if isinstance(item, ZappaAppTest) and item.py_executable is not None:
+            SCHEDULER.submit(item.nodeid, item.app_run)
+
+
+def pytest_runtest_logreport(report):
+    if report.failed:
+        ITEM_OUTCOMES[report.nodeid] = "failed"
+    elif report.skipped:
+        ITEM_OUTCOMES.setdefault(report.nodeid, "skipped")
+    elif report.when == "call":
+        ITEM_OUTCOMES.setdefault(report.nodeid, "passed")
+
+
+def pytest_keyboard_interrupt(excinfo):
+    # kill whatever is running; each pair's teardown still runs afterwards and undeploys
+    PROCESS_ENGINE.cancel_all()
+
+
+def pytest_sessionfinish(session, exitstatus):
+    SCHEDULER.shutdown()
+    if LOCAL_AWS is not None:
+        LOCAL_AWS.stop()
+    OUTPUT_LOGS.close()
+    if ENV_CONFIG["trace"]:
+        TRACER.write(ENV_CONFIG["trace"])
+
+    items = [_item_result(item) for item in session.items if isinstance(item, ZappaAppTest)]
+    if SHARD is None:
+        # shard runs leave the history alone so a retry of shard i is partitioned exactly as before;
+        # `python zappa_e2e.py merge` records their durations instead
+        PERF_DB.record_durations(
+            dict((item["nodeid"], item["duration"]) for item in items if item["duration"] is not None)
+        )
+        return
+
+    index, count, estimated_seconds, plan = SHARD
+    path = session.config.getoption("shard_report") or os.path.join(
+        tempfile.gettempdir(), "zappa-e2e", "shards", "shard-{}-of-{}.json".format(index, count)
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "shard": index,
+                "count": count,
+                "host": socket.gethostname(),
+                "wall_seconds": time.time() - SESSION_STARTED,
+                "estimated_seconds": estimated_seconds,
+                "plan": plan,
+                "items": items,
+            },
+            f,
+            indent=2,
+            sort_keys=True,
+        )
+    logger.info("Zappa E2E: wrote shard report to " + path)
+
+
+def _item_result(item):
+    """outcome, duration (all four stages), per-phase timings and preserved temp dir of one app item"""
+    run = item.app_run
+    timings = {}
+    duration = None
+    for span in TRACER.spans_for(**run.trace_context):
+        timings[span["name"]] = timings.get(span["name"], 0) + span["duration"]
+        if span["name"].startswith("stage "):
+            duration = (duration or 0) + span["duration"]
+    return {
+        "nodeid": item.nodeid,
+        "outcome": ITEM_OUTCOMES.get(item.nodeid, "not run"),
+        "duration": duration,
+        "timings": timings,
+        "preserved": run.ptd.name if run.ptd is not None and run.ptd.preserved else None,
+    }
+
+
+def pytest_terminal_summary(terminalreporter):
+    if AFFECTED is not None:
+        terminalreporter.write_sep("=", "zappa e2e affected apps")
+        for name in sorted(AFFECTED):
+            terminalreporter.write_line(
+                "{}: {} ({})".format("run" if AFFECTED[name] else "skip", name, AFFECTED[name] or "unchanged")
+            )
+    cold_starts = [run.cold_start for run in APP_RUNS if run.cold_start]
+    if cold_starts:
+        terminalreporter.write_sep("=", "zappa e2e cold starts")
+        for line in _cold_start_table(cold_starts):
+            terminalreporter.write_line(line)
+    if PROCESS_ENGINE.stats["timeouts"] or PROCESS_ENGINE.stats["cancelled"]:
+        terminalreporter.write_sep("=", "zappa e2e processes")
+        terminalreporter.write_line(PROCESS_ENGINE.report())
+    if RATE_LIMITER.stats["calls"]:
+        terminalreporter.write_sep("=", "zappa e2e rate limiter")
+        terminalreporter.write_line(RATE_LIMITER.report())
+    if SCHEDULER.pipelined:
+        terminalreporter.write_sep("=", "zappa e2e pipeline")
+        for line in SCHEDULER.report():
+            terminalreporter.write_line(line)
+    if terminalreporter.config.getoption("venv_cache_stats"):
+        terminalreporter.write_sep("=", "zappa e2e venv cache")
+        terminalreporter.write_line(VENV_STORE.report())
+
+
+def _cold_start_table(cold_starts):
+    row = "{:<36} {:>6} {:>14} {:>10} {:>10} {:>10}"
+    lines = [row.format("app", "slim", "code size", "cold ms", "warm p50", "penalty")]
+    for result in sorted(cold_starts, key=lambda r: (r["py_version"], r["label"])):
+        lines.append(
+            row.format(
+                result["label"],
+                "yes" if result["slim_handler"] else "no",
+                result["code_size"] or "?",
+                "{:.0f}".format(result["cold_ms"]),
+                "{:.0f}".format(result["warm_p50_ms"]),
+                "{:.0f}".format(result["cold_penalty_ms"]),
+            )
+        )
+    return lines
+
+
 class ZappaAppFile(pytest.File):
     def __init__(self, name, parent=None, config=None, session=None, nodeid=None):
         super(ZappaAppFile, self).__init__(name, parent, config, session, nodeid=nodeid)
@@ -52,145 +349,508 @@ class ZappaAppFile(pytest.File):
         self.app_path = os.path.join(APPS_PREFIX, app_name)
 
     def collect(self):
-        yield ZappaAppTest(self.app_name, self)
+        matrix = settings_matrix(self.app_path)
+        for py_version, py_executable in python_executables(app_runtimes(self.app_path)).items():
+            for combination in matrix:
+                name = "{}-py{}".format(self.app_name, py_version)
+                if combination:
+                    name += "[{}]".format(
+                        ",".join("{}={}".format(k, combination[k]) for k in sorted(combination))
+                    )
+                yield ZappaAppTest(name, self, py_version, py_executable, combination)
 
 
 class ZappaAppTest(pytest.Item):
-    first_run = True
-
-    def __init__(self, name, parent):
+    def __init__(self, name, parent, py_version, py_executable, combination=None):
         super(ZappaAppTest, self).__init__(name, parent)
         self.app_name = parent.app_name
         self.app_path = parent.app_path
-
-    def _venv_cmd(self, cmd, params=[], as_json=False, check=False, extra_env={}):
-        extra_env.update({
-            'VIRTUAL_ENV': self.venv_dir,
-            'PATH': ':'.join([os.path.join(self.venv_dir, 'bin'), os.environ.get('PATH')]),
-        })
-        return venv_cmd(self.venv_dir, cmd, params, as_json, check, extra_env)
+        self.py_version = py_version
+        self.py_executable = py_executable
+        self.app_run = ZappaAppRun(
+            self.app_name, self.app_path, py_version, py_executable, combination
+        )
+        APP_RUNS.append(self.app_run)
 
     def runtest(self):
-
-        for py_version, py_executable in python_executables().items():
-
-            if py_executable is None:
-                logger.warn("Could not find a python {} executable.".format(py_version))
-                continue
-
-            if ENV_CONFIG['sleep_between']:
-                if self.__class__.first_run:
-                    self.__class__.first_run = False
-                else:
-                    logger.info(
-                        "Sleeping for {}s to help with the AWS rate limit.".format(
-                            ENV_CONFIG['sleep_between']
-                        )
+        if self.py_executable is None:
+            pytest.skip("Could not find a python {} executable.".format(self.py_version))
+
+        try:
+            SCHEDULER.result(self.nodeid, self.app_run)
+            run_id = new_run_id(self.app_run.label)
+            violations = self._check_package(run_id)
+            self._check_performance(run_id)
+            if violations:
+                pytest.fail(
+                    "Package over budget ({}):\n".format(os.path.join(self.app_path, "zappa_budget.json"))
+                    + "\n".join("{} is {} bytes, budget {}".format(*v) for v in violations)
+                )
+        finally:
+            for span in TRACER.spans_for(**self.app_run.trace_context):
+                self.user_properties.append(
+                    (
+                        "span:" + span["name"],
+                        json.dumps(
+                            dict((k, span[k]) for k in ("start", "duration", "exit_code", "error") if k in span)
+                        ),
                     )
-                    time.sleep(ENV_CONFIG['sleep_between'])
-
-            logger.info(
-                "Entering app {} with Python {}".format(self.app_name, py_version)
-            )
-            with PreservableTemporaryDirectory(self.app_name, "py" + py_version) as (
-                app_tmp_dir,
-                ptd,
-            ):
-                self.app_test_dir = os.path.join(
-                    app_tmp_dir, "{}-py{}".format(self.app_name, py_version)
                 )
-                copy_tree(self.app_path, self.app_test_dir)
-                chdir(self.app_test_dir)
-
-                self.venv_dir = os.path.join(app_tmp_dir, "venv")
-
-                req_path = os.path.join(self.app_test_dir, "requirements.txt")
-                if os.path.isfile(req_path):
-                    requirements_txt_path = req_path
-
-                alt_req_path = os.path.join(
-                    self.app_test_dir,
-                    "requirements-py{}.txt".format(py_version.replace(".", "")),
+            if self.app_run.ptd is not None and self.app_run.ptd.preserved:
+                self.add_report_section(
+                    "call", "preserved temp dir", self.app_run.ptd.name
                 )
-                if os.path.isfile(alt_req_path):
-                    # override:
-                    requirements_txt_path = alt_req_path
-
-                if not os.path.isdir(self.venv_dir):
-                    cmd = subprocess.run(
-                        ["virtualenv", "-p", py_executable, self.venv_dir],
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                    )
-                    if cmd.returncode != 0:
-                        print(cmd.returncode, cmd.stdout, cmd.stderr)
-                        raise EnvironmentError(
-                            "Could not create virtualenv for py {}".format(py_version)
-                        )
-
-                if ENV_CONFIG['zappa_override']:
-                    # allow the user to supply a zappa override. This can be a version or a local path. Or even a fork, if that ever exists.
-                    logger.debug("Installing overridden Zappa: {}".format(ENV_CONFIG['zappa_override']))
-                    ret, _, _ = self._venv_cmd(
-                        "pip", ["uninstall", "-y", "zappa"], check=True
-                    )
-                    ret, _, _ = self._venv_cmd(
-                        "pip", ["install", "--no-cache-dir", "--upgrade", "--no-deps", "--force-reinstall", "--ignore-installed", ENV_CONFIG['zappa_override']], check=True
-                    )
-
-                ret, _, _ = self._venv_cmd(
-                    "pip", ["install", "-r", requirements_txt_path, "--no-cache-dir"], check=True
+            if self.app_run.deployed_app is not None:
+                self.add_report_section(
+                    "call",
+                    "zappa status calls",
+                    str(self.app_run.deployed_app.status_calls),
                 )
-
-                template_file = os.path.join(
-                    self.app_test_dir, "zappa_settings.json.j2"
+            if self.app_run.deployed_app is not None and self.app_run.deployed_app.package:
+                self.add_report_section(
+                    "call",
+                    "zappa package",
+                    "{path}: {size} bytes, built in {build_seconds:.1f}s".format(
+                        **self.app_run.deployed_app.package
+                    ),
+                )
+            if self.app_run.benchmark is not None:
+                self.add_report_section(
+                    "call", "benchmark", json.dumps(self.app_run.benchmark, indent=2)
+                )
+            if self.app_run.zappa_worker is not None:
+                self.add_report_section(
+                    "call", "zappa worker", self.app_run.zappa_worker.report()
                 )
-                with open(template_file) as f:
-                    template_source = f.read()
 
-                template = Template(template_source)
-                rendered_template = template.render(
-                    S3_BUCKET=ZAPPA_S3_BUCKET, E2E_VERSION=py_version
+    def _check_package(self, run_id):
+        """records the package breakdown and reports it with its diff against the previous run; returns budget violations"""
+        analysis = self.app_run.package_analysis
+        if analysis is None:
+            return []
+        variant = variant_name(self.app_run.combination)
+        previous = PERF_DB.previous_package(self.app_name, self.py_version, variant)
+        PERF_DB.record_package(run_id, {"app": self.app_name, "py_version": self.py_version, "variant": variant}, analysis)
+        violations = budget_violations(analysis, app_budget(self.app_path))
+        self.add_report_section(
+            "call",
+            "package size",
+            "\n".join(
+                format_package_analysis(
+                    analysis, None if previous is None else package_diff(previous, analysis), violations
                 )
+            ),
+        )
+        return violations
+
+    def _check_performance(self, run_id):
+        metrics = self.app_run.metrics()
+        if not metrics:
+            return
+        PERF_DB.record(
+            run_id,
+            {
+                "app": self.app_name,
+                "py_version": self.py_version,
+                "variant": variant_name(self.app_run.combination),
+                "zappa_version": self.app_run.zappa_version,
+                "zappa_override": ZAPPA_OVERRIDE_REVISION,
+                "git_commit": GIT_COMMIT,
+            },
+            metrics,
+        )
+        regressions = PERF_DB.regressions(run_id)
+        if regressions:
+            message = "\n".join(format_regression(r) for r in regressions)
+            self.add_report_section("call", "performance regressions", message)
+            if ENV_CONFIG["perf_gate"]:
+                pytest.fail("Performance regressed:\n" + message)
+            logger.warn("Performance regressed:\n" + message)
+
+    def reportinfo(self):
+        return self.fspath, None, self.name
+
+
+class ZappaAppRun:
+    def __init__(self, app_name, app_path, py_version, py_executable, combination=None):
+        """One deploy/test/undeploy cycle of an app on one Python version (and one zappa_matrix.json combination)
+
+        split into the RunScheduler stages (prepare, deploy, verify, teardown). Keeps no global process state (no
+        chdir) so several runs can share a process"""
+        self.app_name = app_name
+        self.app_path = app_path
+        self.py_version = py_version
+        self.py_executable = py_executable
+        self.combination = combination or {}
+        # app dirs, result files and logs are named after this, so matrix combinations never collide
+        self.workspace_name = app_name
+        if self.combination:
+            self.workspace_name += "-" + variant_name(self.combination)
+        self.label = "{}-py{}".format(app_name, py_version)
+        if self.combination:
+            self.label += "-" + variant_name(self.combination)
+        self.app_test_dir = None
+        self.venv_dir = None
+        self.ptd = None
+        self.zappa_worker = None
+        self.deployed_app = None
+        self.requirements_txt_path = None
+        self.settings_file = None
+        self.workspace_sync = None
+        self._exit_stack = None
+        self.trace_context = {"app": app_name, "py_version": py_version}
+        if self.combination:
+            self.trace_context["variant"] = variant_name(self.combination)
+        self.benchmark = None
+        self.cold_start = None
+        self.package_analysis = None
+        self.zappa_version = None
+
+    def __repr__(self):
+        return "<{} {}>".format(self.__class__.__name__, self.label)
+
+    def _venv_cmd(self, cmd, params=[], as_json=False, check=False, extra_env={}, venv_dir=None):
+        venv_dir = venv_dir or self.venv_dir
+        extra_env = dict(extra_env)
+        extra_env.update({
+            'VIRTUAL_ENV': venv_dir,
+            'PATH': ':'.join([os.path.join(venv_dir, 'bin'), os.environ.get('PATH')]),
+        })
+        if cmd == "zappa":
+            return zappa_cmd(
+                venv_dir,
+                params,
+                as_json,
+                check,
+                extra_env,
+                cwd=self.app_test_dir,
+                zappa_worker=self.zappa_worker if venv_dir == self.venv_dir else None,
+            )
+        return venv_cmd(
+            venv_dir, cmd, params, as_json, check, extra_env, cwd=self.app_test_dir
+        )
+
+    def _build_venv(self, venv_dir, requirements_txt_path):
+        install_args, zappa_override = self._install_sources()
+        zappa_line = None if ENV_CONFIG["no_base_venv"] else zappa_requirement(requirements_txt_path)
+        if zappa_line:
+            # Zappa and its dependencies come from a base venv shared by every app on this interpreter;
+            # only the app's own requirements are installed into the clone
+            base_key = VENV_STORE.base_key(
+                python_version_string(self.py_executable), zappa_line, ENV_CONFIG["zappa_override"]
+            )
+            base_dir = VENV_STORE.checkout(
+                base_key,
+                lambda base_dir: self._build_base_venv(base_dir, zappa_line, install_args, zappa_override),
+            )
+            try:
+                with TRACER.span("clone venv") as span:
+                    span.update(clone_venv(base_dir, venv_dir))
+            finally:
+                VENV_STORE.release(base_key)
+        else:
+            self._create_venv(venv_dir)
+            self._install_zappa_override(venv_dir, install_args, zappa_override)
+
+        with TRACER.span("pip install", requirement=os.path.basename(requirements_txt_path)) as span:
+            ret, _, _ = self._venv_cmd(
+                "pip", ["install", "-r", requirements_txt_path] + install_args, check=True, venv_dir=venv_dir
+            )
+            span["exit_code"] = ret
+
+    def _build_base_venv(self, base_dir, zappa_line, install_args, zappa_override):
+        self._create_venv(base_dir)
+        with TRACER.span("pip install", requirement=zappa_line) as span:
+            ret, _, _ = self._venv_cmd("pip", ["install", zappa_line] + install_args, check=True, venv_dir=base_dir)
+            span["exit_code"] = ret
+        self._install_zappa_override(base_dir, install_args, zappa_override)
+
+    def _install_sources(self):
+        """(pip install args, Zappa override to install): the wheelhouse and the override's wheel, unless disabled"""
+        zappa_override = ENV_CONFIG['zappa_override']
+        install_args = ["--no-cache-dir"]
+        if not ENV_CONFIG["no_wheelhouse"]:
+            override_wheel = WHEELHOUSE.ensure(
+                self.py_version,
+                self.py_executable,
+                self._all_requirements_paths(),
+                zappa_override,
+            )
+            if override_wheel:
+                zappa_override = override_wheel
+            install_args = WHEELHOUSE.install_args(self.py_version)
+        return install_args, zappa_override
+
+    def _create_venv(self, venv_dir):
+        with TRACER.span("virtualenv") as span:
+            ret, out, err = OUTPUT_LOGS.run(["virtualenv", "-p", self.py_executable, venv_dir])
+            span["exit_code"] = ret
+        if ret != 0:
+            logger.error(
+                "Zappa E2E: virtualenv exited {}; full output in {}".format(ret, OUTPUT_LOGS.log_path())
+            )
+            raise EnvironmentError(
+                "Could not create virtualenv for py {}".format(self.py_version)
+            )
 
-                settings_file = os.path.join(self.app_test_dir, "zappa_settings.json")
-                with open(settings_file, "w") as zsj:
-                    zsj.write(rendered_template)
-                    logger.debug(
-                        "Zappa E2E: wrote settings file {} from template {}".format(
-                            settings_file, template_file
-                        )
+    def _install_zappa_override(self, venv_dir, install_args, zappa_override):
+        if zappa_override:
+            # allow the user to supply a zappa override. This can be a version or a local path. Or even a fork, if that ever exists.
+            logger.debug("Installing overridden Zappa: {}".format(zappa_override))
+            with TRACER.span("pip uninstall") as span:
+                ret, _, _ = self._venv_cmd(
+                    "pip", ["uninstall", "-y", "zappa"], check=True, venv_dir=venv_dir
+                )
+                span["exit_code"] = ret
+            with TRACER.span("pip install", requirement=zappa_override) as span:
+                ret, _, _ = self._venv_cmd(
+                    "pip", ["install"] + install_args + ["--upgrade", "--no-deps", "--force-reinstall", "--ignore-installed", zappa_override], check=True, venv_dir=venv_dir
+                )
+                span["exit_code"] = ret
+
+    def _all_requirements_paths(self):
+        # the wheelhouse is built for every app at once, so later apps' venvs never go to the network
+        paths = []
+        for app_name in sorted(os.listdir(APPS_PREFIX)):
+            path = requirements_path(os.path.join(APPS_PREFIX, app_name), self.py_version)
+            if path:
+                paths.append(path)
+        return paths
+
+    def _link_venv(self, venv_link, venv_dir):
+        # run_tests scripts activate ../venv, so keep that path pointing at the shared venv
+        if os.path.islink(venv_link):
+            if os.readlink(venv_link) == venv_dir:
+                return
+            os.unlink(venv_link)
+        elif os.path.isdir(venv_link):
+            # a private venv from before the shared store existed
+            shutil.rmtree(venv_link)
+        os.symlink(venv_dir, venv_link)
+
+    def prepare(self):
+        """local, CPU/disk-bound setup: workspace, venv and rendered settings"""
+        py_version = self.py_version
+        py_executable = self.py_executable
+
+        logger.info(
+            "Entering app {} with Python {}{}".format(
+                self.app_name,
+                py_version,
+                " and settings {}".format(self.combination) if self.combination else "",
+            )
+        )
+        self._exit_stack = ExitStack()
+        app_tmp_dir, ptd = self._exit_stack.enter_context(
+            PreservableTemporaryDirectory(self.workspace_name, "py" + py_version)
+        )
+        self.ptd = ptd
+        self.app_test_dir = os.path.join(app_tmp_dir, self.label)
+        with TRACER.span("sync workspace") as span:
+            # the manifest sits beside the app dir so it is never packaged
+            self.workspace_sync = WorkspaceSync(
+                self.app_path, self.app_test_dir, os.path.join(app_tmp_dir, self.label + ".manifest.json")
+            ).run()
+            span["copied"] = len(self.workspace_sync.copied)
+            span["removed"] = len(self.workspace_sync.removed)
+            span["changed"] = self.workspace_sync.changed
+        logger.debug("Zappa E2E: synced {}: {}".format(self.app_test_dir, self.workspace_sync.summary()))
+
+        requirements_txt_path = requirements_path(self.app_test_dir, py_version)
+
+        venv_key = VENV_STORE.key(
+            python_version_string(py_executable),
+            requirements_txt_path,
+            ENV_CONFIG["zappa_override"],
+        )
+        self.venv_dir = os.path.join(app_tmp_dir, "venv")
+        self._link_venv(
+            self.venv_dir,
+            VENV_STORE.checkout(
+                venv_key,
+                lambda venv_dir: self._build_venv(venv_dir, requirements_txt_path),
+            ),
+        )
+        self._exit_stack.callback(VENV_STORE.release, venv_key)
+        self.requirements_txt_path = requirements_txt_path
+
+        template_file = os.path.join(
+            self.app_test_dir, "zappa_settings.json.j2"
+        )
+        self.settings_file = os.path.join(self.app_test_dir, "zappa_settings.json")
+        with TRACER.span("render settings"):
+            # also applies the matrix combination, and the local backend's settings when it is running
+            render_settings(
+                template_file, self.settings_file, py_version, self.combination, s3_bucket=ZAPPA_S3_BUCKET
+            )
+            if not ENV_CONFIG["no_package_analysis"]:
+                keep_local_package(self.settings_file, "test")
+        logger.debug(
+            "Zappa E2E: wrote settings file {} from template {}".format(
+                self.settings_file, template_file
+            )
+        )
+
+    def deploy(self):
+        if ENV_CONFIG["zappa_worker"]:
+            self.zappa_worker = ZappaWorker(self.venv_dir, self.label)
+            self._exit_stack.callback(self._log_worker_report)
+            self._exit_stack.enter_context(self.zappa_worker)
+
+        self.zappa_version = installed_version(self.venv_dir, "zappa")
+        self.deployed_app = DeployedZappaApp(
+            self.app_test_dir,
+            self.venv_dir,
+            self.ptd,
+            zappa_worker=self.zappa_worker,
+            fingerprint=deployment_fingerprint(
+                self.app_test_dir,
+                self.requirements_txt_path,
+                self.settings_file,
+                self.venv_dir,
+                source_hash=self.workspace_sync.source_hash(),
+            ),
+            package_store=None if ENV_CONFIG["no_package_cache"] else PACKAGE_STORE,
+            gateway=None
+            if LOCAL_AWS is None
+            else LocalGateway(
+                self.venv_dir,
+                self.app_test_dir,
+                log_path=os.path.join(self.ptd.name, "gateway.log"),
+            ),
+        )
+        # undeployed handled in DeployedZappaApp, on teardown
+        self._exit_stack.enter_context(self.deployed_app)
+
+    def verify(self):
+        py_version = self.py_version
+
+        if not ENV_CONFIG["undeploy_only"]:
+
+            # already fetched right after the deploy; no need for another round trip
+            ret, status = self.deployed_app.get_status()
+            assert ret == 0, "Got Zappa app status"
+
+            env_status = {"PY_VERSION": py_version.replace(".", "")}
+            for k, v in status.items():
+                if type(v) == str:
+                    env_status[k.upper().replace(" ", "_")] = v
+
+            run_tests = os.path.join(self.app_test_dir, "run_tests")
+            if os.path.isfile(run_tests):
+                with TRACER.span("run_tests") as span:
+                    ret, out, err = self._venv_cmd(
+                        run_tests, extra_env=env_status
                     )
+                    span["exit_code"] = ret
+                if ret == 0:
+                    logger.info("Tests ran successfully!")
+                else:
+                    logger.info("stdout:")
+                    [logger.info(l) for l in out.decode().split("\n") if l != ""]
+                    logger.info("stderr:")
+                    [logger.info(l) for l in err.decode().split("\n") if l != ""]
+                assert (
+                    ret == 0 or ret == 5
+                ), "run_tests success (or no tests)"
+
+            if ENV_CONFIG["benchmark_requests"]:
+                self._benchmark(status["API Gateway URL"], status)
+
+            if ENV_CONFIG["cold_start_probe"]:
+                with TRACER.span("cold start probe"):
+                    if self.deployed_app.gateway is not None:
+                        # a fresh gateway process is the local equivalent of a fresh Lambda container
+                        force_cold = self.deployed_app.gateway.restart
+                    else:
+                        force_cold = lambda: force_lambda_cold_start(self.venv_dir, status["Lambda ARN"])
+                    self.cold_start = cold_start_probe(
+                        status["API Gateway URL"],
+                        force_cold,
+                        ENV_CONFIG["cold_start_warm_requests"],
+                    )
+                    if self.deployed_app.gateway is None:
+                        # forcing the cold start changed the function's configuration, and its last-modified time
+                        self.deployed_app.refresh_fingerprint()
+                self.cold_start.update(self._result_attrs(status))
+                self.cold_start["label"] = self.label
+                self.cold_start["slim_handler"] = bool(
+                    load_settings(self.settings_file).get("test", {}).get("slim_handler")
+                )
 
-                with DeployedZappaApp(
-                    self.app_test_dir, self.venv_dir, ptd
-                ) as zappa_app:
-
-                    # undeployed handled in DeployedZappaApp
-                    if not ENV_CONFIG["undeploy_only"]:
-
-                        ret, status, _ = self._venv_cmd(
-                            "zappa", ["status"], as_json=True
-                        )
-                        assert ret == 0, "Got Zappa app status"
-
-                        env_status = {"PY_VERSION": py_version.replace(".", "")}
-                        for k, v in status.items():
-                            if type(v) == str:
-                                env_status[k.upper().replace(" ", "_")] = v
-
-                        run_tests = os.path.join(self.app_test_dir, "run_tests")
-                        if os.path.isfile(run_tests):
-                            ret, out, err = self._venv_cmd(
-                                run_tests, extra_env=env_status
-                            )
-                            if ret == 0:
-                                logger.info("Tests ran successfully!")
-                            else:
-                                logger.info("stdout:")
-                                [logger.info(l) for l in out.decode().split("\n") if l != ""]
-                                logger.info("stderr:")
-                                [logger.info(l) for l in err.decode().split("\n") if l != ""]
-                            assert (
-                                ret == 0 or ret == 5
-                            ), "run_tests success (or no tests)"
+            if not ENV_CONFIG["no_package_analysis"]:
+                with TRACER.span("package analysis"):
+                    work_dir = os.path.join(self.ptd.name, "package-analysis")
+                    os.makedirs(work_dir, exist_ok=True)
+                    try:
+                        archives = self.deployed_app.package_archives(work_dir)
+                        if archives:
+                            self.package_analysis = analyze_package(archives)
+                    finally:
+                        # only the breakdown is kept; a preserved temp dir would otherwise gain a package every run
+                        shutil.rmtree(work_dir, ignore_errors=True)
+
+    def _result_attrs(self, status):
+        return {
+            "app": self.app_name,
+            "py_version": self.py_version,
+            "variant": self.combination,
+            "memory_size": status.get("Lambda Memory Size"),
+            "code_size": status.get("Lambda Code Size"),
+        }
+
+    def _benchmark(self, url, status):
+        with TRACER.span("benchmark"):
+            self.benchmark = benchmark(
+                url,
+                ENV_CONFIG["benchmark_requests"],
+                ENV_CONFIG["benchmark_concurrency"],
+            )
+        self.benchmark.update(self._result_attrs(status))
+        # rough cost signal for memory sweeps: what a million requests at the median latency would bill
+        self.benchmark["gb_seconds_per_million"] = (
+            (status.get("Lambda Memory Size") or 0) / 1024.0
+            * self.benchmark["latency_ms"]["p50"] / 1000.0
+            * 1e6
+        )
+
+        os.makedirs(ENV_CONFIG["benchmark_dir"], exist_ok=True)
+        result_file = os.path.join(ENV_CONFIG["benchmark_dir"], self.label + ".json")
+        with open(result_file, "w") as f:
+            json.dump(self.benchmark, f, indent=2)
+        logger.info(
+            "{}: benchmark p50={p50:.0f}ms p90={p90:.0f}ms p99={p99:.0f}ms max={max:.0f}ms".format(
+                self.label, **self.benchmark["latency_ms"]
+            )
+            + " {:.1f} req/s, {:.1%} errors; written to {}".format(
+                self.benchmark["throughput_rps"], self.benchmark["error_rate"], result_file
+            )
+        )
+
+    def metrics(self):
+        """what goes into the perf DB for this run; all lower-is-better"""
+        metrics = {}
+        for span in TRACER.spans_for(**self.trace_context):
+            if span["name"] in ("zappa deploy", "zappa update", "zappa undeploy") and span.get("exit_code") == 0:
+                metrics[span["name"].split()[1] + "_seconds"] = span["duration"]
+        if self.deployed_app is not None:
+            if self.deployed_app.package and self.deployed_app.package["built"]:
+                metrics["package_build_seconds"] = self.deployed_app.package["build_seconds"]
+            metrics["code_size"] = self.deployed_app.status.get("Lambda Code Size")
+            readiness = self.deployed_app.readiness
+            if readiness and readiness["ready"]:
+                metrics[readiness["command"] + "_ready_seconds"] = readiness["seconds"]
+        if self.package_analysis is not None:
+            metrics["package_uncompressed_bytes"] = self.package_analysis["uncompressed_bytes"]
+        if self.benchmark is not None:
+            for pct in ("p50", "p90", "p99"):
+                metrics["latency_{}_ms".format(pct)] = self.benchmark["latency_ms"][pct]
+        return dict((k, v) for k, v in metrics.items() if v is not None)
+
+    def teardown(self):
+        """undeploy, then give back the worker, the shared venv and the temp dir; runs even if an earlier stage failed"""
+        if self._exit_stack is not None:
+            self._exit_stack.close()
+
+    def _log_worker_report(self):
+        logger.info("{}: {}".format(self.label, self.zappa_worker.report()))
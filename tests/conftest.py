@@ -0,0 +1,27 @@
+import os
+import sys
+from contextlib import ExitStack
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from zappa_e2e import local_wsgi_server  # noqa: E402
+
+
+def hello(environ, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [b"hello"]
+
+
+@pytest.fixture
+def hello_app():
+    """a WSGI app that answers every request with 200 "hello" """
+    return hello
+
+
+@pytest.fixture
+def serve():
+    """serve(wsgi_app) -> the URL of wsgi_app on the local WSGI stand-in, which stops when the test ends"""
+    with ExitStack() as stack:
+        yield lambda app: stack.enter_context(local_wsgi_server(app))
@@ -0,0 +1,21 @@
+from zappa_e2e import affected_apps
+
+APPS = ["hello-world", "slim"]
+
+
+def test_app_changes_only_affect_their_app():
+    assert affected_apps(["apps/slim/app.py"], APPS) == {"hello-world": None, "slim": "changed: apps/slim/app.py"}
+
+
+def test_harness_changes_affect_every_app():
+    assert affected_apps(["zappa_e2e.py"], APPS) == dict((name, "harness changed: zappa_e2e.py") for name in APPS)
+
+
+def test_docs_and_unit_tests_affect_no_app():
+    changed = ["README.md", ".gitignore", "tests/test_sweep.py", "tests/conftest.py"]
+    assert affected_apps(changed, APPS) == {"hello-world": None, "slim": None}
+
+
+def test_a_zappa_override_change_affects_every_app():
+    reason = "Zappa override changed: abc -> def"
+    assert affected_apps([], APPS, override_change=reason) == dict((name, reason) for name in APPS)
@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+from zappa_e2e import benchmark, load_wsgi_app, local_wsgi_server, percentile
+
+APPS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "apps")
+
+
+@pytest.fixture
+def hello_world(serve):
+    pytest.importorskip("flask")
+    return serve(load_wsgi_app(os.path.join(APPS_DIR, "hello-world")))
+
+
+def test_benchmark_against_hello_world(hello_world):
+    result = benchmark(hello_world, requests=50, concurrency=4)
+
+    assert result["requests"] == 50
+    assert result["errors"] == 0
+    assert result["error_rate"] == 0
+    assert result["throughput_rps"] > 0
+    latency = result["latency_ms"]
+    assert 0 < latency["p50"] <= latency["p90"] <= latency["p99"] <= latency["max"]
+
+
+def test_benchmark_counts_error_statuses(hello_world):
+    result = benchmark(hello_world + "no-such-route", requests=20, concurrency=2)
+
+    assert result["requests"] == 20
+    assert result["errors"] == 20
+    assert result["error_rate"] == 1.0
+
+
+def test_benchmark_counts_connection_errors():
+    with local_wsgi_server(lambda environ, start_response: []) as url:
+        pass  # the port is free again once the server is gone
+
+    result = benchmark(url, requests=5, concurrency=2, timeout=5)
+
+    assert result["requests"] == 5
+    assert result["error_rate"] == 1.0
+
+
+@pytest.mark.parametrize(
+    "pct,expected", [(1, 1), (10, 1), (11, 2), (50, 5), (90, 9), (91, 10), (99, 10), (100, 10)]
+)
+def test_percentile_is_nearest_rank(pct, expected):
+    assert percentile(list(range(1, 11)), pct) == expected
+
+
+def test_percentile_of_nothing_is_zero():
+    assert percentile([], 50) == 0.0
+
+
+def test_percentile_of_one_value():
+    assert [percentile([0.25], pct) for pct in (1, 50, 99)] == [0.25, 0.25, 0.25]
@@ -0,0 +1,39 @@
+import pytest
+
+from zappa_e2e import SimulatedColdStart, cold_start_probe
+
+
+@pytest.fixture
+def cold_app(hello_app, serve):
+    app = SimulatedColdStart(hello_app, penalty_seconds=0.5)
+    return app, serve(app)
+
+
+def test_probe_reports_the_cold_start_penalty(cold_app):
+    app, url = cold_app
+
+    result = cold_start_probe(url, app.reset, warm_requests=5)
+
+    assert result["warm_requests"] == 5
+    assert result["cold_ms"] >= 500
+    assert result["warm_p50_ms"] < 100
+    assert result["cold_penalty_ms"] == pytest.approx(500, abs=100)
+
+
+def test_probe_without_a_cold_start_has_no_penalty(cold_app):
+    app, url = cold_app
+    cold_start_probe(url, app.reset, warm_requests=1)
+
+    # nothing makes the container cold this time
+    result = cold_start_probe(url, lambda: None, warm_requests=5)
+
+    assert result["cold_penalty_ms"] < 100
+
+
+def test_probe_fails_on_error_statuses(serve):
+    def broken(environ, start_response):
+        start_response("502 Bad Gateway", [])
+        return [b""]
+
+    with pytest.raises(EnvironmentError):
+        cold_start_probe(serve(broken), lambda: None, warm_requests=1)
@@ -0,0 +1,38 @@
+from types import SimpleNamespace
+
+import pytest
+
+from zappa_e2e import DeployedZappaApp
+
+DEPLOYED = {"Lambda Last Modified": "2018-07-05T00:26:52.796+0000", "Lambda Code Size": 19346351}
+# after a forced cold start: same code, new configuration
+TOUCHED = dict(DEPLOYED, **{"Lambda Last Modified": "2018-07-05T00:31:07.112+0000"})
+
+
+@pytest.fixture
+def live(tmpdir):
+    """a DeployedZappaApp whose live status is whatever live["status"] holds"""
+    live = {"status": DEPLOYED}
+    app = DeployedZappaApp(str(tmpdir), None, SimpleNamespace(name=str(tmpdir)), fingerprint="abc")
+    app.get_status = lambda refresh=False: (0, live["status"])
+    return app, live
+
+
+def test_refresh_fingerprint_follows_a_configuration_change(live):
+    app, status = live
+    app._save_fingerprint(DEPLOYED)
+    status["status"] = TOUCHED
+    assert not app._fingerprint_matches(TOUCHED)
+
+    app.refresh_fingerprint()
+
+    assert app._fingerprint_matches(TOUCHED)
+    assert app.post_deploy_status == TOUCHED
+
+
+def test_refresh_fingerprint_without_a_stored_one_stores_nothing(live):
+    app, status = live
+
+    app.refresh_fingerprint()
+
+    assert not app._fingerprint_matches(DEPLOYED)
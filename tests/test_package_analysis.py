@@ -0,0 +1,164 @@
+import io
+import json
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+from zappa_e2e import DeployedZappaApp, analyze_package, budget_violations, package_diff, parse_size
+
+# (archive member, uncompressed size)
+MEMBERS = [
+    ("handler.py", 1000),
+    ("app.py", 500),
+    ("flask/__init__.py", 3000),
+    ("flask/app.pyc", 2000),
+    ("flask/testing/client.py", 700),
+    ("Flask-1.0.2.dist-info/METADATA", 400),
+    ("markupsafe/_speedups.cpython-36m-x86_64-linux-gnu.so", 5000),
+    ("six.py", 800),
+    ("certifi/cacert.pem", 250),
+]
+
+
+def make_zip(path, members):
+    with zipfile.ZipFile(str(path), "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, size in members:
+            archive.writestr(name, b"x" * size)
+        archive.writestr("flask/", b"")
+    return str(path)
+
+
+def make_tarball(path, members):
+    with tarfile.open(str(path), "w:gz") as archive:
+        for name, size in members:
+            info = tarfile.TarInfo(name)
+            info.size = size
+            archive.addfile(info, io.BytesIO(b"x" * size))
+    return str(path)
+
+
+def test_analyze_package_breaks_down_by_package_and_type(tmpdir):
+    path = make_zip(tmpdir.join("package.zip"), MEMBERS)
+
+    analysis = analyze_package([path])
+
+    assert analysis["archive_bytes"] == os.path.getsize(path)
+    assert analysis["files"] == len(MEMBERS)
+    assert analysis["uncompressed_bytes"] == sum(size for _, size in MEMBERS)
+    assert analysis["packages"] == {
+        "handler": 1000,
+        "app": 500,
+        "flask": 6100,
+        "markupsafe": 5000,
+        "six": 800,
+        "certifi": 250,
+    }
+    assert analysis["types"] == {".py": 5300, ".pyc": 2000, "tests": 700, "dist-info": 400, ".so": 5000, "other": 250}
+
+
+def test_analyze_package_adds_up_a_slim_handler_and_its_project_archive(tmpdir):
+    handler = make_zip(tmpdir.join("handler.zip"), MEMBERS[:1])
+    project = make_tarball(tmpdir.join("project.tar.gz"), MEMBERS[1:])
+
+    analysis = analyze_package([handler, project])
+
+    assert analysis["archive_bytes"] == os.path.getsize(handler) + os.path.getsize(project)
+    single = analyze_package([make_zip(tmpdir.join("package.zip"), MEMBERS)])
+    for key in ("files", "uncompressed_bytes", "packages", "types"):
+        assert analysis[key] == single[key]
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [(1048576, 1048576), ("1MB", 1048576), ("512KB", 524288), ("1.5GB", 1610612736), ("100", 100), (" 2 mb ", 2097152)],
+)
+def test_parse_size(value, expected):
+    assert parse_size(value) == expected
+
+
+def test_parse_size_rejects_junk():
+    with pytest.raises(ValueError):
+        parse_size("lots")
+
+
+def test_budget_violations(tmpdir):
+    analysis = analyze_package([make_zip(tmpdir.join("package.zip"), MEMBERS)])
+    budget = {
+        "uncompressed_bytes": 10000,
+        "archive_bytes": 10 ** 6,
+        "packages": {"flask": 6000, "markupsafe": 5000, "botocore": 1},
+        "types": {"tests": 1000, ".so": 4096},
+    }
+
+    assert budget_violations(analysis, budget) == [
+        ("uncompressed_bytes", 13650, 10000),
+        ("package flask", 6100, 6000),
+        ("type .so", 5000, 4096),
+    ]
+    assert budget_violations(analysis, {}) == []
+
+
+def test_package_diff_lists_what_moved_biggest_first():
+    previous = {
+        "archive_bytes": 50000,
+        "uncompressed_bytes": 100000,
+        "packages": {"flask": 60000, "requests": 40000},
+        "types": {".py": 100000},
+    }
+    current = {
+        "archive_bytes": 50500,
+        "uncompressed_bytes": 130000,
+        "packages": {"flask": 60000, "requests": 40000, "numpy": 30000},
+        "types": {".py": 100000, ".so": 30000},
+    }
+
+    assert package_diff(previous, current) == [
+        ("package numpy", 0, 30000),
+        ("type .so", 0, 30000),
+        ("uncompressed_bytes", 100000, 130000),
+    ]
+    assert package_diff(previous, current, min_bytes=500)[-1] == ("archive_bytes", 50000, 50500)
+
+
+def test_package_diff_against_no_previous_run():
+    current = {"archive_bytes": 2048, "uncompressed_bytes": 4096, "packages": {"app": 4096}, "types": {".py": 4096}}
+
+    assert package_diff({}, current) == [
+        ("package app", 0, 4096),
+        ("type .py", 0, 4096),
+        ("uncompressed_bytes", 0, 4096),
+        ("archive_bytes", 0, 2048),
+    ]
+
+
+def test_package_archives_are_the_last_build_zappa_left_behind(tmpdir):
+    app_dir = tmpdir.mkdir("app")
+    app_dir.join("zappa_settings.json").write(json.dumps({"test": {"project_name": "slim-36", "slim_handler": True}}))
+    # a deploy, then an update whose handler zip was built a few seconds after its project archive
+    for name in (
+        "slim-36-test-1000.tar.gz",
+        "handler_slim-36-test-1010.zip",
+        "slim-36-test-2000.tar.gz",
+        "handler_slim-36-test-2004.zip",
+        "slim-36-other-3000.zip",
+    ):
+        app_dir.join(name).write("")
+    work_dir = tmpdir.mkdir("analysis")
+
+    archives = DeployedZappaApp(str(app_dir), None, None).package_archives(str(work_dir))
+
+    assert sorted(os.path.basename(path) for path in archives) == [
+        "handler_slim-36-test-2004.zip",
+        "slim-36-test-2000.tar.gz",
+    ]
+    assert all(os.path.dirname(path) == str(work_dir) for path in archives)
+    assert sorted(os.listdir(str(app_dir))) == ["slim-36-other-3000.zip", "zappa_settings.json"]
+
+
+def test_nothing_to_analyze_without_a_build_or_package_store(tmpdir):
+    app_dir = tmpdir.mkdir("app")
+    app_dir.join("zappa_settings.json").write(json.dumps({"test": {"project_name": "hello-world-36"}}))
+
+    assert DeployedZappaApp(str(app_dir), None, None).package_archives(str(tmpdir.mkdir("analysis"))) == []
@@ -0,0 +1,48 @@
+import signal
+import stat
+import subprocess
+import threading
+
+import pytest
+
+import zappa_e2e
+from zappa_e2e import ProcessEngine, ZappaWorker
+
+
+def test_slots_count_against_the_process_limit():
+    engine = ProcessEngine(max_processes=1, timeouts={"default": 30})
+    results = []
+    runner = threading.Thread(target=lambda: results.append(engine.run(["true"])))
+
+    with engine.slot():
+        runner.start()
+        runner.join(0.5)
+        # the only slot is taken, so the command has to wait for it
+        assert runner.is_alive()
+        assert results == []
+
+    runner.join(10)
+    assert results == [0]
+    assert engine.stats["commands"] == 2
+
+
+def hung_worker(tmpdir):
+    """a venv whose Zappa worker starts, then never answers"""
+    bin_dir = tmpdir.mkdir("venv").mkdir("bin")
+    bin_dir.join("activate").write('VIRTUAL_ENV="{}"\n'.format(bin_dir.dirname))
+    python = bin_dir.join("python")
+    python.write('#!/bin/sh\necho \'{"import_seconds": 0}\'\nexec sleep 60\n')
+    python.chmod(python.stat().mode | stat.S_IEXEC)
+    return bin_dir.dirname
+
+
+def test_worker_timeout_is_recorded_as_killed(tmpdir, monkeypatch):
+    monkeypatch.setattr(zappa_e2e.PROCESS_ENGINE, "timeouts", {"default": 0.5})
+    recorded = []
+    monkeypatch.setattr(zappa_e2e.OUTPUT_LOGS, "record", lambda args, returncode, *rest: recorded.append(returncode))
+
+    with ZappaWorker(hung_worker(tmpdir)) as worker:
+        with pytest.raises(subprocess.TimeoutExpired):
+            worker.cmd(["status", "test"], cwd=str(tmpdir))
+
+    assert recorded == [-signal.SIGKILL]
@@ -0,0 +1,137 @@
+import os
+import stat
+
+import pytest
+
+import zappa_e2e
+from zappa_e2e import RateLimiter, zappa_cmd
+
+THROTTLED = "An error occurred (TooManyRequestsException) when calling the UpdateFunctionCode operation: Rate exceeded"
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # the longest possible backoff, so it can be asserted on
+    monkeypatch.setattr(zappa_e2e.random, "uniform", lambda low, high: high)
+    return FakeClock()
+
+
+def limiter(clock, **kwargs):
+    return RateLimiter(rate=2.0, burst=4, base_delay=1.0, max_delay=60.0, sleep=clock.sleep, clock=clock, **kwargs)
+
+
+def fake_zappa(tmpdir, throttled_calls):
+    """a venv whose zappa is throttled on its first throttled_calls calls; returns (venv dir, call counter file)"""
+    bin_dir = tmpdir.mkdir("venv").mkdir("bin")
+    bin_dir.join("activate").write('VIRTUAL_ENV="{}"\n'.format(bin_dir.dirname))
+    counter = tmpdir.join("calls")
+    counter.write("0")
+    zappa = bin_dir.join("zappa")
+    zappa.write(
+        "#!/bin/sh\n"
+        'n=$(($(cat "{counter}") + 1)); echo $n > "{counter}"\n'
+        'if [ $n -le {throttled} ]; then echo "{message}" >&2; exit 1; fi\n'
+        "echo ok\n".format(counter=counter, throttled=throttled_calls, message=THROTTLED)
+    )
+    os.chmod(str(zappa), os.stat(str(zappa)).st_mode | stat.S_IEXEC)
+    return bin_dir.dirname, counter
+
+
+def test_idempotent_command_is_retried_with_backoff(tmpdir, clock):
+    venv_dir, counter = fake_zappa(tmpdir, throttled_calls=2)
+    rate_limiter = limiter(clock)
+
+    ret, out, err = zappa_cmd(venv_dir, ["status", "test"], rate_limiter=rate_limiter)
+
+    assert (ret, out) == (0, b"ok\n")
+    assert counter.read().strip() == "3"
+    assert rate_limiter.stats["throttles"] == 2
+    assert rate_limiter.stats["retries"] == 2
+    # base_delay * 2 ** attempt for attempts 0 and 1; waiting for a token is counted separately
+    assert rate_limiter.stats["backoff_seconds"] == 1.0 + 2.0
+    assert sum(clock.sleeps) == pytest.approx(
+        rate_limiter.stats["backoff_seconds"] + rate_limiter.stats["wait_seconds"]
+    )
+    # halved twice (2 -> 1 -> 0.5), then a tenth of the max rate back for the success
+    assert rate_limiter.rate == pytest.approx(0.7)
+
+
+def test_non_idempotent_command_is_not_retried(tmpdir, clock):
+    venv_dir, counter = fake_zappa(tmpdir, throttled_calls=1)
+    rate_limiter = limiter(clock)
+
+    ret, out, err = zappa_cmd(venv_dir, ["deploy", "test"], rate_limiter=rate_limiter)
+
+    assert ret == 1
+    assert b"TooManyRequestsException" in err
+    assert counter.read().strip() == "1"
+    assert rate_limiter.stats["throttles"] == 1
+    assert rate_limiter.stats["retries"] == 0
+    assert rate_limiter.stats["backoff_seconds"] == 0
+    assert rate_limiter.rate == 1.0
+
+
+@pytest.mark.parametrize("command", ["status", "undeploy", "update", "deploy", "package"])
+def test_only_status_and_undeploy_are_retried(clock, command):
+    results = [(1, b"", THROTTLED.encode()), (0, b"ok", b"")]
+    rate_limiter = limiter(clock)
+
+    ret, _, _ = rate_limiter.call([command, "test"], lambda: results.pop(0))
+
+    retried = command in ("status", "undeploy")
+    assert ret == (0 if retried else 1)
+    assert rate_limiter.stats["retries"] == (1 if retried else 0)
+
+
+def test_gives_up_after_max_retries(clock):
+    calls = []
+    rate_limiter = limiter(clock, max_retries=2)
+
+    def throttled():
+        calls.append(1)
+        return 1, b"", b"Throttling: Rate exceeded"
+
+    ret, _, _ = rate_limiter.call(["undeploy", "test"], throttled)
+
+    assert ret == 1
+    assert len(calls) == 3
+    assert rate_limiter.stats["retries"] == 2
+    assert rate_limiter.stats["backoff_seconds"] == 1.0 + 2.0
+
+
+def test_rate_is_halved_then_recovers(clock):
+    rate_limiter = limiter(clock)
+    rate_limiter.call(["deploy", "test"], lambda: (1, b"", THROTTLED.encode()))
+    assert rate_limiter.rate == 1.0
+
+    for expected in (1.2, 1.4, 1.6, 1.8, 2.0, 2.0):
+        rate_limiter.call(["status", "test"], lambda: (0, b"", b""))
+        assert rate_limiter.rate == pytest.approx(expected)
+
+
+def test_rate_never_drops_below_a_sixteenth(clock):
+    rate_limiter = limiter(clock)
+    for _ in range(10):
+        rate_limiter.call(["deploy", "test"], lambda: (1, b"", THROTTLED.encode()))
+    assert rate_limiter.rate == 2.0 / 16
+
+
+def test_failures_other_than_throttling_are_not_retried(clock):
+    rate_limiter = limiter(clock)
+    ret, _, _ = rate_limiter.call(["status", "test"], lambda: (1, b"", b"No Lambda test-app-test detected"))
+    assert ret == 1
+    assert rate_limiter.stats["throttles"] == 0
+    assert rate_limiter.rate == 2.0
@@ -0,0 +1,55 @@
+import pytest
+
+from zappa_e2e import ReadinessProber, SimulatedPropagation, local_wsgi_server
+
+
+@pytest.fixture
+def propagating(hello_app, serve):
+    app = SimulatedPropagation(hello_app, ready_after=1.0)
+    return app, serve(app)
+
+
+def test_ready_once_the_deploy_has_propagated(propagating):
+    app, url = propagating
+    app.reset()
+
+    result = ReadinessProber(deadline=10, concurrency=2, base_delay=0.1, max_delay=0.5).probe(url)
+
+    assert result["ready"]
+    assert result["url"] == url
+    assert 1.0 <= result["seconds"] < 2.0
+    assert result["elapsed"] >= result["seconds"]
+    # it was polled, and failed, before it got there
+    assert result["attempts"] > 1
+    assert result["last_error"] == "HTTP 503 Service Unavailable"
+
+
+def test_not_ready_when_the_deadline_passes_first(propagating):
+    app, url = propagating
+    app.reset()
+
+    result = ReadinessProber(deadline=0.5, concurrency=2, base_delay=0.1, max_delay=0.5).probe(url)
+
+    assert not result["ready"]
+    assert result["seconds"] is None
+    assert result["last_error"] == "HTTP 503 Service Unavailable"
+    assert 0.5 <= result["elapsed"] < 1.0
+
+
+def test_ready_at_once_without_a_propagation_delay(hello_app, serve):
+    result = ReadinessProber(deadline=5, concurrency=1).probe(serve(hello_app))
+
+    assert result["ready"]
+    assert result["attempts"] == 1
+    assert result["last_error"] is None
+    assert result["seconds"] < 1.0
+
+
+def test_connection_errors_are_reported(hello_app):
+    with local_wsgi_server(hello_app) as url:
+        pass  # the port is free again once the server is gone
+
+    result = ReadinessProber(deadline=0.5, concurrency=1, base_delay=0.1).probe(url)
+
+    assert not result["ready"]
+    assert result["last_error"].startswith("ConnectionRefusedError")
@@ -0,0 +1,122 @@
+import pytest
+
+from zappa_e2e import merge_shard_reports, parse_shard, partition, shard_plan
+
+KEYS = ["apps/{}/zappa_settings.json.j2::{}-py3.6".format(app, app) for app in "abcdefg"]
+
+
+def test_partition_covers_every_item_exactly_once():
+    durations = dict((key, i * 10.0) for i, key in enumerate(KEYS))
+    shards, loads = partition(KEYS, durations, 3)
+
+    assert sorted(key for shard in shards for key in shard) == sorted(KEYS)
+    assert sum(loads) == sum(durations.values())
+
+
+def test_partition_is_longest_first_and_balanced():
+    durations = {"a": 8.0, "b": 7.0, "c": 6.0, "d": 5.0, "e": 4.0}
+    shards, loads = partition(list(durations), durations, 2)
+
+    assert shards == [["a", "d", "e"], ["b", "c"]]
+    assert loads == [17.0, 13.0]
+
+
+def test_partition_does_not_depend_on_item_order():
+    durations = {KEYS[0]: 30.0, KEYS[3]: 5.0}
+    assert partition(KEYS, durations, 3) == partition(list(reversed(KEYS)), durations, 3)
+
+
+def test_items_without_history_take_the_median():
+    shards, loads = partition(["a", "b", "new"], {"a": 10.0, "b": 20.0}, 1)
+    assert loads == [45.0]
+
+
+def test_partition_without_history_splits_evenly_by_name():
+    shards, loads = partition(KEYS, {}, 3)
+    assert shards == [KEYS[0::3], KEYS[1::3], KEYS[2::3]]
+    assert loads == [3.0, 2.0, 2.0]
+
+
+def test_more_shards_than_items():
+    shards, loads = partition(["a"], {}, 3)
+    assert shards == [["a"], [], []]
+
+
+def test_shard_plan_covers_items_and_their_durations():
+    durations = {KEYS[0]: 30.0}
+    plan = shard_plan(KEYS, durations)
+
+    assert shard_plan(list(reversed(KEYS)), durations) == plan
+    # durations of items not being partitioned don't matter
+    assert shard_plan(KEYS, dict(durations, other=1.0)) == plan
+    assert shard_plan(KEYS, {KEYS[0]: 31.0}) != plan
+    assert shard_plan(KEYS[:-1], durations) != plan
+
+
+@pytest.mark.parametrize("value,expected", [("2/4", (2, 4)), (" 1 / 1 ", (1, 1))])
+def test_parse_shard(value, expected):
+    assert parse_shard(value) == expected
+
+
+@pytest.mark.parametrize("value", ["0/4", "5/4", "2", "a/b", "", None])
+def test_parse_shard_rejects(value):
+    with pytest.raises(ValueError):
+        parse_shard(value)
+
+
+def report(shard, count, items, plan="p1"):
+    return {
+        "shard": shard,
+        "count": count,
+        "host": "host{}".format(shard),
+        "wall_seconds": 100.0 * shard,
+        "estimated_seconds": 90.0,
+        "plan": plan,
+        "items": [
+            {"nodeid": nodeid, "outcome": outcome, "duration": duration, "timings": {}, "preserved": preserved}
+            for nodeid, outcome, duration, preserved in items
+        ],
+    }
+
+
+def test_merge_shard_reports():
+    merged = merge_shard_reports(
+        [
+            report(2, 2, [("b", "failed", 20.0, "/tmp/b"), ("c", "skipped", None, None)]),
+            report(1, 2, [("a", "passed", 10.0, None)]),
+        ]
+    )
+
+    assert [shard["shard"] for shard in merged["shards"]] == [1, 2]
+    assert [item["nodeid"] for item in merged["items"]] == ["a", "b", "c"]
+    assert merged["outcomes"] == {"passed": 1, "failed": 1, "skipped": 1}
+    assert merged["durations"] == {"a": 10.0, "b": 20.0}
+    assert merged["preserved"] == ["/tmp/b"]
+    assert merged["missing_shards"] == []
+    assert merged["wall_seconds"] == 200.0
+
+
+def test_merge_lists_missing_shards():
+    merged = merge_shard_reports([report(2, 3, [("b", "passed", 1.0, None)])])
+    assert merged["missing_shards"] == [1, 3]
+
+
+def test_merge_rejects_different_shard_counts():
+    with pytest.raises(ValueError):
+        merge_shard_reports([report(1, 2, []), report(2, 3, [])])
+
+
+def test_merge_rejects_different_plans():
+    with pytest.raises(ValueError) as e:
+        merge_shard_reports([report(1, 2, [], plan="p1"), report(2, 2, [], plan="p2")])
+    assert "--shard-durations" in str(e.value)
+
+
+def test_merged_durations_reproduce_the_partition():
+    # what every machine of the next run gets through --shard-durations
+    merged = merge_shard_reports(
+        [report(1, 2, [("a", "passed", 50.0, None), ("b", "passed", 5.0, None)]), report(2, 2, [("c", "passed", 40.0, None)])]
+    )
+    first = partition(["a", "b", "c"], merged["durations"], 2)
+    assert first == partition(["c", "b", "a"], dict(merged["durations"]), 2)
+    assert first[0] == [["a"], ["c", "b"]]
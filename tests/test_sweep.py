@@ -0,0 +1,90 @@
+import json
+import os
+import shutil
+import socket
+import sys
+
+import pytest
+
+import zappa_e2e
+from zappa_e2e import LocalAWS, Sweeper, main, sweep_venv, venv_cmd, zappa_cmd
+
+PY_VERSION = "{}.{}".format(*sys.version_info[:2])
+
+# a function named like an e2e deployment of an app that no longer exists, created next to a real deployment
+_CREATE_RETIRED = """
+import io, sys, zipfile, boto3
+client = boto3.client("lambda")
+role = client.get_function(FunctionName=sys.argv[1])["Configuration"]["Role"]
+code = io.BytesIO()
+with zipfile.ZipFile(code, "w") as z:
+    z.writestr("handler.py", "def handler(event, context):\\n    return None\\n")
+client.create_function(
+    FunctionName=sys.argv[2], Runtime=sys.argv[3], Role=role, Handler="handler.handler", Code={"ZipFile": code.getvalue()}
+)
+"""
+
+
+@pytest.fixture
+def local_aws():
+    pytest.importorskip("moto")
+    with LocalAWS() as aws:
+        yield aws
+
+
+@pytest.fixture
+def apps_dir(tmpdir, monkeypatch):
+    """just hello-world, on the running Python version"""
+    app_dir = tmpdir.mkdir("apps").join("hello-world")
+    shutil.copytree(os.path.join(zappa_e2e.APPS_DIR, "hello-world"), str(app_dir))
+    app_dir.join(zappa_e2e.RUNTIMES_FILE).write(json.dumps([PY_VERSION]))
+    monkeypatch.setattr(zappa_e2e, "APPS_DIR", str(app_dir.dirname))
+    return str(app_dir.dirname)
+
+
+def test_sweep_undeploys_and_lists_orphans_on_a_running_emulator(local_aws, apps_dir, capsys, monkeypatch):
+    venv_dir = sweep_venv()
+    target, = Sweeper(venv_dir, apps_dir).targets()
+    shutil.copy(os.path.join(apps_dir, "hello-world", "app.py"), target["work_dir"])
+    zappa_cmd(venv_dir, ["deploy", "test"], cwd=target["work_dir"], check=True)
+    retired = "retired-{}-test".format(PY_VERSION.replace(".", ""))
+    venv_cmd(
+        venv_dir,
+        "python",
+        ["-c", _CREATE_RETIRED, target["function_name"], retired, "python" + PY_VERSION],
+        check=True,
+    )
+    # as if from another process, e.g. after the session that deployed has ended
+    monkeypatch.setattr(LocalAWS, "active", None)
+
+    assert main(["sweep", "--backend", "local", "--endpoint", local_aws.endpoint, "--venv", venv_dir]) == 0
+
+    out = capsys.readouterr()[0]
+    assert "deployed: {label} ({function_name})".format(**target) in out
+    assert "undeployed: {label}".format(**target) in out
+    assert "orphan: {} (no app directory)".format(retired) in out
+    assert "1 settings checked, 1 deployed, 1 undeployed, 1 orphaned functions" in out
+    assert LocalAWS.active is None
+    LocalAWS.active = local_aws
+    assert zappa_cmd(venv_dir, ["status", "test"], cwd=target["work_dir"])[0] != 0
+
+
+def test_local_sweep_needs_an_endpoint(capsys, monkeypatch):
+    monkeypatch.setitem(zappa_e2e.ENV_CONFIG, "local_aws_endpoint", None)
+
+    assert main(["sweep", "--backend", "local", "--venv", "/nonexistent"]) == 2
+
+    assert "--endpoint" in capsys.readouterr()[1]
+    assert LocalAWS.active is None
+
+
+def test_local_sweep_fails_without_an_emulator_at_the_endpoint():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        endpoint = "http://127.0.0.1:{}".format(s.getsockname()[1])
+
+    with pytest.raises(EnvironmentError) as e:
+        main(["sweep", "--backend", "local", "--endpoint", endpoint, "--venv", "/nonexistent"])
+
+    assert endpoint in str(e.value)
+    assert LocalAWS.active is None
@@ -1,17 +1,57 @@
+import asyncio
+import select
+import signal
 import subprocess
 import tempfile
+import http.client
+import importlib.util
+import socket
+import socketserver
+import sqlite3
+import argparse
+import statistics
+import uuid
+import fcntl
+import glob
+import hashlib
+import itertools
+import shutil
 import logging
+import logging.handlers
 import os
 import json
+import random
+import re
 import sys
+import tarfile
+import threading
+import time
 import weakref
-from distutils.spawn import find_executable
-from distutils.errors import DistutilsExecError
+import zipfile
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from copy import copy
+from urllib.parse import urlparse
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+from jinja2 import Template
 
 
 logger = logging.getLogger()
 
+APPS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "apps")
+# every Python version an app can be tested on
+PY_VERSIONS = ("2.7", "3.6")
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "zappa_e2e_worker.py")
+GATEWAY_SCRIPT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "zappa_e2e_gateway.py")
+# holds the sitecustomize.py that points botocore at the local AWS emulator
+LOCAL_AWS_SHIM_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "zappa_e2e_local")
+
+
+def _dotted_version(digits):
+    """e.g. 27 -> 2.7, 310 -> 3.10"""
+    return "{}.{}".format(digits[0], digits[1:])
+
 
 def env_bool(var):
     return os.environ.get("ZAPPA_E2E_" + var, False) in [
@@ -33,20 +73,228 @@ ENV_CONFIG = {
     "no_undeploy": env_bool("NO_UNDEPLOY"),
     # preserve temporary app dirs
     "preserve_temp": env_bool("PRESERVE_TEMP"),
-    # python versions
-    "skip_python_27": env_bool("SKIP_PYTHON_27"),
-    "skip_python_36": env_bool("SKIP_PYTHON_36"),
-    "python_27_path": env_bool("PYTHON_27_PATH"),
-    "python_36_path": env_bool("PYTHON_36_PATH"),
+    # python versions: apps without a zappa_runtimes.json are tested on py_versions. Any version can be skipped
+    # with ZAPPA_E2E_SKIP_PYTHON_<XY> or pinned to an executable with ZAPPA_E2E_PYTHON_<XY>_PATH (e.g. 27, 36, 310)
+    "py_versions": tuple(
+        v.strip() for v in os.environ.get("ZAPPA_E2E_PY_VERSIONS", ",".join(PY_VERSIONS)).split(",") if v.strip()
+    ),
+    "skip_python": set(
+        _dotted_version(match.group(1))
+        for match in (re.match(r"^ZAPPA_E2E_SKIP_PYTHON_(\d+)$", name) for name in os.environ)
+        if match and env_bool(match.group(0)[len("ZAPPA_E2E_") :])
+    ),
+    "python_paths": dict(
+        (_dotted_version(match.group(1)), os.environ[match.group(0)])
+        for match in (re.match(r"^ZAPPA_E2E_PYTHON_(\d+)_PATH$", name) for name in os.environ)
+        if match and os.environ[match.group(0)]
+    ),
 
     # override Zappa?
     "zappa_override": os.environ.get("ZAPPA_E2E_ZAPPA_OVERRIDE"),
 
-    # sleep between deployments (helps with AWS API limits; might not be necessary since they raised these)
+    # deprecated: replaced by the adaptive rate limiter below
     "sleep_between": int(os.environ.get("ZAPPA_E2E_SLEEP_BETWEEN", 0)),
+
+    # sustained rate (and burst) of zappa commands across all runs; backs off further on its own when AWS throttles
+    "zappa_calls_per_second": float(os.environ.get("ZAPPA_E2E_ZAPPA_CALLS_PER_SECOND", 2)),
+    "zappa_calls_burst": int(os.environ.get("ZAPPA_E2E_ZAPPA_CALLS_BURST", 4)),
+
+    # how many (app, python version) pairs to run at the same time
+    "workers": int(os.environ.get("ZAPPA_E2E_WORKERS", 1)),
+    # per-stage pool sizes, e.g. "prepare=2,deploy=4"; stages not listed get "workers"
+    "stage_workers": dict(
+        (stage.strip(), int(count))
+        for stage, count in (
+            pair.split("=", 1)
+            for pair in os.environ.get("ZAPPA_E2E_STAGE_WORKERS", "").split(",")
+            if pair.strip()
+        )
+    ),
+
+    # disk cap for the shared virtualenv store; least recently used venvs are evicted past this
+    "venv_cache_max_mb": int(os.environ.get("ZAPPA_E2E_VENV_CACHE_MAX_MB", 2048)),
+
+    # build every venv from scratch instead of cloning a per-interpreter Zappa base venv
+    "no_base_venv": env_bool("NO_BASE_VENV"),
+
+    # install straight from pypi instead of the local wheelhouse
+    "no_wheelhouse": env_bool("NO_WHEELHOUSE"),
+
+    # run zappa commands through one long-lived worker process per app instead of a fresh CLI each time
+    "zappa_worker": env_bool("ZAPPA_WORKER"),
+
+    # let zappa deploy/update build their own package instead of reusing one from the local package cache
+    "no_package_cache": env_bool("NO_PACKAGE_CACHE"),
+
+    # skip the per-app size breakdown of the deployment package (and its zappa_budget.json check)
+    "no_package_analysis": env_bool("NO_PACKAGE_ANALYSIS"),
+
+    # subprocess output is streamed to <log_dir>/<app>-py<version>/<stage>.log, rotated at log_max_mb;
+    # only the last output_tail_kb of each stream is kept in memory, for error messages
+    "log_dir": os.environ.get("ZAPPA_E2E_LOG_DIR", os.path.join(tempfile.gettempdir(), "zappa-e2e", "logs")),
+    "log_max_mb": int(os.environ.get("ZAPPA_E2E_LOG_MAX_MB", 10)),
+    "log_backups": int(os.environ.get("ZAPPA_E2E_LOG_BACKUPS", 3)),
+    "output_tail_kb": int(os.environ.get("ZAPPA_E2E_OUTPUT_TAIL_KB", 64)),
+
+    # external commands running at once, across all apps
+    "max_processes": int(os.environ.get("ZAPPA_E2E_MAX_PROCESSES", 16)),
+    # seconds before a command's process group is killed, by command name or "<command> <first argument>",
+    # e.g. "pip=900,zappa=1800,zappa status=120"; anything else gets the default
+    "command_timeouts": dict(
+        [("default", float(os.environ.get("ZAPPA_E2E_COMMAND_TIMEOUT", 1800)))]
+        + [
+            (command.strip(), float(seconds))
+            for command, seconds in (
+                pair.split("=", 1)
+                for pair in os.environ.get("ZAPPA_E2E_COMMAND_TIMEOUTS", "").split(",")
+                if pair.strip()
+            )
+        ]
+    ),
+
+    # write timed spans of every phase here: Chrome trace-event format for *.json, one span per line otherwise
+    "trace": os.environ.get("ZAPPA_E2E_TRACE"),
+
+    # after a deploy/update, poll API_GATEWAY_URL until it answers, for at most this many seconds (0 is off)
+    "readiness_timeout": float(os.environ.get("ZAPPA_E2E_READINESS_TIMEOUT", 120)),
+    "readiness_concurrency": int(os.environ.get("ZAPPA_E2E_READINESS_CONCURRENCY", 4)),
+
+    # after the tests pass, load-test API_GATEWAY_URL with this many requests (0 is off)
+    "benchmark_requests": int(os.environ.get("ZAPPA_E2E_BENCHMARK_REQUESTS", 0)),
+    "benchmark_concurrency": int(os.environ.get("ZAPPA_E2E_BENCHMARK_CONCURRENCY", 4)),
+    "benchmark_dir": os.environ.get(
+        "ZAPPA_E2E_BENCHMARK_DIR", os.path.join(tempfile.gettempdir(), "zappa-e2e", "benchmarks")
+    ),
+
+    # after the tests pass, force a fresh Lambda container and time its first request against this many warm ones
+    "cold_start_probe": env_bool("COLD_START_PROBE"),
+    "cold_start_warm_requests": int(os.environ.get("ZAPPA_E2E_COLD_START_WARM_REQUESTS", 10)),
+
+    "s3_bucket": os.environ.get(
+        "ZAPPA_S3_BUCKET",
+        "zappa-e2e-" + str(hashlib.md5(socket.gethostname().encode()).hexdigest()),
+    ),
+
+    # "aws", or "local" for a moto server standing in for AWS and a local HTTP gateway standing in for API Gateway
+    "backend": os.environ.get("ZAPPA_E2E_BACKEND", "aws"),
+    "local_aws_region": os.environ.get("ZAPPA_E2E_LOCAL_AWS_REGION", "us-east-1"),
+    # a moto server that is already running, e.g. one shared by several sessions and the sweep; None starts one
+    "local_aws_endpoint": os.environ.get("ZAPPA_E2E_AWS_ENDPOINT") or None,
+
+    # history of deploy/package/latency metrics, and the gate that fails a run when they regress
+    "perf_db": os.environ.get(
+        "ZAPPA_E2E_PERF_DB",
+        os.path.join(tempfile.gettempdir(), "zappa-e2e", "perf.sqlite"),
+    ),
+    # on by default when testing a Zappa override; set to 0 or 1 to force it off or on
+    "perf_gate": (
+        env_bool("PERF_GATE")
+        if os.environ.get("ZAPPA_E2E_PERF_GATE") is not None
+        else bool(os.environ.get("ZAPPA_E2E_ZAPPA_OVERRIDE"))
+    ),
+    # a metric regresses when it is this much worse than the median of the last perf_baseline_runs runs
+    "perf_threshold": float(os.environ.get("ZAPPA_E2E_PERF_THRESHOLD", 0.2)),
+    "perf_baseline_runs": int(os.environ.get("ZAPPA_E2E_PERF_BASELINE_RUNS", 5)),
 }
 
 
+class Tracer:
+    def __init__(self):
+        """Tracer
+
+        collects timed spans (name, start, duration plus attributes such as app, py_version and exit_code). context()
+        sets attributes for every span opened by the current thread inside it, which is how calls deep inside a stage
+        get tagged with their app."""
+        self.spans = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def context(self, **attrs):
+        previous = getattr(self._local, "attrs", {})
+        self._local.attrs = dict(previous, **attrs)
+        try:
+            yield
+        finally:
+            self._local.attrs = previous
+
+    def current(self):
+        """the current thread's context() attributes"""
+        return dict(getattr(self._local, "attrs", {}))
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """yields the span dict, so callers can add e.g. exit_code before it closes"""
+        span = dict(getattr(self._local, "attrs", {}), **attrs)
+        span["name"] = name
+        started = time.time()
+        try:
+            yield span
+        except BaseException as e:
+            span.setdefault("error", e.__class__.__name__)
+            raise
+        finally:
+            span["start"] = started
+            span["duration"] = time.time() - started
+            with self._lock:
+                self.spans.append(span)
+
+    def spans_for(self, **attrs):
+        with self._lock:
+            return [
+                span
+                for span in self.spans
+                if all(span.get(k) == v for k, v in attrs.items())
+            ]
+
+    def write(self, path):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span["start"])
+        with open(path, "w") as f:
+            if path.endswith(".json"):
+                json.dump({"traceEvents": self._trace_events(spans)}, f)
+            else:
+                for span in spans:
+                    f.write(json.dumps(span, sort_keys=True) + "\n")
+        logger.info("Tracer: wrote {} spans to {}".format(len(spans), path))
+
+    def _trace_events(self, spans):
+        # one timeline row per (app, python version) so a run reads left to right
+        lanes = {None: 0}
+        events = [_thread_name_event(0, "harness")]
+        for span in spans:
+            lane = None
+            if span.get("app"):
+                lane = "{}-py{}".format(span["app"], span.get("py_version"))
+            if lane not in lanes:
+                lanes[lane] = len(lanes)
+                events.append(_thread_name_event(lanes[lane], lane))
+            events.append(
+                {
+                    "name": span["name"],
+                    "cat": "zappa-e2e",
+                    "ph": "X",
+                    "ts": int(span["start"] * 1e6),
+                    "dur": int(span["duration"] * 1e6),
+                    "pid": os.getpid(),
+                    "tid": lanes[lane],
+                    "args": dict(
+                        (k, v)
+                        for k, v in span.items()
+                        if k not in ("name", "start", "duration")
+                    ),
+                }
+            )
+        return events
+
+
+def _thread_name_event(tid, name):
+    return {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+
+
+TRACER = Tracer()
+
+
 class PreservableTemporaryDirectory(tempfile.TemporaryDirectory):
     def __init__(self, app_name, version):
         """Preservable Temporary Directory
@@ -81,18 +329,19 @@ class PreservableTemporaryDirectory(tempfile.TemporaryDirectory):
             warn_message="Implicitly cleaning up {!r}".format(self),
         )
 
-        self._preserve = True
+        self._preserved = False
 
         if ENV_CONFIG["preserve_temp"]:
             logger.info("Automatically preserving temp dir due to environment config")
             self.preserve()
 
     def preserve(self):
+        self._preserved = True
         self._finalizer.detach()
 
     @property
     def preserved(self):
-        return self._preserve
+        return self._preserved
 
     def __enter__(self):
         return self.name, self
@@ -100,22 +349,51 @@ class PreservableTemporaryDirectory(tempfile.TemporaryDirectory):
     def __exit__(self, exc, value, tb):
         logger.debug(
             "Exiting PreservableTemporaryDirectory {} with preserve={}".format(
-                self.name, "True" if self._preserve else "False"
+                self.name, "True" if self._preserved else "False"
             )
         )
-        if not self._preserve:
-            self.cleanup()
+        if not self._preserved:
+            with TRACER.span("temp cleanup"):
+                self.cleanup()
 
 
 class DeployedZappaApp:
-    def __init__(self, app_dir, venv_dir, ptd, stage="test"):
+    FINGERPRINT_FILE = "deployment-fingerprint.json"
+
+    def __init__(
+        self,
+        app_dir,
+        venv_dir,
+        ptd,
+        stage="test",
+        zappa_worker=None,
+        fingerprint=None,
+        package_store=None,
+        gateway=None,
+    ):
         self.skip_cleanup = False
         self.app_dir = app_dir
         self.venv_dir = venv_dir
         self.ptd = ptd
+        self.zappa_worker = zappa_worker
         self.failed = False
         self.stage = stage
         self.post_deploy_status = {}
+        # (returncode, parsed status or raw output); dropped whenever a deploy, update or undeploy changes the stage
+        self._status_cache = None
+        self.status_calls = 0
+        # see deployment_fingerprint(); lets update-over-deploy skip an update that would change nothing
+        self.fingerprint = fingerprint
+        self.skipped_update = False
+        self.package_store = package_store
+        # {"path", "size", "build_seconds", "built"} of the archive handed to deploy/update
+        self.package = None
+        # LocalGateway serving the app when deployed to a local AWS emulator; its URL replaces "API Gateway URL"
+        self.gateway = gateway
+        # a deploy/update timed out or was cancelled partway; cleanup undeploys whatever it left, then fails
+        self.interrupted = False
+        # ReadinessProber.probe() result after the deploy/update, plus "command"
+        self.readiness = None
 
     @property
     def status(self):
@@ -158,11 +436,40 @@ class DeployedZappaApp:
     def __repr__(self):
         return "<{} {!r}>".format(self.__class__.__name__, self.name)
 
+    def _zappa(self, params, as_json=False):
+        return zappa_cmd(
+            self.venv_dir,
+            params,
+            as_json=as_json,
+            cwd=self.app_dir,
+            zappa_worker=self.zappa_worker,
+        )
+
+    def get_status(self, refresh=False):
+        """remote `zappa status`, cached until the stage changes; returns (returncode, status dict or raw output)"""
+        if self._status_cache is None or refresh:
+            self.status_calls += 1
+            ret, out, _ = self._zappa(
+                ["status", self.stage, "--json"]
+            )  # not using as_json because zappa status doesn't return json when it fails
+            if ret == 0:
+                try:
+                    out = json.loads(out)
+                except json.decoder.JSONDecodeError:
+                    pass
+            if ret == 0 and isinstance(out, dict) and self.gateway is not None:
+                out["API Gateway URL"] = self.gateway.start()
+            self._status_cache = (ret, out)
+        return self._status_cache
+
+    def invalidate_status(self):
+        self._status_cache = None
+        if self.gateway is not None:
+            # the stage is about to change; the next status starts a gateway with the new code
+            self.gateway.stop()
+
     def __enter__(self):
-        chdir(self.app_dir)
-        ret, out, _ = venv_cmd(
-            self.venv_dir, "zappa", ["status", "--json"]
-        )  # not using as_json because zappa status doesn't return json when it fails
+        ret, out = self.get_status()
         pre_deploy_status_exists = ret == 1
 
         if not pre_deploy_status_exists and not (
@@ -176,24 +483,37 @@ class DeployedZappaApp:
             self.skip_cleanup = True
             sys.exit(1)
 
-        elif not pre_deploy_status_exists:
-            try:
-                self.post_deploy_status = json.loads(out)
-            except json.decoder.JSONDecodeError:
-                pass
+        elif not pre_deploy_status_exists and isinstance(out, dict):
+            self.post_deploy_status = out
 
         if ENV_CONFIG["undeploy_only"]:
             # exit early
             logger.info("{}: doing undeploy only".format(self.__class__.__name__))
             return self.name
 
+        if (
+            not pre_deploy_status_exists
+            and ENV_CONFIG["update_over_deploy"]
+            and self._fingerprint_matches(self.post_deploy_status)
+        ):
+            logger.info(
+                "{}: {} is unchanged since it was last deployed; skipping update".format(
+                    self.__class__.__name__, self.name
+                )
+            )
+            self.skipped_update = True
+            return self.post_deploy_status
+
+        command = "deploy"
         if not pre_deploy_status_exists and ENV_CONFIG["update_over_deploy"]:
+            command = "update"
             logger.info(
                 "{}: updating instead of deploying for {}".format(
                     self.__class__.__name__, self.name
                 )
             )
-            ret, out, err = venv_cmd(self.venv_dir, "zappa", ["update", self.stage])
+            self.invalidate_status()
+            ret, out, err = self._interruptible(["update", self.stage] + self._zip_args())
             if ret != 0:
                 logger.error(
                     "{}: failed to update. Bailing.".format(
@@ -207,7 +527,8 @@ class DeployedZappaApp:
                 return None
 
         else:
-            ret, out, err = venv_cmd(self.venv_dir, "zappa", ["deploy", self.stage])
+            self.invalidate_status()
+            ret, out, err = self._interruptible(["deploy", self.stage] + self._zip_args())
             if ret != 0:
                 logger.error(
                     "{}: failed to deploy. Bailing.".format(
@@ -221,9 +542,7 @@ class DeployedZappaApp:
                 self.skip_cleanup = True
                 return None
 
-        ret, out, _ = venv_cmd(
-            self.venv_dir, "zappa", ["status", self.stage], as_json=True
-        )
+        ret, out = self.get_status()
         if ret != 0:
             logger.error(
                 "{}: something went wrong with the post-deploy status check.".format(
@@ -234,14 +553,177 @@ class DeployedZappaApp:
             return None
 
         self.post_deploy_status = out
+        self._save_fingerprint(out)
         logger.info(
             "{}: zappa app {} published.".format(self.__class__.__name__, self.name)
         )
+        if ENV_CONFIG["readiness_timeout"] and isinstance(out, dict) and out.get("API Gateway URL"):
+            self._probe_readiness(out["API Gateway URL"], command)
 
         return self.post_deploy_status
 
+    def _probe_readiness(self, url, command):
+        """wait for API Gateway and Lambda to propagate before anything hits the URL"""
+        with TRACER.span("readiness probe", command=command) as span:
+            self.readiness = ReadinessProber().probe(url)
+            span["ready"] = self.readiness["ready"]
+            span["attempts"] = self.readiness["attempts"]
+        self.readiness["command"] = command
+        if self.readiness["ready"]:
+            logger.info(
+                "{}: {} ready {:.1f}s after the {} ({} requests)".format(
+                    self.__class__.__name__, url, self.readiness["seconds"], command, self.readiness["attempts"]
+                )
+            )
+        else:
+            logger.error(
+                "{}: {} was still not ready {:.0f}s after the {}; last error: {}".format(
+                    self.__class__.__name__, url, self.readiness["elapsed"], command, self.readiness["last_error"]
+                )
+            )
+
+    def _interruptible(self, params):
+        """a deploy/update that may time out, be cancelled or be interrupted with Ctrl-C; if it is, cleanup runs
+        before the error propagates, because the caller never gets a context manager to exit"""
+        try:
+            return self._zappa(params)
+        except (subprocess.TimeoutExpired, CommandCancelled, KeyboardInterrupt) as e:
+            logger.error(
+                "{}: 'zappa {}' did not finish ({}); undeploying".format(
+                    self.__class__.__name__, " ".join(params[:2]), str(e) or e.__class__.__name__
+                )
+            )
+            self.interrupted = True
+            try:
+                self.__exit__(*sys.exc_info())
+            except SystemExit:
+                pass  # cleanup's verdict; the interruption is the error to report
+            raise
+
     def __exit__(self, exc, value, tb):
-        self.cleanup()
+        try:
+            self.cleanup()
+        finally:
+            if self.gateway is not None:
+                self.gateway.stop()
+
+    def _zip_args(self):
+        """prebuilt package for deploy/update, from the package store"""
+        if not self._storable:
+            return []
+        self.package = self._stored_package()
+        # zappa may remove the zip it deployed, so hand it a copy
+        local_zip = os.path.join(self.app_dir, os.path.basename(self.package["path"]))
+        shutil.copyfile(self.package["path"], local_zip)
+        return ["--zip", local_zip]
+
+    @property
+    def _storable(self):
+        if self.package_store is None or self.fingerprint is None:
+            return False
+        # a slim package is a handler zip plus a separate project archive; --zip only takes the former
+        return not load_settings(os.path.join(self.app_dir, "zappa_settings.json")).get(
+            self.stage, {}
+        ).get("slim_handler")
+
+    def _stored_package(self):
+        return self.package_store.get("{}-{}".format(self.fingerprint, self.stage), self._build_package)
+
+    def _build_package(self, path):
+        ret, out, err = self._zappa(["package", self.stage, "-o", path])
+        if ret != 0:
+            raise EnvironmentError(
+                "zappa package failed for {}:\nstdout={}\nstderr={}".format(
+                    self.app_dir, out, err
+                )
+            )
+
+    def package_archives(self, work_dir):
+        """the archives of the deployed package: the stored zip when deploy/update used one, otherwise what zappa
+        built for the last deploy/update and left in the app dir (see keep_local_package()), moved into work_dir for the caller to delete.
+        [] when neither exists, e.g. an update that was skipped with no package store"""
+        if self.package:
+            return [self.package["path"]]
+        built = self._built_archives()
+        if built:
+            return [shutil.move(path, work_dir) for path in built]
+        if self._storable:
+            return [self._stored_package()["path"]]
+        return []
+
+    def _built_archives(self):
+        """the newest package zappa built in the app dir: its zip, or a slim handler's handler zip and project
+        .tar.gz; older ones, from a deploy that an update replaced, are removed"""
+        settings = load_settings(os.path.join(self.app_dir, "zappa_settings.json")).get(self.stage, {})
+        if "project_name" not in settings:
+            return []
+        # zappa names them <prefix>-<build time>.<ext>; a slim handler's two archives are built seconds apart
+        pattern = re.compile(
+            r"^((?:handler_)?{}-{})-(\d+)\.(zip|tar\.gz)$".format(
+                re.escape(settings["project_name"]), re.escape(self.stage)
+            )
+        )
+        builds = {}
+        for name in os.listdir(self.app_dir):
+            match = pattern.match(name)
+            if match:
+                kind = (match.group(1), match.group(3))
+                builds.setdefault(kind, []).append((int(match.group(2)), os.path.join(self.app_dir, name)))
+        archives = []
+        for kind in sorted(builds):
+            paths = sorted(builds[kind])
+            for _, path in paths[:-1]:
+                os.remove(path)
+            archives.append(paths[-1][1])
+        return archives
+
+    @property
+    def _fingerprint_path(self):
+        return os.path.join(self.ptd.name, self.FINGERPRINT_FILE)
+
+    def _fingerprint_matches(self, status):
+        """the stored fingerprint matches, and the live function is still the one we deployed with it"""
+        if self.fingerprint is None:
+            return False
+        try:
+            with open(self._fingerprint_path) as f:
+                stored = json.load(f)
+        except (IOError, ValueError):
+            return False
+        return stored.get("fingerprint") == self.fingerprint and all(
+            stored.get(k) == status.get(k)
+            for k in ("Lambda Last Modified", "Lambda Code Size")
+        )
+
+    def _save_fingerprint(self, status):
+        if self.fingerprint is None:
+            return
+        with open(self._fingerprint_path, "w") as f:
+            json.dump(
+                {
+                    "fingerprint": self.fingerprint,
+                    "Lambda Last Modified": status.get("Lambda Last Modified"),
+                    "Lambda Code Size": status.get("Lambda Code Size"),
+                },
+                f,
+                indent=2,
+            )
+
+    def refresh_fingerprint(self):
+        """re-saves the stored fingerprint with the live status, after something other than a deploy or update (like
+        a forced cold start) changed the function; otherwise the next run would never match it"""
+        if self.fingerprint is None or not os.path.isfile(self._fingerprint_path):
+            return
+        ret, out = self.get_status(refresh=True)
+        if ret == 0 and isinstance(out, dict):
+            self.post_deploy_status = out
+            self._save_fingerprint(out)
+
+    def _forget_fingerprint(self):
+        try:
+            os.unlink(self._fingerprint_path)
+        except FileNotFoundError:
+            pass
 
     def _preserve_and_fail(self, msg):
         self.failed = True
@@ -275,12 +757,11 @@ class DeployedZappaApp:
                         "Not undeploying {} due to environment config".format(self.name)
                     )
                 else:
-                    os.chdir(self.app_dir)
-                    ret, out, err = venv_cmd(
-                        self.venv_dir, "zappa", ["undeploy", "-y", self.stage]
-                    )
+                    self.invalidate_status()
+                    ret, out, err = self._zappa(["undeploy", "-y", self.stage])
                     if ret == 0 or ENV_CONFIG["undeploy_only"]:
-                        ret, out, _ = venv_cmd(self.venv_dir, "zappa", ["status"])
+                        self._forget_fingerprint()
+                        ret, out = self.get_status()
                         if ret != 1:
                             self._preserve_and_fail(
                                 "Zappa status should have returned 1. Returned {}. With output: {}".format(
@@ -296,18 +777,502 @@ class DeployedZappaApp:
                             )
                         )
 
+            logger.debug(
+                "{}: {} made {} remote status calls".format(
+                    self.__class__.__name__, self.name, self.status_calls
+                )
+            )
+
+            if self.interrupted:
+                self._preserve_and_fail("zappa deploy/update was interrupted")
+
             if self.failed:
                 sys.exit(1)
 
 
-def venv_cmd(venv_dir, cmd, params=[], as_json=False, check=False, extra_env={}):
+class CommandCancelled(subprocess.SubprocessError):
+    def __init__(self, cmd):
+        self.cmd = cmd
+
+    def __str__(self):
+        return "Command '{}' was cancelled".format(" ".join(self.cmd))
+
+
+class ProcessEngine:
+    KILL_GRACE_SECONDS = 10
+
+    def __init__(self, max_processes=None, timeouts=None):
+        """Process Engine
+
+        runs external commands on one asyncio event loop in a background thread, at most max_processes at a time.
+        Every command gets its own process group and a timeout (see timeout_for()); on timeout or cancel_all() the
+        whole group is terminated, then killed. run() blocks the calling thread, so the thread-based callers
+        (scheduler stages, venv_cmd) keep working unchanged."""
+        self.max_processes = max_processes or ENV_CONFIG["max_processes"]
+        self.timeouts = ENV_CONFIG["command_timeouts"] if timeouts is None else timeouts
+        self.stats = {"commands": 0, "timeouts": 0, "cancelled": 0, "queued_seconds": 0.0}
+        self._semaphore = None
+        self._processes = set()
+        self._cancelled = set()
+        self._loop = asyncio.new_event_loop()
+        if sys.version_info < (3, 8):
+            # before 3.8, subprocesses on a loop outside the main thread need the child watcher attached from it
+            asyncio.get_child_watcher().attach_loop(self._loop)
+        self._thread = threading.Thread(target=self._loop.run_forever, name="process-engine")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def timeout_for(self, args, params=()):
+        name = os.path.basename(args[0])
+        if params:
+            key = "{} {}".format(name, params[0])
+            if key in self.timeouts:
+                return self.timeouts[key]
+        return self.timeouts.get(name, self.timeouts.get("default"))
+
+    def run(self, args, env=None, cwd=None, timeout=None, on_stdout=None, on_stderr=None):
+        """runs args, calling on_stdout/on_stderr with each line of output as it arrives; returns the returncode
+
+        raises subprocess.TimeoutExpired once timeout (default: timeout_for(args)) has passed, and CommandCancelled
+        if cancel_all() stopped it; the process group is gone either way. Anything else raised while waiting (e.g. a
+        KeyboardInterrupt) also kills the command's process group before it propagates"""
+        if timeout is None:
+            timeout = self.timeout_for(args, args[1:])
+        handle = {}
+        future = asyncio.run_coroutine_threadsafe(
+            self._run(args, env, cwd, timeout, on_stdout, on_stderr, handle), self._loop
+        )
+        try:
+            return future.result()
+        except BaseException:
+            if not future.done():
+                # the command runs in its own session, so a Ctrl-C here never reached it
+                asyncio.run_coroutine_threadsafe(self._abandon(handle), self._loop).result()
+            raise
+
+    @contextmanager
+    def slot(self):
+        """holds one of the max_processes slots for work that runs outside the engine (a Zappa worker's command), so
+        it counts against the same limit; waits for a free slot like run() does"""
+        future = asyncio.run_coroutine_threadsafe(self._acquire(), self._loop)
+        try:
+            future.result()
+        except BaseException:
+            # interrupted while waiting: give the slot back if it is acquired after all
+            future.cancel()
+            future.add_done_callback(
+                lambda f: f.cancelled() or f.exception() or self._loop.call_soon_threadsafe(self._semaphore.release)
+            )
+            raise
+        try:
+            yield
+        finally:
+            self._loop.call_soon_threadsafe(self._semaphore.release)
+
+    def cancel_all(self):
+        """kills every running command; commands started afterwards run normally (e.g. teardown's undeploy)"""
+        if self._processes:
+            asyncio.run_coroutine_threadsafe(self._cancel_all(), self._loop).result()
+
+    def report(self):
+        return "processes: {commands} commands, {timeouts} timed out, {cancelled} cancelled, {queued_seconds:.1f}s waiting for a slot".format(
+            **self.stats
+        )
+
+    async def _acquire(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_processes)
+        queued = time.time()
+        await self._semaphore.acquire()
+        self.stats["queued_seconds"] += time.time() - queued
+        self.stats["commands"] += 1
+
+    async def _run(self, args, env, cwd, timeout, on_stdout, on_stderr, handle):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_processes)
+        queued = time.time()
+        async with self._semaphore:
+            self.stats["queued_seconds"] += time.time() - queued
+            if handle.get("abandoned"):
+                raise CommandCancelled(args)
+            self.stats["commands"] += 1
+            process = await asyncio.create_subprocess_exec(
+                *args,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env=env,
+                cwd=cwd,
+                start_new_session=True
+            )
+            self._processes.add(process)
+            handle["process"] = process
+            if handle.get("abandoned"):
+                self._cancelled.add(process)
+                await self._kill(process)
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(
+                        self._pump(process.stdout, on_stdout),
+                        self._pump(process.stderr, on_stderr),
+                        process.wait(),
+                    ),
+                    timeout,
+                )
+            except asyncio.TimeoutError:
+                self.stats["timeouts"] += 1
+                await self._kill(process)
+                raise subprocess.TimeoutExpired(args, timeout)
+            finally:
+                self._processes.discard(process)
+
+            if process in self._cancelled:
+                self._cancelled.discard(process)
+                self.stats["cancelled"] += 1
+                raise CommandCancelled(args)
+            return process.returncode
+
+    @staticmethod
+    async def _pump(stream, on_line):
+        # by hand rather than readline(), which gives up on lines over 64KiB (pip's progress bars)
+        pending = b""
+        while True:
+            chunk = await stream.read(65536)
+            if not chunk:
+                break
+            lines = (pending + chunk).split(b"\n")
+            pending = lines.pop()
+            if on_line is not None:
+                for line in lines:
+                    on_line(line + b"\n")
+        if pending and on_line is not None:
+            on_line(pending)
+
+    async def _kill(self, process):
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(process.pid, sig)
+            except ProcessLookupError:
+                pass
+            try:
+                await asyncio.wait_for(process.wait(), self.KILL_GRACE_SECONDS)
+                return
+            except asyncio.TimeoutError:
+                continue
+
+    async def _abandon(self, handle):
+        # handle["process"] is only ever set on this loop, so whichever of _run() and this runs first sees the other
+        handle["abandoned"] = True
+        process = handle.get("process")
+        if process is not None and process.returncode is None:
+            self._cancelled.add(process)
+            await self._kill(process)
+
+    async def _cancel_all(self):
+        processes = list(self._processes)
+        self._cancelled.update(processes)
+        await asyncio.gather(*[self._kill(process) for process in processes])
+
+
+PROCESS_ENGINE = ProcessEngine()
+
+
+class TailBuffer:
+    def __init__(self, max_bytes):
+        """the last max_bytes of a stream, in whole lines (a single longer line is kept whole)"""
+        self.max_bytes = max_bytes
+        self.dropped_bytes = 0
+        self._lines = deque()
+        self._size = 0
+
+    def feed(self, line):
+        self._lines.append(line)
+        self._size += len(line)
+        while self._size > self.max_bytes and len(self._lines) > 1:
+            dropped = self._lines.popleft()
+            self._size -= len(dropped)
+            self.dropped_bytes += len(dropped)
+
+    def getvalue(self):
+        return b"".join(self._lines)
+
+
+class OutputLogs:
+    def __init__(self, root=None, max_bytes=None, backups=None, tail_bytes=None):
+        """Output Logs
+
+        streams subprocess output, line by line as it arrives, to rotating per-app, per-phase log files
+        (<root>/<app>-py<version>[-variant]/<stage>.log, from the Tracer context of the calling thread) instead of
+        holding it in memory. run() returns the same (returncode, stdout, stderr) as subprocess.run, except that
+        stdout and stderr are only the tail of each stream. follow() also copies every line to a stream, prefixed
+        with its app and phase."""
+        self.root = root or ENV_CONFIG["log_dir"]
+        self.max_bytes = max_bytes or ENV_CONFIG["log_max_mb"] * 1024 * 1024
+        self.backups = ENV_CONFIG["log_backups"] if backups is None else backups
+        self.tail_bytes = tail_bytes or ENV_CONFIG["output_tail_kb"] * 1024
+        self._handlers = {}
+        self._follow = None
+        self._lock = threading.Lock()
+
+    def follow(self, stream):
+        self._follow = stream
+
+    def log_path(self):
+        """the log file output of the calling thread's commands goes to"""
+        return self._current()[2]
+
+    def _current(self):
+        """(label, phase, log file) for the calling thread"""
+        context = TRACER.current()
+        if "app" in context:
+            label = "{}-py{}".format(context["app"], context.get("py_version", ""))
+            if context.get("variant"):
+                label += "-" + context["variant"]
+        else:
+            label = "harness"
+        phase = context.get("stage", "session")
+        return label, phase, os.path.join(self.root, label, phase + ".log")
+
+    def _handler(self, path):
+        with self._lock:
+            if path not in self._handlers:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                handler = logging.handlers.RotatingFileHandler(
+                    path, maxBytes=self.max_bytes, backupCount=self.backups, delay=True
+                )
+                handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+                self._handlers[path] = handler
+            return self._handlers[path]
+
+    def _emit(self, handler, prefix, text):
+        handler.handle(logging.makeLogRecord({"msg": text, "levelno": logging.INFO}))
+        if self._follow is not None:
+            with self._lock:
+                self._follow.write("{} {}\n".format(prefix, text))
+                self._follow.flush()
+
+    def _line(self, tail, handler, prefix, marker, line):
+        tail.feed(line)
+        self._emit(handler, prefix, marker + line.decode(errors="replace").rstrip("\r\n"))
+
+    def _pump(self, lines, tail, handler, prefix, marker=""):
+        for line in lines:
+            self._line(tail, handler, prefix, marker, line)
+
+    def run(self, args, env=None, cwd=None, check=False, timeout=None):
+        label, phase, path = self._current()
+        handler = self._handler(path)
+        prefix = "[{} {}]".format(label, phase)
+        self._emit(handler, prefix, "$ " + " ".join(args))
+
+        stdout, stderr = TailBuffer(self.tail_bytes), TailBuffer(self.tail_bytes)
+        try:
+            returncode = PROCESS_ENGINE.run(
+                args,
+                env=env,
+                cwd=cwd,
+                timeout=timeout,
+                on_stdout=lambda line: self._line(stdout, handler, prefix, "", line),
+                on_stderr=lambda line: self._line(stderr, handler, prefix, "! ", line),
+            )
+        except (subprocess.TimeoutExpired, CommandCancelled) as e:
+            self._emit(handler, prefix, "{}; process group killed".format(e))
+            logger.error("{}; output so far in {}".format(e, path))
+            e.output, e.stderr = stdout.getvalue(), stderr.getvalue()
+            raise
+        return self._finish(args, returncode, stdout, stderr, handler, prefix, path, check)
+
+    def record(self, args, returncode, stdout_path, stderr_path, check=False):
+        """like run(), for output a command has already written to files (the Zappa worker)"""
+        label, phase, path = self._current()
+        handler = self._handler(path)
+        prefix = "[{} {}]".format(label, phase)
+        self._emit(handler, prefix, "$ " + " ".join(args))
+
+        stdout, stderr = TailBuffer(self.tail_bytes), TailBuffer(self.tail_bytes)
+        with open(stdout_path, "rb") as f:
+            self._pump(f, stdout, handler, prefix)
+        with open(stderr_path, "rb") as f:
+            self._pump(f, stderr, handler, prefix, "! ")
+        return self._finish(args, returncode, stdout, stderr, handler, prefix, path, check)
+
+    def _finish(self, args, returncode, stdout, stderr, handler, prefix, path, check):
+        self._emit(handler, prefix, "exit {}".format(returncode))
+        if returncode != 0:
+            logger.info("'{}' exited {}; full output in {}".format(" ".join(args), returncode, path))
+        if stdout.dropped_bytes or stderr.dropped_bytes:
+            logger.debug(
+                "kept the last {} bytes of output of '{}' in memory; the rest is in {}".format(
+                    self.tail_bytes, " ".join(args), path
+                )
+            )
+        if check and returncode != 0:
+            raise subprocess.CalledProcessError(returncode, args, stdout.getvalue(), stderr.getvalue())
+        return returncode, stdout.getvalue(), stderr.getvalue()
+
+    def close(self):
+        with self._lock:
+            for handler in self._handlers.values():
+                handler.close()
+            self._handlers.clear()
+
+
+OUTPUT_LOGS = OutputLogs()
+
+
+def venv_cmd(
+    venv_dir, cmd, params=[], as_json=False, check=False, extra_env={}, cwd=None, timeout=None
+):
     args = [os.path.join(venv_dir, "bin", cmd)]
     args.extend(params)
     if as_json:
         args.append("--json")
     logger.debug("Calling '{}'".format(" ".join(args)))
 
+    env = _venv_env(venv_dir, extra_env)
+
+    # logger.debug("venv_cmd: calling {} with env {}".format(args, env))
+    returncode, stdout, stderr = OUTPUT_LOGS.run(args, env=env, cwd=cwd, check=check, timeout=timeout)
+    if as_json:
+        try:
+            return returncode, json.loads(stdout), stderr
+        except json.decoder.JSONDecodeError:
+            pass  # returns below
+
+    return returncode, stdout, stderr
+
+
+class RateLimiter:
+    THROTTLE_MARKERS = (b"TooManyRequestsException", b"Rate exceeded", b"Throttling")
+    # safe to simply run again after being throttled half way through
+    IDEMPOTENT = ("status", "undeploy")
+
+    def __init__(
+        self,
+        rate=2.0,
+        burst=4,
+        max_retries=5,
+        base_delay=1.0,
+        max_delay=60.0,
+        sleep=time.sleep,
+        clock=time.monotonic,
+    ):
+        """Rate Limiter
+
+        a token bucket shared by every zappa command. When a command fails with an AWS throttling error the sustained
+        rate is halved (and creeps back up with each success), and idempotent commands are retried with exponential
+        backoff and full jitter. sleep and clock are injectable so a fake CLI can exercise it without waiting."""
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stats = {"calls": 0, "throttles": 0, "retries": 0, "backoff_seconds": 0.0, "wait_seconds": 0.0}
+        self._sleep = sleep
+        self._clock = clock
+        self._tokens = float(burst)
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # going negative reserves a slot, so concurrent callers queue up instead of stampeding
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+            self.stats["calls"] += 1
+            self.stats["wait_seconds"] += wait
+        if wait:
+            self._sleep(wait)
+
+    def call(self, params, fn):
+        """fn() -> (returncode, stdout, stderr), run once a token is free and again while throttled, if idempotent"""
+        attempt = 0
+        while True:
+            self.acquire()
+            ret, out, err = fn()
+            if not self.throttled(ret, out, err):
+                self._speed_up()
+                return ret, out, err
+
+            self._slow_down()
+            command = params[0] if params else ""
+            if command not in self.IDEMPOTENT or attempt >= self.max_retries:
+                logger.warn("RateLimiter: 'zappa {}' was throttled".format(command))
+                return ret, out, err
+
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+            logger.info(
+                "RateLimiter: 'zappa {}' was throttled; retrying in {:.1f}s".format(command, delay)
+            )
+            with self._lock:
+                self.stats["retries"] += 1
+                self.stats["backoff_seconds"] += delay
+            self._sleep(delay)
+            attempt += 1
+
+    def throttled(self, ret, out, err):
+        if ret == 0:
+            return False
+        output = b"".join(o for o in (out, err) if isinstance(o, bytes))
+        return any(marker in output for marker in self.THROTTLE_MARKERS)
+
+    def report(self):
+        return "zappa rate limiter: {calls} calls, {throttles} throttled, {retries} retried, {backoff_seconds:.1f}s backing off, {wait_seconds:.1f}s waiting for a slot".format(
+            **self.stats
+        )
+
+    def _slow_down(self):
+        with self._lock:
+            self.stats["throttles"] += 1
+            self.rate = max(self.max_rate / 16, self.rate / 2)
+
+    def _speed_up(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+RATE_LIMITER = RateLimiter(
+    ENV_CONFIG["zappa_calls_per_second"], ENV_CONFIG["zappa_calls_burst"]
+)
+
+
+def zappa_cmd(
+    venv_dir,
+    params=[],
+    as_json=False,
+    check=False,
+    extra_env={},
+    cwd=None,
+    zappa_worker=None,
+    rate_limiter=None,
+):
+    """venv_cmd for zappa itself: rate limited, and through the app's ZappaWorker if it has one"""
+    rate_limiter = rate_limiter or RATE_LIMITER
+
+    def run():
+        with TRACER.span("zappa " + (params[0] if params else "")) as span:
+            if zappa_worker is not None:
+                ret, out, err = zappa_worker.cmd(params, as_json, False, extra_env, cwd)
+            else:
+                ret, out, err = venv_cmd(venv_dir, "zappa", params, as_json, False, extra_env, cwd)
+            span["exit_code"] = ret
+        return ret, out, err
+
+    ret, out, err = rate_limiter.call(params, run)
+    if check and ret != 0:
+        raise subprocess.CalledProcessError(ret, ["zappa"] + list(params), out, err)
+    return ret, out, err
+
+
+def _venv_env(venv_dir, extra_env={}):
     env = copy(os.environ)
+    if LocalAWS.active is not None:
+        for name in LocalAWS.UNSET_ENV:
+            env.pop(name, None)
+        env.update(LocalAWS.active.env())
     env.update(extra_env)
 
     prefix = 'VIRTUAL_ENV="'
@@ -319,82 +1284,2355 @@ def venv_cmd(venv_dir, cmd, params=[], as_json=False, check=False, extra_env={})
                 break
             l = f.readline()
 
-    # logger.debug("venv_cmd: calling {} with env {}".format(args, env))
-    cmd = subprocess.run(
-        args, check=check, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env
-    )
-    if as_json:
-        try:
-            return cmd.returncode, json.loads(cmd.stdout), cmd.stderr
-        except json.decoder.JSONDecodeError:
-            pass  # returns below
+    return env
+
+
+class ZappaWorker:
+    def __init__(self, venv_dir, label=""):
+        """Zappa Worker
+
+        one long-lived process inside a venv (see zappa_e2e_worker.py) that imports the Zappa CLI once and then runs
+        every zappa command of an app cycle. cmd() returns the same (returncode, stdout, stderr) as venv_cmd, and falls
+        back to venv_cmd if the worker has died."""
+        self.venv_dir = venv_dir
+        self.label = label
+        self.calls = 0
+        self.startup_seconds = None
+        self.import_seconds = None
+        self._process = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        started = time.time()
+        self._process = subprocess.Popen(
+            [os.path.join(self.venv_dir, "bin", "python"), WORKER_SCRIPT],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=_venv_env(self.venv_dir),
+            # its own process group, so a timed-out command takes anything zappa started down with it
+            start_new_session=True,
+        )
+        ready = self._process.stdout.readline()
+        if not ready:
+            self._process.wait()
+            self._process = None
+            raise EnvironmentError(
+                "Zappa worker in {} failed to start".format(self.venv_dir)
+            )
+        self.import_seconds = json.loads(ready.decode())["import_seconds"]
+        self.startup_seconds = time.time() - started
+        logger.debug(
+            "ZappaWorker{}: started in {:.2f}s".format(self._label(), self.startup_seconds)
+        )
+        return self
+
+    @property
+    def saved_seconds(self):
+        # every call after the first would have paid the interpreter + Zappa import startup again
+        if not self.startup_seconds:
+            return 0.0
+        return self.startup_seconds * max(0, self.calls - 1)
+
+    def report(self):
+        return "zappa worker: {} calls, {:.2f}s startup ({:.2f}s importing Zappa), ~{:.2f}s saved".format(
+            self.calls, self.startup_seconds or 0, self.import_seconds or 0, self.saved_seconds
+        )
 
-    return cmd.returncode, cmd.stdout, cmd.stderr
+    def cmd(self, params=[], as_json=False, check=False, extra_env={}, cwd=None):
+        args = list(params)
+        if as_json:
+            args.append("--json")
+        logger.debug("ZappaWorker{}: calling 'zappa {}'".format(self._label(), " ".join(args)))
 
+        with self._lock:
+            if self._process is None or self._process.poll() is not None:
+                logger.warn(
+                    "ZappaWorker{}: worker is not running; falling back to the zappa CLI".format(
+                        self._label()
+                    )
+                )
+                return venv_cmd(self.venv_dir, "zappa", params, as_json, check, extra_env, cwd)
+
+            with PROCESS_ENGINE.slot(), tempfile.TemporaryDirectory() as out_dir:
+                request = {
+                    "args": args,
+                    "cwd": cwd or os.getcwd(),
+                    "env": dict(_venv_env(self.venv_dir, extra_env)),
+                    "stdout": os.path.join(out_dir, "stdout"),
+                    "stderr": os.path.join(out_dir, "stderr"),
+                }
+                self._process.stdin.write((json.dumps(request) + "\n").encode())
+                self._process.stdin.flush()
+                timeout = PROCESS_ENGINE.timeout_for(["zappa"], args)
+                try:
+                    replied = select.select([self._process.stdout], [], [], timeout)[0]
+                except BaseException:
+                    # e.g. Ctrl-C: the worker runs in its own session, so zappa would carry on without it
+                    self._kill()
+                    raise
+                if not replied:
+                    # zappa runs inside the worker, so the worker goes too; later calls fall back to venv_cmd
+                    self._kill()
+                    OUTPUT_LOGS.record(["zappa"] + args, -signal.SIGKILL, request["stdout"], request["stderr"])
+                    raise subprocess.TimeoutExpired(["zappa"] + args, timeout)
+                reply = self._process.stdout.readline()
+                if not reply:
+                    raise EnvironmentError(
+                        "Zappa worker in {} died running 'zappa {}'".format(
+                            self.venv_dir, " ".join(args)
+                        )
+                    )
+                returncode = json.loads(reply.decode())["returncode"]
+                returncode, stdout, stderr = OUTPUT_LOGS.record(
+                    ["zappa"] + args, returncode, request["stdout"], request["stderr"]
+                )
+            self.calls += 1
+
+        if check and returncode != 0:
+            raise subprocess.CalledProcessError(returncode, ["zappa"] + args, stdout, stderr)
+        if as_json:
+            try:
+                return returncode, json.loads(stdout), stderr
+            except json.decoder.JSONDecodeError:
+                pass  # returns below
 
-def chdir(wd):
-    logger.debug("Changing os directory to {}".format(wd))
-    os.chdir(wd)
+        return returncode, stdout, stderr
 
+    def close(self):
+        if self._process is None:
+            return
+        self._process.stdin.close()
+        try:
+            self._process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+        self._process.stdout.close()
+        self._process = None
 
-def _try_run_python(name):
-    out = ""
-    cmd = find_executable(name)
-    if cmd:
+    def _kill(self):
         try:
-            run = subprocess.run(
-                [cmd, "-V"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT
-            )
-            if run:
-                out = run.stdout.decode()
-        except DistutilsExecError:
+            os.killpg(self._process.pid, signal.SIGKILL)
+        except ProcessLookupError:
             pass
-    return out, cmd
+        self._process.wait()
+        self._process.stdin.close()
+        self._process.stdout.close()
+        self._process = None
+
+    def _label(self):
+        return " " + self.label if self.label else ""
 
+    def __enter__(self):
+        return self.start()
 
-def python_executables():
+    def __exit__(self, exc, value, tb):
+        self.close()
 
-    found = {"2.7": None, "3.6": None}
 
-    if ENV_CONFIG["python_27_path"]:
-        out, cmd = _try_run_python(ENV_CONFIG["python_27_path"])
-        if out.startswith("Python 2.7"):
-            found["2.7"] = ENV_CONFIG["python_27_path"]
-        else:
-            raise EnvironmentError(
-                "Python 2.7 path specified, but is not actually a Python 2.7 executable."
+class RunScheduler:
+    STAGES = ("prepare", "deploy", "verify", "teardown")
+
+    def __init__(self, workers=1, stage_workers=None):
+        """Run Scheduler
+
+        runs (app, python version) pairs as a pipeline of stages (see ZappaAppRun), each stage on its own bounded
+        thread pool, so the next app's venv gets built while the current one is deploying or being torn down. Work is
+        submitted up front and each pytest item collects its own result, so failures are still reported per pair. A
+        failed stage skips the rest except teardown, which always runs. With every pool at one worker nothing is
+        submitted and each pair runs its stages inline, like the old sequential loop."""
+        stage_workers = stage_workers or {}
+        self.pool_sizes = dict(
+            (stage, max(1, stage_workers.get(stage, workers))) for stage in self.STAGES
+        )
+        self.pipelined = max(self.pool_sizes.values()) > 1
+        self.stats = dict(
+            (
+                stage,
+                {"runs": 0, "busy_seconds": 0.0, "queued": 0, "max_queue": 0, "queue_sum": 0, "samples": 0},
             )
+            for stage in self.STAGES
+        )
+        self._futures = {}
+        self._pools = {}
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._started_at = None
+        self._finished_at = None
 
-    if ENV_CONFIG["python_36_path"]:
-        out, cmd = _try_run_python(ENV_CONFIG["python_36_path"])
-        if out.startswith("Python 3.6"):
-            found["3.6"] = ENV_CONFIG["python_36_path"]
-        else:
-            raise EnvironmentError(
-                "Python 3.6 path specified, but is not actually a Python 3.6 executable."
+    def submit(self, key, run):
+        if not self.pipelined:
+            return
+        if self._started_at is None:
+            self._started_at = time.time()
+        future = Future()
+        self._futures[key] = future
+        self._enqueue(run, 0, None, future)
+
+    def result(self, key, run):
+        future = self._futures.pop(key, None)
+        if future is not None:
+            return future.result()
+
+        error = None
+        for stage in self.STAGES:
+            error = self._run_stage(run, stage, error)
+        if error is not None:
+            raise error
+
+    def shutdown(self):
+        # stages only ever hand work forward, so shutting the pools down in order drains them
+        self._cancelled = True
+        for stage in self.STAGES:
+            if stage in self._pools:
+                self._pools[stage].shutdown(wait=True)
+        self._pools = {}
+        self._futures = {}
+
+    def report(self):
+        elapsed = max((self._finished_at or 0) - (self._started_at or 0), 1e-9)
+        lines = []
+        for stage in self.STAGES:
+            stats = self.stats[stage]
+            lines.append(
+                "{}: {} workers, {} runs, queue depth max {} / mean {:.1f}, utilisation {:.0%}".format(
+                    stage,
+                    self.pool_sizes[stage],
+                    stats["runs"],
+                    stats["max_queue"],
+                    stats["queue_sum"] / max(stats["samples"], 1),
+                    stats["busy_seconds"] / (self.pool_sizes[stage] * elapsed),
+                )
             )
+        return lines
+
+    def _enqueue(self, run, index, error, future):
+        stage = self.STAGES[index]
+        with self._lock:
+            if stage not in self._pools:
+                self._pools[stage] = ThreadPoolExecutor(max_workers=self.pool_sizes[stage])
+            stats = self.stats[stage]
+            stats["queued"] += 1
+            stats["max_queue"] = max(stats["max_queue"], stats["queued"])
+            stats["queue_sum"] += stats["queued"]
+            stats["samples"] += 1
+        self._pools[stage].submit(self._step, run, index, error, future)
+
+    def _step(self, run, index, error, future):
+        stage = self.STAGES[index]
+        with self._lock:
+            self.stats[stage]["queued"] -= 1
+
+        if self._cancelled and error is None and stage != "teardown":
+            # shutting down: nothing new gets deployed or tested, but whatever was deployed is still torn down
+            error = RuntimeError("{!r} cancelled before its {} stage".format(run, stage))
+        error = self._run_stage(run, stage, error)
+        self._finished_at = time.time()
+
+        if index + 1 < len(self.STAGES):
+            self._enqueue(run, index + 1, error, future)
+        elif error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(None)
+
+    def _run_stage(self, run, stage, error):
+        """runs one stage of run unless an earlier one failed (teardown always runs); returns the first error"""
+        if error is not None and stage != "teardown":
+            return error
+
+        started = time.time()
+        try:
+            with TRACER.context(stage=stage, **getattr(run, "trace_context", {})):
+                with TRACER.span("stage " + stage):
+                    getattr(run, stage)()
+        except BaseException as e:
+            # includes the SystemExit DeployedZappaApp bails with; it belongs to this pair, not the whole process
+            if error is None:
+                error = e
+        finally:
+            with self._lock:
+                self.stats[stage]["runs"] += 1
+                self.stats[stage]["busy_seconds"] += time.time() - started
+        return error
+
+
+class VenvStore:
+    MARKER = ".zappa-e2e-venv.json"
+
+    def __init__(self, root=None, max_bytes=None):
+        """Virtualenv Store
+
+        content-addressed virtualenvs, keyed by interpreter version + requirements + Zappa override, so apps with the
+        same requirements share one venv and skip pip entirely on a hit. An entry only counts as built once its marker
+        is written. Runs hold a shared flock() on an entry while using it and eviction needs an exclusive one, so neither
+        parallel pairs nor other processes can evict a venv out from under a run; a separate lock serialises builds."""
+        if root is None:
+            root = os.path.join(tempfile.gettempdir(), "zappa-e2e", "venvs")
+        if max_bytes is None:
+            max_bytes = ENV_CONFIG["venv_cache_max_mb"] * 1024 * 1024
+        self.root = root
+        self.max_bytes = max_bytes
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "bytes_reclaimed": 0}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def key(self, interpreter_version, requirements_path, zappa_override=None):
+        h = hashlib.sha256()
+        h.update(interpreter_version.strip().encode())
+        h.update(b"\0")
+        with open(requirements_path, "rb") as f:
+            h.update(f.read())
+        h.update(b"\0")
+        h.update(_override_fingerprint(zappa_override).encode())
+        return h.hexdigest()[:24]
 
-    if not found["2.7"] or not found["3.6"]:
-        # try plain `python` first
-        out, cmd = _try_run_python("python")
-        if not found["2.7"] and out and out.startswith("Python 2.7"):
-            found["2.7"] = cmd
-        elif not found["3.6"] and out and out.startswith("Python 3.6"):
-            found["3.6"] = cmd
+    def base_key(self, interpreter_version, zappa_requirement, zappa_override=None):
+        """a base venv holds only Zappa and its dependencies; app venvs with the same Zappa are cloned from it"""
+        h = hashlib.sha256()
+        for part in (interpreter_version.strip(), zappa_requirement, _override_fingerprint(zappa_override)):
+            h.update(part.encode())
+            h.update(b"\0")
+        return "base-" + h.hexdigest()[:24]
 
-    if not found["2.7"] and out and (found["2.7"] is None):
-        out, cmd = _try_run_python("python2")
-        if out.startswith("Python 2.7"):
-            found["2.7"] = cmd
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def checkout(self, key, build):
+        """returns the venv dir for key, calling build(venv_dir) first on a miss. Pair with release(key)"""
+        os.makedirs(self.root, exist_ok=True)
+        venv_dir = self.path(key)
+        lock_file = open(venv_dir + ".lock", "a")
+        fcntl.flock(lock_file, fcntl.LOCK_SH)
+        try:
+            hit = self._verified(venv_dir)
+            if not hit:
+                with open(venv_dir + ".build", "a") as build_lock:
+                    fcntl.flock(build_lock, fcntl.LOCK_EX)
+                    # another run may have built it while we waited
+                    hit = self._verified(venv_dir)
+                    if not hit:
+                        self._count("misses")
+                        logger.info("VenvStore: building venv {}".format(venv_dir))
+                        if os.path.lexists(venv_dir):
+                            shutil.rmtree(venv_dir)
+                        build(venv_dir)
+                        with open(os.path.join(venv_dir, self.MARKER), "w") as f:
+                            json.dump({"key": key, "size": _tree_size(venv_dir)}, f)
+            if hit:
+                self._count("hits")
+                logger.info("VenvStore: reusing venv {}".format(venv_dir))
+                os.utime(os.path.join(venv_dir, self.MARKER))
+        except BaseException:
+            lock_file.close()
+            raise
+        with self._lock:
+            self._locks.setdefault(key, []).append(lock_file)
+        self.evict(keep=key)
+        return venv_dir
+
+    def release(self, key):
+        with self._lock:
+            lock_file = self._locks[key].pop()
+        lock_file.close()
+
+    def evict(self, keep=None):
+        entries = []
+        for name in os.listdir(self.root):
+            marker = os.path.join(self.root, name, self.MARKER)
+            if name == keep or not os.path.isfile(marker):
+                continue
+            try:
+                with open(marker) as f:
+                    size = json.load(f)["size"]
+            except (ValueError, KeyError):
+                size = _tree_size(os.path.join(self.root, name))
+            entries.append((os.path.getmtime(marker), size, name))
+
+        total = sum(size for _, size, _ in entries)
+        if keep is not None and self._verified(self.path(keep)):
+            total += self._entry_size(keep)
+
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            lock_file = open(self.path(name) + ".lock", "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                # in use by some run; try the next oldest
+                lock_file.close()
+                continue
+            try:
+                logger.info("VenvStore: evicting venv {} ({} bytes)".format(name, size))
+                shutil.rmtree(self.path(name))
+                self._count("evictions")
+                self._count("bytes_reclaimed", size)
+                total -= size
+            finally:
+                lock_file.close()
+
+    def report(self):
+        return "venv cache: {hits} hits, {misses} misses, {evictions} evictions, {bytes_reclaimed} bytes reclaimed".format(
+            **self.stats
+        )
+
+    def _entry_size(self, key):
+        try:
+            with open(os.path.join(self.path(key), self.MARKER)) as f:
+                return json.load(f)["size"]
+        except (IOError, ValueError, KeyError):
+            return _tree_size(self.path(key))
+
+    def _verified(self, venv_dir):
+        return os.path.isfile(os.path.join(venv_dir, self.MARKER)) and os.path.isfile(
+            os.path.join(venv_dir, "bin", "python")
+        )
+
+    def _count(self, stat, n=1):
+        with self._lock:
+            self.stats[stat] += n
+
+
+def zappa_requirement(requirements_path):
+    """the line of a requirements file that installs Zappa, e.g. "zappa" or "zappa==0.46.2"; None if there is none"""
+    with open(requirements_path) as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if re.match(r"^zappa(?![\w.-])", line, re.IGNORECASE):
+                return line
+    return None
+
+
+# ioctl(2) request for a copy-on-write clone of a whole file (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+
+def clone_venv(base_dir, venv_dir):
+    """clone the virtualenv in base_dir to venv_dir without copying package files
+
+    files are reflinked where the filesystem supports it, otherwise hard-linked; pip only ever unlinks and recreates
+    installed files, so a linked base is never changed by installs into the clone. Files that carry the venv's own
+    path (scripts' shebangs, activate scripts, pyvenv.cfg) are rewritten for the new location, and *.pth files, which
+    setuptools appends to in place, are copied. Returns {"reflinked": n, "linked": n, "copied": n, "rewritten": n}"""
+    stats = {"reflinked": 0, "linked": 0, "copied": 0, "rewritten": 0}
+    base_dir, venv_dir = os.path.abspath(base_dir), os.path.abspath(venv_dir)
+    old_prefix, new_prefix = base_dir.encode(), venv_dir.encode()
+    can_reflink = True
+    for root, dirs, files in os.walk(base_dir):
+        dirs.sort()
+        rel_root = os.path.relpath(root, base_dir)
+        target_root = os.path.normpath(os.path.join(venv_dir, rel_root))
+        os.makedirs(target_root, exist_ok=True)
+        shutil.copystat(root, target_root)
+        for name in dirs + files:
+            src, dst = os.path.join(root, name), os.path.join(target_root, name)
+            if os.path.islink(src):
+                link = os.readlink(src)
+                if link == base_dir or link.startswith(base_dir + os.sep):
+                    link = venv_dir + link[len(base_dir):]
+                os.symlink(link, dst)
+                if name in dirs:
+                    dirs.remove(name)
+                continue
+            if name in dirs or (rel_root == "." and name == VenvStore.MARKER):
+                continue
+            if rel_root == "bin" or name == "pyvenv.cfg":
+                with open(src, "rb") as f:
+                    content = f.read()
+                if b"\0" not in content[:1024] and old_prefix in content:
+                    with open(dst, "wb") as f:
+                        f.write(content.replace(old_prefix, new_prefix))
+                    shutil.copystat(src, dst)
+                    stats["rewritten"] += 1
+                    continue
+            if name.endswith(".pth"):
+                shutil.copy2(src, dst)
+                stats["copied"] += 1
+                continue
+            if can_reflink:
+                try:
+                    _reflink(src, dst)
+                    stats["reflinked"] += 1
+                    continue
+                except OSError:
+                    can_reflink = False
+            try:
+                os.link(src, dst)
+                stats["linked"] += 1
+            except OSError:
+                # e.g. EXDEV: the store root spans filesystems
+                shutil.copy2(src, dst)
+                stats["copied"] += 1
+    return stats
+
+
+def _reflink(src, dst):
+    with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        except OSError:
+            dst_file.close()
+            os.unlink(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+class Wheelhouse:
+    MANIFEST = "manifest.json"
+
+    def __init__(self, root=None):
+        """Wheelhouse
+
+        one directory of wheels per Python version, built from every app's requirements (plus the Zappa override) so
+        venv builds can `pip install --no-index --find-links` without touching the network. Each requirement line is
+        recorded in a manifest once its wheels are built; only new or changed lines are built again."""
+        if root is None:
+            root = os.path.join(tempfile.gettempdir(), "zappa-e2e", "wheelhouse")
+        self.root = root
+        self._ready = {}
+        self._lock = threading.Lock()
+
+    def path(self, py_version):
+        return os.path.join(self.root, "py" + py_version)
+
+    def ensure(self, py_version, py_executable, requirements_files, zappa_override=None):
+        """builds whatever is missing (once per session and version); returns the path of the overridden Zappa wheel, if any"""
+        with self._lock:
+            version_lock = self._ready.setdefault(py_version, [threading.Lock(), None])
+        with version_lock[0]:
+            if version_lock[1] is None:
+                version_lock[1] = self._build(
+                    py_version, py_executable, requirements_files, zappa_override
+                )
+            return version_lock[1]
+
+    def install_args(self, py_version):
+        return ["--no-index", "--find-links", self.path(py_version)]
+
+    def _build(self, py_version, py_executable, requirements_files, zappa_override):
+        wheel_dir = self.path(py_version)
+        os.makedirs(wheel_dir, exist_ok=True)
+        with open(os.path.join(wheel_dir, ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            manifest = self._load_manifest(wheel_dir)
+            builder_dir = os.path.join(wheel_dir, ".builder")
+            if not os.path.isfile(os.path.join(builder_dir, "bin", "pip")):
+                ret, out, err = OUTPUT_LOGS.run(["virtualenv", "-p", py_executable, builder_dir])
+                if ret != 0:
+                    logger.error(
+                        "Wheelhouse: virtualenv exited {}; full output in {}".format(ret, OUTPUT_LOGS.log_path())
+                    )
+                    raise EnvironmentError(
+                        "Could not create wheel builder virtualenv for py {}".format(py_version)
+                    )
+
+            lines = []
+            for requirements_file in requirements_files:
+                for line in _requirement_lines(requirements_file):
+                    if line not in lines:
+                        lines.append(line)
+
+            for line in lines:
+                if line in manifest["requirements"]:
+                    continue
+                logger.info("Wheelhouse: building wheels for py{} {}".format(py_version, line))
+                with TRACER.span("pip wheel", requirement=line):
+                    venv_cmd(
+                        builder_dir,
+                        "pip",
+                        ["wheel", "--find-links", wheel_dir, "-w", wheel_dir, line],
+                        check=True,
+                    )
+                manifest["requirements"][line] = True
+                self._save_manifest(wheel_dir, manifest)
+
+            override_wheel = None
+            if zappa_override:
+                fingerprint = _override_fingerprint(zappa_override)
+                override_wheel = manifest["overrides"].get(fingerprint)
+                if override_wheel is None or not os.path.isfile(override_wheel):
+                    override_wheel = self._build_override(builder_dir, wheel_dir, zappa_override)
+                    manifest["overrides"][fingerprint] = override_wheel
+                    self._save_manifest(wheel_dir, manifest)
+
+        return override_wheel
+
+    def _build_override(self, builder_dir, wheel_dir, zappa_override):
+        # built on its own first so we know exactly which file is the override, then its dependencies
+        with tempfile.TemporaryDirectory() as build_dir:
+            logger.info("Wheelhouse: building overridden Zappa {}".format(zappa_override))
+            venv_cmd(
+                builder_dir,
+                "pip",
+                ["wheel", "--no-deps", "-w", build_dir, os.path.expanduser(zappa_override)],
+                check=True,
+            )
+            (wheel_name,) = os.listdir(build_dir)
+            override_wheel = os.path.join(wheel_dir, wheel_name)
+            shutil.move(os.path.join(build_dir, wheel_name), override_wheel)
+        venv_cmd(
+            builder_dir,
+            "pip",
+            ["wheel", "--find-links", wheel_dir, "-w", wheel_dir, override_wheel],
+            check=True,
+        )
+        return override_wheel
+
+    def _load_manifest(self, wheel_dir):
+        try:
+            with open(os.path.join(wheel_dir, self.MANIFEST)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {"requirements": {}, "overrides": {}}
+
+    def _save_manifest(self, wheel_dir, manifest):
+        tmp_manifest = os.path.join(wheel_dir, self.MANIFEST + ".tmp")
+        with open(tmp_manifest, "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.rename(tmp_manifest, os.path.join(wheel_dir, self.MANIFEST))
+
+
+class PackageStore:
+    def __init__(self, root=None):
+        """Package Store
+
+        `zappa package` archives, built once per deployment fingerprint + stage and reused by every deploy and update
+        that would otherwise package the very same thing again. Size and build time are kept next to each archive."""
+        if root is None:
+            root = os.path.join(tempfile.gettempdir(), "zappa-e2e", "packages")
+        self.root = root
+        self.stats = {"hits": 0, "misses": 0}
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        """returns the package info for key, calling build(zip_path) first on a miss"""
+        os.makedirs(self.root, exist_ok=True)
+        zip_path = os.path.join(self.root, key + ".zip")
+        info_path = os.path.join(self.root, key + ".json")
+        with open(os.path.join(self.root, key + ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(info_path) as f:
+                    info = json.load(f)
+                if os.path.isfile(zip_path):
+                    self._count("hits")
+                    info["built"] = False
+                    logger.info("PackageStore: reusing package {}".format(zip_path))
+                    return info
+            except (IOError, ValueError):
+                pass
+
+            self._count("misses")
+            tmp_zip_path = zip_path + ".tmp.zip"
+            started = time.time()
+            build(tmp_zip_path)
+            info = {
+                "path": zip_path,
+                "size": os.path.getsize(tmp_zip_path),
+                "build_seconds": time.time() - started,
+            }
+            os.rename(tmp_zip_path, zip_path)
+            with open(info_path, "w") as f:
+                json.dump(info, f, indent=2)
+            logger.info(
+                "PackageStore: built {} ({} bytes) in {:.1f}s".format(
+                    zip_path, info["size"], info["build_seconds"]
+                )
+            )
+            info["built"] = True
+            return info
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+
+BUDGET_FILE = "zappa_budget.json"
+
+# what each file in a package counts as, first match wins
+PACKAGE_FILE_TYPES = (
+    ("dist-info", lambda parts: any(p.endswith((".dist-info", ".egg-info")) for p in parts[:-1])),
+    ("tests", lambda parts: any(p in ("tests", "test", "testing") for p in parts[:-1])),
+    (".pyc", lambda parts: parts[-1].endswith(".pyc")),
+    (".so", lambda parts: re.search(r"\.(so(\.[\d.]+)?|pyd)$", parts[-1]) is not None),
+    (".py", lambda parts: parts[-1].endswith(".py")),
+    ("other", lambda parts: True),
+)
+
+
+def analyze_package(archives):
+    """uncompressed size breakdown of a deployment package, by top-level package and by file type
+
+    archives: the package zip, plus the project .tar.gz of a slim handler"""
+    analysis = {"archive_bytes": 0, "uncompressed_bytes": 0, "files": 0, "packages": {}, "types": {}}
+    for path in archives:
+        analysis["archive_bytes"] += os.path.getsize(path)
+        for name, size in _archive_members(path):
+            parts = [p for p in name.split("/") if p]
+            if not parts:
+                continue
+            file_type = next(label for label, matches in PACKAGE_FILE_TYPES if matches(parts))
+            package = _top_level_package(parts)
+            analysis["files"] += 1
+            analysis["uncompressed_bytes"] += size
+            analysis["packages"][package] = analysis["packages"].get(package, 0) + size
+            analysis["types"][file_type] = analysis["types"].get(file_type, 0) + size
+    return analysis
+
+
+def _archive_members(path):
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            return [(info.filename, info.file_size) for info in archive.infolist() if not info.filename.endswith("/")]
+    with tarfile.open(path) as archive:
+        return [(info.name, info.size) for info in archive.getmembers() if info.isfile()]
+
+
+def _top_level_package(parts):
+    top = parts[0]
+    info = re.match(r"^(.+?)-[^-]+\.(dist|egg)-info$", top)
+    if info:
+        # metadata belongs with its distribution; close enough to the import name for most packages
+        return info.group(1).lower().replace("-", "_")
+    if len(parts) == 1:
+        # a top-level module: foo.py, foo.cpython-36m-x86_64-linux-gnu.so, ...
+        return top.split(".", 1)[0]
+    return top
+
+
+def app_budget(app_dir):
+    """the app's zappa_budget.json, e.g. {"archive_bytes": "12MB", "uncompressed_bytes": "40MB",
+    "packages": {"botocore": "30MB"}, "types": {"tests": "1MB"}}, with sizes in bytes; {} if it has none"""
+    try:
+        with open(os.path.join(app_dir, BUDGET_FILE)) as f:
+            budget = json.load(f)
+    except FileNotFoundError:
+        return {}
+    parsed = {}
+    for key, value in budget.items():
+        if isinstance(value, dict):
+            parsed[key] = dict((name, parse_size(size)) for name, size in value.items())
+        else:
+            parsed[key] = parse_size(value)
+    return parsed
+
+
+def parse_size(value):
+    """1048576, "1MB", "512KB" or "1.5GB" -> bytes (binary units)"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = re.match(r"^\s*([\d.]+)\s*([KMG]?)B?\s*$", str(value), re.IGNORECASE)
+    if not match:
+        raise ValueError("not a size: {!r}".format(value))
+    return int(float(match.group(1)) * 1024 ** " KMG".index(match.group(2).upper() or " "))
+
+
+def budget_violations(analysis, budget):
+    """[(what, size, limit)] for everything in the analysis over its budget"""
+    violations = []
+    for key in ("archive_bytes", "uncompressed_bytes"):
+        if key in budget and analysis[key] > budget[key]:
+            violations.append((key, analysis[key], budget[key]))
+    for section in ("packages", "types"):
+        for name, limit in sorted(budget.get(section, {}).items()):
+            size = analysis[section].get(name, 0)
+            if size > limit:
+                violations.append(("{} {}".format(section[:-1], name), size, limit))
+    return violations
+
+
+def package_diff(previous, current, min_bytes=1024):
+    """[(what, before, after)] for every total and breakdown entry that moved by at least min_bytes, biggest first"""
+    changes = []
+    for key in ("archive_bytes", "uncompressed_bytes"):
+        changes.append((key, previous.get(key, 0), current[key]))
+    for section in ("packages", "types"):
+        before, after = previous.get(section, {}), current[section]
+        for name in set(before) | set(after):
+            changes.append(("{} {}".format(section[:-1], name), before.get(name, 0), after.get(name, 0)))
+    changes = [c for c in changes if abs(c[2] - c[1]) >= min_bytes]
+    return sorted(changes, key=lambda c: (-abs(c[2] - c[1]), c[0]))
+
+
+def format_package_analysis(analysis, diff=None, violations=(), top=10):
+    lines = [
+        "{} archive bytes, {} uncompressed in {} files".format(
+            analysis["archive_bytes"], analysis["uncompressed_bytes"], analysis["files"]
+        )
+    ]
+    row = "  {:<32} {:>12} {:>6}"
+    for section in ("types", "packages"):
+        lines.append("by {}:".format(section[:-1] if section == "types" else "package"))
+        entries = sorted(analysis[section].items(), key=lambda e: (-e[1], e[0]))
+        for name, size in entries[:top]:
+            lines.append(row.format(name, size, "{:.0%}".format(size / float(analysis["uncompressed_bytes"] or 1))))
+        if len(entries) > top:
+            lines.append(row.format("({} more)".format(len(entries) - top), sum(size for _, size in entries[top:]), ""))
+    if diff is not None:
+        lines.append("since the previous run:" if diff else "unchanged since the previous run")
+        for what, before, after in diff[:top]:
+            lines.append("  {:<32} {:>12} -> {:>12} ({:+})".format(what, before, after, after - before))
+    for what, size, limit in violations:
+        lines.append("over budget: {} is {} bytes, budget {}".format(what, size, limit))
+    return lines
+
+
+MATRIX_FILE = "zappa_matrix.json"
+
+
+def settings_matrix(app_dir):
+    """every combination of the app's zappa_matrix.json grid, e.g. {"memory_size": [128, 512], "slim_handler": [true, false]}
+
+    an app without one has a single, empty combination"""
+    try:
+        with open(os.path.join(app_dir, MATRIX_FILE)) as f:
+            grid = json.load(f)
+    except FileNotFoundError:
+        return [{}]
+    keys = sorted(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[k] for k in keys))]
+
+
+def variant_name(combination):
+    """short, AWS-name-safe suffix for a matrix combination; empty for the default one"""
+    if not combination:
+        return ""
+    name = "-".join(
+        re.sub(r"[^A-Za-z0-9]+", "", str(combination[k]).lower()) for k in sorted(combination)
+    )
+    if len(name) > 20:
+        # lambda function names are capped at 64 characters, project name and stage included
+        name = hashlib.sha256(json.dumps(combination, sort_keys=True).encode()).hexdigest()[:8]
+    return name
+
+
+def apply_matrix(settings_file, stage, combination):
+    """merges a matrix combination into the rendered settings and gives the stage its own project name"""
+    if not combination:
+        return
+    settings = load_settings(settings_file)
+    settings[stage].update(combination)
+    settings[stage]["project_name"] = "{}-{}".format(
+        settings[stage]["project_name"], variant_name(combination)
+    )
+    with open(settings_file, "w") as f:
+        json.dump(settings, f, indent=4)
+
+
+def keep_local_package(settings_file, stage):
+    """has zappa deploy/update leave the package they build in the app dir, so it can be analyzed without a rebuild"""
+    settings = load_settings(settings_file)
+    settings[stage]["delete_local_zip"] = False
+    with open(settings_file, "w") as f:
+        json.dump(settings, f, indent=4)
+
+
+def render_settings(template_file, settings_file, py_version, combination=None, stage="test", s3_bucket=None):
+    """zappa_settings.json.j2 -> zappa_settings.json for one python version and matrix combination"""
+    with open(template_file) as f:
+        template = Template(f.read())
+    with open(settings_file, "w") as f:
+        f.write(
+            template.render(
+                S3_BUCKET=s3_bucket or ENV_CONFIG["s3_bucket"], E2E_VERSION=py_version, MATRIX=combination
+            )
+        )
+    apply_matrix(settings_file, stage, combination)
+    if LocalAWS.active is not None:
+        LocalAWS.active.configure(settings_file, stage)
+
+
+def load_settings(settings_file):
+    """zappa_settings.json as a dict; tolerates the trailing commas our templates have"""
+    with open(settings_file) as f:
+        source = f.read()
+    return json.loads(re.sub(r",(\s*[}\]])", r"\1", source))
+
+
+def _requirement_lines(requirements_file):
+    lines = []
+    with open(requirements_file) as f:
+        for line in f:
+            line = line.split(" #", 1)[0].strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("-r ") or line.startswith("--requirement "):
+                included = line.split(None, 1)[1]
+                lines.extend(
+                    _requirement_lines(
+                        os.path.join(os.path.dirname(requirements_file), included)
+                    )
+                )
+            elif line.startswith("-"):
+                logger.warn(
+                    "Wheelhouse: ignoring pip option {!r} in {}".format(line, requirements_file)
+                )
+            else:
+                lines.append(line)
+    return lines
+
+
+def requirements_path(app_dir, py_version):
+    """requirements-pyXY.txt wins over requirements.txt when both exist"""
+    requirements_txt_path = None
+
+    req_path = os.path.join(app_dir, "requirements.txt")
+    if os.path.isfile(req_path):
+        requirements_txt_path = req_path
+
+    alt_req_path = os.path.join(
+        app_dir, "requirements-py{}.txt".format(py_version.replace(".", ""))
+    )
+    if os.path.isfile(alt_req_path):
+        # override:
+        requirements_txt_path = alt_req_path
+
+    return requirements_txt_path
+
+
+def deployment_fingerprint(app_dir, requirements_path, settings_file, venv_dir, source_hash=None):
+    """hash of everything that ends up in the deployed function
+
+    the app source (minus its tests and the settings we render into it), the resolved requirements, the rendered
+    zappa_settings.json and the venv (its store key covers any Zappa override) plus the installed Zappa version.
+    `source_hash` (see WorkspaceSync.source_hash()) stands in for hashing the app dir again"""
+    h = hashlib.sha256()
+    h.update((source_hash or tree_hash(app_dir, exclude=_not_app_source)).encode())
+    for path in (requirements_path, settings_file):
+        with open(path, "rb") as f:
+            h.update(hashlib.sha256(f.read()).hexdigest().encode())
+    h.update(os.path.basename(os.path.realpath(venv_dir)).encode())
+    h.update(str(installed_version(venv_dir, "zappa")).encode())
+    return h.hexdigest()
+
+
+def _not_app_source(rel_path):
+    top = rel_path.split(os.sep, 1)[0]
+    if top.startswith("tests") or top in ("run_tests", "zappa_settings.json"):
+        return True
+    # packages zappa leaves behind in the project dir
+    return os.sep not in rel_path and rel_path.endswith((".zip", ".tar.gz"))
+
+
+def tree_hash(path, exclude=None):
+    h = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if d != "__pycache__")
+        for name in sorted(files):
+            full_path = os.path.join(root, name)
+            rel_path = os.path.relpath(full_path, path)
+            if name.endswith(".pyc") or (exclude and exclude(rel_path)):
+                continue
+            with open(full_path, "rb") as f:
+                h.update("{}\0{}\0".format(rel_path, hashlib.sha256(f.read()).hexdigest()).encode())
+    return h.hexdigest()
+
+
+class WorkspaceSync:
+    # bumped when the manifest format changes; an older manifest is ignored
+    VERSION = 1
+
+    def __init__(self, src, dst, manifest_path):
+        """Workspace Sync
+
+        keeps an app's workspace in step with its source dir, copying only what changed. The manifest (kept in the
+        workspace, next to the app dir, so it never ends up in a package) maps each source file to the size, mtime and
+        sha256 it was copied with. A file whose source and workspace copy both still match their recorded stats is
+        skipped without being read; otherwise its content is hashed and it is only copied when the content differs
+        (or the workspace copy is gone). Files that disappeared from the source are removed."""
+        self.src = src
+        self.dst = dst
+        self.manifest_path = manifest_path
+        self.files = {}
+        self.copied = []
+        self.removed = []
+        self.unchanged = 0
+        self.bytes_copied = 0
+
+    @property
+    def changed(self):
+        return bool(self.copied or self.removed)
+
+    def _load(self):
+        if not os.path.isdir(self.dst):
+            return {}
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if manifest.get("version") != self.VERSION or manifest.get("src") != os.path.abspath(self.src):
+            return {}
+        return manifest["files"]
+
+    def _save(self):
+        tmp_path = "{}.{}".format(self.manifest_path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump({"version": self.VERSION, "src": os.path.abspath(self.src), "files": self.files}, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _walk(self):
+        for root, dirs, files in os.walk(self.src):
+            dirs.sort()
+            for name in sorted(files):
+                full_path = os.path.join(root, name)
+                yield os.path.relpath(full_path, self.src), full_path
+
+    def run(self):
+        previous = self._load()
+        for rel_path, src_path in self._walk():
+            dst_path = os.path.join(self.dst, rel_path)
+            st = os.stat(src_path)
+            stats = [st.st_size, st.st_mtime_ns]
+            entry = previous.get(rel_path)
+            try:
+                dst_st = os.lstat(dst_path)
+                dst_stats = [dst_st.st_size, dst_st.st_mtime_ns]
+            except OSError:
+                dst_stats = None
+            if entry and entry["stats"] == stats and dst_stats == stats:
+                self.files[rel_path] = entry
+                self.unchanged += 1
+                continue
+
+            digest = _file_hash(src_path)
+            if entry and entry["sha256"] == digest and dst_stats == entry["stats"]:
+                # touched but not modified: just record the new stats
+                shutil.copystat(src_path, dst_path)
+                self.unchanged += 1
+            else:
+                os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+                if os.path.islink(dst_path) or os.path.isdir(dst_path):
+                    _remove(dst_path)
+                shutil.copy2(src_path, dst_path)
+                self.copied.append(rel_path)
+                self.bytes_copied += stats[0]
+            self.files[rel_path] = {"stats": stats, "sha256": digest}
+
+        for rel_path in sorted(set(previous) - set(self.files)):
+            dst_path = os.path.join(self.dst, rel_path)
+            if os.path.lexists(dst_path):
+                _remove(dst_path)
+            self.removed.append(rel_path)
+            self._prune(os.path.dirname(dst_path))
+
+        os.makedirs(self.dst, exist_ok=True)
+        self._save()
+        return self
+
+    def _prune(self, path):
+        # drop directories a removed file leaves empty, up to the workspace root
+        while os.path.abspath(path) != os.path.abspath(self.dst):
+            try:
+                os.rmdir(path)
+            except OSError:
+                return
+            path = os.path.dirname(path)
+
+    def source_hash(self, exclude=_not_app_source):
+        """tree_hash() of the synced source, from the manifest instead of re-reading every file"""
+        h = hashlib.sha256()
+        for rel_path in sorted(self.files):
+            parts = rel_path.split(os.sep)
+            if "__pycache__" in parts or rel_path.endswith(".pyc") or (exclude and exclude(rel_path)):
+                continue
+            h.update("{}\0{}\0".format(rel_path, self.files[rel_path]["sha256"]).encode())
+        return h.hexdigest()
+
+    def summary(self):
+        return "{} copied ({} bytes), {} removed, {} unchanged".format(
+            len(self.copied), self.bytes_copied, len(self.removed), self.unchanged
+        )
+
+
+def _file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+
+def installed_version(venv_dir, package):
+    """reads the version from the installed metadata directory, without starting the venv's interpreter"""
+    pattern = os.path.join(venv_dir, "lib", "python*", "site-packages", "{}-*.*-info")
+    for name in (package, package.capitalize()):
+        for info_dir in glob.glob(pattern.format(name)):
+            base = os.path.basename(info_dir).rsplit(".", 1)[0]
+            return base.split("-")[1]
+    return None
+
+
+def _tree_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def _override_fingerprint(zappa_override):
+    """a Zappa override can be a local checkout; fold its file stats in so edits to it invalidate cached venvs"""
+    if not zappa_override:
+        return ""
+    path = os.path.expanduser(zappa_override)
+    if not os.path.isdir(path):
+        return zappa_override
+    h = hashlib.sha256(zappa_override.encode())
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith(".") and d != "__pycache__")
+        for name in sorted(files):
+            if name.endswith(".pyc"):
+                continue
+            st = os.stat(os.path.join(root, name))
+            h.update(
+                "{}:{}:{}".format(
+                    os.path.relpath(os.path.join(root, name), path), st.st_size, st.st_mtime
+                ).encode()
+            )
+    return h.hexdigest()
+
+
+def python_version_string(executable):
+    return INTERPRETERS.version_string(executable)
+
+
+def benchmark(url, requests=100, concurrency=4, timeout=30):
+    """load-test url: `requests` GETs from `concurrency` threads, each reusing one keep-alive connection
+
+    returns latency percentiles (ms), throughput and error rate; any exception or a status >= 400 is an error"""
+    parsed = urlparse(url)
+    path = parsed.path or "/"
+    if parsed.query:
+        path += "?" + parsed.query
+    connection_class = (
+        http.client.HTTPSConnection if parsed.scheme == "https" else http.client.HTTPConnection
+    )
+
+    latencies = []
+    errors = [0]
+    remaining = [requests]
+    lock = threading.Lock()
+
+    def worker():
+        connection = connection_class(parsed.netloc, timeout=timeout)
+        try:
+            while True:
+                with lock:
+                    if remaining[0] <= 0:
+                        return
+                    remaining[0] -= 1
+                started = time.time()
+                try:
+                    connection.request("GET", path)
+                    response = connection.getresponse()
+                    response.read()
+                    failed = response.status >= 400
+                except (OSError, http.client.HTTPException):
+                    connection.close()  # reconnects on the next request
+                    failed = True
+                latency = time.time() - started
+                with lock:
+                    latencies.append(latency)
+                    if failed:
+                        errors[0] += 1
+        finally:
+            connection.close()
+
+    started = time.time()
+    threads = [threading.Thread(target=worker) for _ in range(max(1, concurrency))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    latencies.sort()
+    return {
+        "url": url,
+        "requests": len(latencies),
+        "concurrency": concurrency,
+        "errors": errors[0],
+        "error_rate": errors[0] / max(len(latencies), 1),
+        "elapsed_seconds": elapsed,
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "latency_ms": {
+            "p50": percentile(latencies, 50) * 1000,
+            "p90": percentile(latencies, 90) * 1000,
+            "p99": percentile(latencies, 99) * 1000,
+            "max": (latencies[-1] if latencies else 0) * 1000,
+        },
+    }
+
+
+def percentile(sorted_values, pct):
+    """nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(-(-pct * len(sorted_values) // 100)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def cold_start_probe(url, force_cold, warm_requests=10, timeout=60):
+    """force_cold(), then time the first request separately from the next warm_requests
+
+    connection setup happens before the clock starts, so the cold figure is the container start, not TLS"""
+    force_cold()
+
+    parsed = urlparse(url)
+    path = parsed.path or "/"
+    connection_class = (
+        http.client.HTTPSConnection if parsed.scheme == "https" else http.client.HTTPConnection
+    )
+
+    def timed_request():
+        connection = connection_class(parsed.netloc, timeout=timeout)
+        try:
+            connection.connect()
+            started = time.time()
+            connection.request("GET", path)
+            response = connection.getresponse()
+            response.read()
+            if response.status >= 400:
+                raise EnvironmentError("{} returned {}".format(url, response.status))
+            return time.time() - started
+        finally:
+            connection.close()
+
+    cold = timed_request()
+    warm = sorted(timed_request() for _ in range(warm_requests))
+    warm_p50 = percentile(warm, 50)
+    return {
+        "url": url,
+        "cold_ms": cold * 1000,
+        "warm_requests": len(warm),
+        "warm_p50_ms": warm_p50 * 1000,
+        "warm_max_ms": (warm[-1] if warm else 0) * 1000,
+        "cold_penalty_ms": (cold - warm_p50) * 1000,
+    }
+
+
+# runs inside the app's venv (so: Python 2.7 compatible), where boto3 is installed with Zappa
+_FORCE_COLD_START = """
+import sys, time, boto3
+arn = sys.argv[1]
+client = boto3.client("lambda", region_name=arn.split(":")[3])
+config = client.get_function_configuration(FunctionName=arn)
+variables = config.get("Environment", {}).get("Variables", {})
+variables["ZAPPA_E2E_COLD_START"] = str(time.time())
+client.update_function_configuration(FunctionName=arn, Environment={"Variables": variables})
+for _ in range(60):
+    if client.get_function_configuration(FunctionName=arn).get("LastUpdateStatus", "Successful") != "InProgress":
+        break
+    time.sleep(1)
+"""
+
+
+def force_lambda_cold_start(venv_dir, function_arn):
+    """changing the function's configuration makes Lambda retire its warm containers"""
+    ret, out, err = venv_cmd(venv_dir, "python", ["-c", _FORCE_COLD_START, function_arn])
+    if ret != 0:
+        raise EnvironmentError(
+            "Could not force a cold start of {}:\n{}".format(function_arn, err.decode())
+        )
+
+
+class ReadinessProber:
+    def __init__(self, deadline=None, concurrency=None, base_delay=0.25, max_delay=5.0, request_timeout=10):
+        """Readiness Prober
+
+        polls a freshly deployed URL until a GET succeeds (any status below 400) or `deadline` seconds pass.
+        `concurrency` pollers start staggered and each backs off exponentially after a failure (capped at max_delay,
+        with jitter), so propagation delays are waited out closely without hammering the endpoint; the first
+        success stops them all."""
+        self.deadline = ENV_CONFIG["readiness_timeout"] if deadline is None else deadline
+        self.concurrency = max(1, ENV_CONFIG["readiness_concurrency"] if concurrency is None else concurrency)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.request_timeout = request_timeout
+
+    def probe(self, url):
+        """{"url", "ready", "seconds" (time to first success, or None), "elapsed", "attempts", "last_error"}"""
+        started = time.monotonic()
+        done = threading.Event()
+        lock = threading.Lock()
+        result = {"url": url, "ready": False, "seconds": None, "attempts": 0, "last_error": None}
+
+        def poll(index):
+            attempt = 0
+            # staggered, so the pollers don't hit the endpoint in lockstep
+            if done.wait(self.base_delay * index / self.concurrency):
+                return
+            while True:
+                remaining = self.deadline - (time.monotonic() - started)
+                if remaining <= 0:
+                    return
+                with lock:
+                    result["attempts"] += 1
+                error = self._request(url, min(self.request_timeout, remaining))
+                with lock:
+                    if error is None:
+                        if not result["ready"]:
+                            result["ready"] = True
+                            result["seconds"] = time.monotonic() - started
+                        done.set()
+                        return
+                    result["last_error"] = error
+                delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+                delay = min(random.uniform(delay / 2, delay), self.deadline - (time.monotonic() - started))
+                if done.wait(max(0, delay)):
+                    return
+                attempt += 1
+
+        threads = [threading.Thread(target=poll, args=(i,)) for i in range(self.concurrency)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        result["elapsed"] = time.monotonic() - started
+        return result
+
+    def _request(self, url, timeout):
+        """None on success, otherwise what went wrong"""
+        parsed = urlparse(url)
+        connection_class = (
+            http.client.HTTPSConnection if parsed.scheme == "https" else http.client.HTTPConnection
+        )
+        connection = connection_class(parsed.netloc, timeout=timeout)
+        try:
+            connection.request("GET", (parsed.path or "/") + ("?" + parsed.query if parsed.query else ""))
+            response = connection.getresponse()
+            response.read()
+            if response.status >= 400:
+                return "HTTP {} {}".format(response.status, response.reason)
+            return None
+        except (OSError, http.client.HTTPException) as e:
+            return "{}: {}".format(e.__class__.__name__, e)
+        finally:
+            connection.close()
+
+
+class SimulatedPropagation:
+    def __init__(self, app, ready_after=2.0, status="503 Service Unavailable"):
+        """WSGI middleware that answers `status` until ready_after seconds after creation or reset(); a stand-in for
+        a deploy that is still propagating, for trying the ReadinessProber without AWS"""
+        self.app = app
+        self.ready_after = ready_after
+        self.status = status
+        self.reset()
+
+    def reset(self):
+        self._ready_at = time.monotonic() + self.ready_after
+
+    def __call__(self, environ, start_response):
+        if time.monotonic() < self._ready_at:
+            start_response(self.status, [("Content-Type", "text/plain")])
+            return [b"not ready"]
+        return self.app(environ, start_response)
+
+
+class SimulatedColdStart:
+    def __init__(self, app, penalty_seconds=1.0):
+        """WSGI middleware that makes the first request after reset() pay penalty_seconds; a cold-start stand-in"""
+        self.app = app
+        self.penalty_seconds = penalty_seconds
+        self._cold = True
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self._cold = True
+
+    def __call__(self, environ, start_response):
+        with self._lock:
+            cold, self._cold = self._cold, False
+        if cold:
+            time.sleep(self.penalty_seconds)
+        return self.app(environ, start_response)
+
+
+class _ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        logger.debug("local wsgi: " + format % args)
+
+
+def load_wsgi_app(app_dir, app_function="app.app"):
+    """imports an app's module from app_dir the way zappa's app_function names it"""
+    module_name, attr = app_function.rsplit(".", 1)
+    spec = importlib.util.spec_from_file_location(
+        "zappa_e2e_local_{}_{}".format(os.path.basename(app_dir).replace("-", "_"), module_name),
+        os.path.join(app_dir, module_name.replace(".", os.sep) + ".py"),
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return getattr(module, attr)
+
+
+@contextmanager
+def local_wsgi_server(app):
+    """serves a WSGI app on an ephemeral localhost port; yields its URL. A stand-in for API Gateway + Lambda"""
+    server = make_server("127.0.0.1", 0, app, _ThreadingWSGIServer, _QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield "http://127.0.0.1:{}/".format(server.server_port)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class LocalAWS:
+    # the emulator serves every service on one port: S3, Lambda, IAM, API Gateway, CloudFormation, CloudWatch (Events)
+    active = None
+    # zappa's post-deploy touch and keep-warm event rule both expect a real Lambda behind the function
+    STAGE_SETTINGS = {"touch": False, "keep_warm": False}
+    # removed from venv commands' environment; they would name profiles that don't exist locally
+    UNSET_ENV = ("AWS_PROFILE", "AWS_DEFAULT_PROFILE")
+
+    def __init__(self, region=None, startup_timeout=30, endpoint=None):
+        """Local AWS
+
+        a moto server standing in for AWS, so the full app cycle runs with no network and no AWS costs. While it
+        is running, every venv command gets fake credentials and a sitecustomize.py (zappa_e2e_local/) that points
+        botocore at it; LocalGateway serves the deployed app in place of API Gateway + Lambda. With an endpoint
+        (default: ZAPPA_E2E_AWS_ENDPOINT), it uses that running server instead of starting its own, so what one
+        session deployed outlives it."""
+        self.region = region or ENV_CONFIG["local_aws_region"]
+        self.startup_timeout = startup_timeout
+        self.process = None
+        self.endpoint = None
+        self._attach_to = endpoint or ENV_CONFIG["local_aws_endpoint"]
+        self._log = None
+
+    def start(self):
+        if self._attach_to:
+            return self._attach()
+        if importlib.util.find_spec("moto") is None:
+            raise EnvironmentError(
+                "ZAPPA_E2E_BACKEND=local needs moto's server next to the harness: pip install 'moto[server]'"
+            )
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+
+        with TRACER.span("local aws start"):
+            self._log = tempfile.NamedTemporaryFile(prefix="zappa-e2e-moto-", suffix=".log", delete=False)
+            env = dict((k, v) for k, v in os.environ.items() if k not in self.UNSET_ENV)
+            env.update(self._credentials())
+            self.process = subprocess.Popen(
+                [sys.executable, "-m", "moto.server", "-H", "127.0.0.1", "-p", str(port)],
+                stdout=self._log,
+                stderr=subprocess.STDOUT,
+                env=env,
+            )
+            deadline = time.time() + self.startup_timeout
+            while True:
+                try:
+                    socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                    break
+                except OSError:
+                    if self.process.poll() is not None or time.time() > deadline:
+                        self.stop()
+                        raise EnvironmentError(
+                            "moto server did not start; see {}".format(self._log.name)
+                        )
+                    time.sleep(0.1)
+
+        self.endpoint = "http://127.0.0.1:{}".format(port)
+        LocalAWS.active = self
+        logger.info("Zappa E2E: local AWS emulator at {}".format(self.endpoint))
+        return self
+
+    def _attach(self):
+        parsed = urlparse(self._attach_to)
+        try:
+            socket.create_connection((parsed.hostname, parsed.port or 80), timeout=5).close()
+        except OSError as e:
+            raise EnvironmentError("No local AWS emulator at {}: {}".format(self._attach_to, e))
+        self.endpoint = self._attach_to
+        LocalAWS.active = self
+        logger.info("Zappa E2E: using the local AWS emulator at {}".format(self.endpoint))
+        return self
+
+    def env(self):
+        python_path = [LOCAL_AWS_SHIM_DIR]
+        if os.environ.get("PYTHONPATH"):
+            python_path.append(os.environ["PYTHONPATH"])
+        env = {
+            "ZAPPA_E2E_AWS_ENDPOINT": self.endpoint,
+            "PYTHONPATH": os.pathsep.join(python_path),
+        }
+        env.update(self._credentials())
+        return env
+
+    def _credentials(self):
+        return {
+            "AWS_ACCESS_KEY_ID": "testing",
+            "AWS_SECRET_ACCESS_KEY": "testing",
+            "AWS_SESSION_TOKEN": "testing",
+            "AWS_DEFAULT_REGION": self.region,
+            "AWS_REGION": self.region,
+            # never fall back to a real profile
+            "AWS_CONFIG_FILE": os.devnull,
+            "AWS_SHARED_CREDENTIALS_FILE": os.devnull,
+        }
+
+    def configure(self, settings_file, stage):
+        """adjusts rendered settings for an emulated deployment"""
+        settings = load_settings(settings_file)
+        settings[stage].update(self.STAGE_SETTINGS)
+        settings[stage]["aws_region"] = self.region
+        with open(settings_file, "w") as f:
+            json.dump(settings, f, indent=4)
+
+    def stop(self):
+        if LocalAWS.active is self:
+            LocalAWS.active = None
+        if self.process is not None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+        if self._log is not None:
+            self._log.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc, value, tb):
+        self.stop()
+
+
+class LocalGateway:
+    def __init__(self, venv_dir, app_dir, stage="test", log_path=None):
+        """Local Gateway
+
+        serves an app deployed to the local AWS emulator from its own venv (see zappa_e2e_gateway.py), under
+        http://127.0.0.1:<port>/<stage>. start() is idempotent; restart() is the local equivalent of a cold start."""
+        self.venv_dir = venv_dir
+        self.app_dir = app_dir
+        self.stage = stage
+        self.log_path = log_path or os.path.join(os.path.dirname(app_dir), "gateway.log")
+        self.process = None
+        # picked by the first start and kept, so a restart doesn't change the app's URL
+        self.port = 0
+        self.url = None
+        self.starts = 0
+
+    def start(self):
+        if self.process is not None and self.process.poll() is None:
+            return self.url
+        app_function = (
+            load_settings(os.path.join(self.app_dir, "zappa_settings.json"))
+            .get(self.stage, {})
+            .get("app_function", "app.app")
+        )
+        with TRACER.span("gateway start"), open(self.log_path, "ab") as log:
+            self.process = subprocess.Popen(
+                [
+                    os.path.join(self.venv_dir, "bin", "python"),
+                    GATEWAY_SCRIPT,
+                    self.app_dir,
+                    app_function,
+                    self.stage,
+                    str(self.port),
+                ],
+                stdout=subprocess.PIPE,
+                stderr=log,
+                env=_venv_env(self.venv_dir),
+                cwd=self.app_dir,
+            )
+            port = self.process.stdout.readline().strip()
+        if not port:
+            self.stop()
+            raise EnvironmentError(
+                "local gateway for {} did not start; see {}".format(self.app_dir, self.log_path)
+            )
+        self.starts += 1
+        self.port = int(port)
+        self.url = "http://127.0.0.1:{}/{}".format(self.port, self.stage)
+        return self.url
+
+    def restart(self):
+        self.stop()
+        return self.start()
+
+    def stop(self):
+        if self.process is None:
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process.stdout.close()
+        self.process = None
+        self.url = None
+
+
+RUNTIMES_FILE = "zappa_runtimes.json"
+
+
+def app_runtimes(app_dir):
+    """the python versions an app is tested on: its zappa_runtimes.json (e.g. ["3.6", "3.7", "3.8"]), or py_versions"""
+    try:
+        with open(os.path.join(app_dir, RUNTIMES_FILE)) as f:
+            return [str(version) for version in json.load(f)]
+    except FileNotFoundError:
+        return list(ENV_CONFIG["py_versions"])
+
+
+def _probe_python(executable):
+    try:
+        run = subprocess.run(
+            [executable, "-V"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=30
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return ""
+    return run.stdout.decode(errors="replace").strip()
+
+
+class Interpreters:
+    def __init__(self, cache_path=None, workers=8):
+        """Interpreters
+
+        finds a python executable for each "X.Y" version asked for. Candidates (ZAPPA_E2E_PYTHON_XY_PATH, else
+        pythonX.Y, pythonX and python) are resolved on PATH without running anything; only binaries the on-disk cache
+        doesn't know yet (by real path, size and mtime, under the current PATH) are probed with -V, all at once.
+        Results are kept for the session, so more apps or versions cost at most one probe per new binary."""
+        self.cache_path = cache_path or os.path.join(tempfile.gettempdir(), "zappa-e2e", "interpreters.json")
+        self.workers = workers
+        self.probes = 0
+        self._found = {}
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _candidates(version):
+        if version in ENV_CONFIG["python_paths"]:
+            return [ENV_CONFIG["python_paths"][version]]
+        return ["python" + version, "python" + version.split(".")[0], "python"]
+
+    @staticmethod
+    def _cache_key():
+        # shims such as pyenv's resolve differently under another PATH or PYENV_VERSION
+        return hashlib.sha256(
+            json.dumps([os.environ.get("PATH", ""), os.environ.get("PYENV_VERSION", "")]).encode()
+        ).hexdigest()[:16]
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_cache(self, cache):
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(self.cache_path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.cache_path)
+
+    def _identify(self, executables):
+        """{executable: "Python X.Y.Z"}, probing in parallel only what the cache can't answer"""
+        cache = self._load_cache()
+        entries = cache.setdefault(self._cache_key(), {})
+        stats = {}
+        for executable in executables:
+            try:
+                stat = os.stat(executable)
+            except OSError:
+                continue
+            stats[executable] = [os.path.realpath(executable), stat.st_size, stat.st_mtime]
+
+        unknown = [
+            executable
+            for executable, stat in stats.items()
+            if entries.get(executable, {}).get("stat") != stat
+        ]
+        if unknown:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                for executable, version in zip(unknown, pool.map(_probe_python, unknown)):
+                    entries[executable] = {"stat": stats[executable], "version": version}
+            self.probes += len(unknown)
+            self._save_cache(cache)
+        return dict((executable, entries[executable]["version"]) for executable in stats)
+
+    def find(self, versions):
+        """{version: executable or None} for every version that isn't skipped"""
+        versions = [version for version in versions if version not in ENV_CONFIG["skip_python"]]
+        with self._lock:
+            missing = [version for version in versions if version not in self._found]
+            if missing:
+                self._discover(missing)
+        return dict((version, self._found[version]) for version in versions)
+
+    def _discover(self, versions):
+        candidates = dict((version, []) for version in versions)
+        for version in versions:
+            for name in self._candidates(version):
+                executable = shutil.which(name)
+                if executable and executable not in candidates[version]:
+                    candidates[version].append(executable)
+        self._versions.update(
+            self._identify(set(itertools.chain.from_iterable(candidates.values())) - set(self._versions))
+        )
+
+        for version in versions:
+            pattern = re.compile(r"^Python {}(\.|$)".format(re.escape(version)))
+            found = [
+                executable for executable in candidates[version] if pattern.match(self._versions.get(executable, ""))
+            ]
+            if version in ENV_CONFIG["python_paths"] and not found:
+                raise EnvironmentError(
+                    "Python {} path specified, but is not actually a Python {} executable.".format(version, version)
+                )
+            self._found[version] = found[0] if found else None
+
+    def version_string(self, executable):
+        """e.g. "Python 3.6.9"; cached like everything else"""
+        executable = shutil.which(executable) or executable
+        with self._lock:
+            if executable not in self._versions:
+                self._versions.update(self._identify([executable]))
+            return self._versions.get(executable, "")
+
+
+INTERPRETERS = Interpreters()
+
+
+def python_executables(versions=None):
+    """{version: executable or None}; versions default to py_versions"""
+    with TRACER.span("python probing"):
+        return INTERPRETERS.find(versions or ENV_CONFIG["py_versions"])
+
+
+class PerfDB:
+    MIN_BASELINE_SAMPLES = 3
+
+    def __init__(self, path=None):
+        """Perf DB
+
+        a local SQLite history of per-run metrics (deploy/update/undeploy duration, package build time, code size,
+        latency percentiles), keyed by app, python version, matrix variant, Zappa version/override and git commit.
+        Every metric is lower-is-better, and is compared against the median of its last few recorded values. The file
+        is only created on first use."""
+        self.path = path or ENV_CONFIG["perf_db"]
+        self._lock = threading.Lock()
+        self._create_lock = threading.Lock()
+        self._created = False
+
+    def _create(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with sqlite3.connect(self.path, timeout=30) as db:
+            db.execute(
+                """CREATE TABLE IF NOT EXISTS metrics (
+                    run_id TEXT, recorded_at REAL, app TEXT, py_version TEXT, variant TEXT,
+                    zappa_version TEXT, zappa_override TEXT, git_commit TEXT, metric TEXT, value REAL
+                )"""
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS metrics_series ON metrics (app, py_version, variant, metric, recorded_at)"
+            )
+            # wall time of each test item (all four stages), for balancing shards
+            db.execute("CREATE TABLE IF NOT EXISTS durations (item TEXT, recorded_at REAL, seconds REAL)")
+            db.execute("CREATE INDEX IF NOT EXISTS durations_item ON durations (item, recorded_at)")
+            # analyze_package() of each run, for diffing against the previous one
+            db.execute(
+                """CREATE TABLE IF NOT EXISTS packages (
+                    run_id TEXT, recorded_at REAL, app TEXT, py_version TEXT, variant TEXT, analysis TEXT
+                )"""
+            )
+
+    def _connect(self):
+        with self._create_lock:
+            if not self._created:
+                self._create()
+                self._created = True
+        return sqlite3.connect(self.path, timeout=30)
+
+    def record(self, run_id, key, metrics):
+        """key: app, py_version, variant, zappa_version, zappa_override, git_commit"""
+        now = time.time()
+        with self._lock, self._connect() as db:
+            db.executemany(
+                "INSERT INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        run_id,
+                        now,
+                        key["app"],
+                        key["py_version"],
+                        key.get("variant") or "",
+                        key.get("zappa_version"),
+                        key.get("zappa_override"),
+                        key.get("git_commit"),
+                        metric,
+                        float(value),
+                    )
+                    for metric, value in sorted(metrics.items())
+                    if value is not None
+                ],
+            )
+
+    def baseline(self, app, py_version, variant, metric, before_run_id=None, runs=None):
+        """median of the metric's last `runs` values, excluding before_run_id and anything recorded after it"""
+        runs = runs or ENV_CONFIG["perf_baseline_runs"]
+        query = "SELECT value FROM metrics WHERE app = ? AND py_version = ? AND variant = ? AND metric = ?"
+        params = [app, py_version, variant or "", metric]
+        if before_run_id is not None:
+            query += " AND run_id != ? AND recorded_at < (SELECT COALESCE(MAX(recorded_at), 1e18) FROM metrics WHERE run_id = ?)"
+            params.extend([before_run_id, before_run_id])
+        query += " ORDER BY recorded_at DESC LIMIT ?"
+        params.append(runs)
+        with self._connect() as db:
+            values = [row[0] for row in db.execute(query, params)]
+        if len(values) < self.MIN_BASELINE_SAMPLES:
+            return None
+        return statistics.median(values)
+
+    def regressions(self, run_id, threshold=None):
+        """[(app, py_version, variant, metric, value, baseline)] for every metric of run_id past the threshold"""
+        threshold = ENV_CONFIG["perf_threshold"] if threshold is None else threshold
+        with self._connect() as db:
+            rows = list(
+                db.execute(
+                    "SELECT app, py_version, variant, metric, value FROM metrics WHERE run_id = ? ORDER BY app, py_version, variant, metric",
+                    (run_id,),
+                )
+            )
+        found = []
+        for app, py_version, variant, metric, value in rows:
+            baseline = self.baseline(app, py_version, variant, metric, before_run_id=run_id)
+            if baseline and value > baseline * (1 + threshold):
+                found.append((app, py_version, variant, metric, value, baseline))
+        return found
+
+    def record_package(self, run_id, key, analysis):
+        with self._lock, self._connect() as db:
+            db.execute(
+                "INSERT INTO packages VALUES (?, ?, ?, ?, ?, ?)",
+                (run_id, time.time(), key["app"], key["py_version"], key.get("variant") or "", json.dumps(analysis)),
+            )
+
+    def previous_package(self, app, py_version, variant):
+        """the most recently recorded package analysis of this app, or None"""
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT analysis FROM packages WHERE app = ? AND py_version = ? AND variant = ? ORDER BY recorded_at DESC LIMIT 1",
+                (app, py_version, variant or ""),
+            ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def record_durations(self, durations):
+        """durations: {item node id: seconds}"""
+        now = time.time()
+        with self._lock, self._connect() as db:
+            db.executemany(
+                "INSERT INTO durations VALUES (?, ?, ?)",
+                [(item, now, float(seconds)) for item, seconds in sorted(durations.items())],
+            )
+
+    def item_durations(self, runs=None):
+        """{item node id: median of its last `runs` durations}"""
+        runs = runs or ENV_CONFIG["perf_baseline_runs"]
+        history = {}
+        with self._connect() as db:
+            for item, seconds in db.execute("SELECT item, seconds FROM durations ORDER BY recorded_at DESC"):
+                values = history.setdefault(item, [])
+                if len(values) < runs:
+                    values.append(seconds)
+        return dict((item, statistics.median(values)) for item, values in history.items())
+
+    def last_override(self):
+        """(found, Zappa override recorded with the most recent metrics); found is False for an empty DB"""
+        with self._connect() as db:
+            row = db.execute("SELECT zappa_override FROM metrics ORDER BY recorded_at DESC LIMIT 1").fetchone()
+        return (False, None) if row is None else (True, row[0])
+
+    def latest_run_ids(self):
+        """the most recent run of every app/python version/variant"""
+        with self._connect() as db:
+            return [
+                row[0]
+                for row in db.execute(
+                    """SELECT run_id FROM metrics GROUP BY app, py_version, variant
+                    HAVING recorded_at = MAX(recorded_at) ORDER BY app, py_version, variant"""
+                )
+            ]
+
+
+def format_regression(regression):
+    app, py_version, variant, metric, value, baseline = regression
+    return "{}-py{}{}: {} {:.3f} vs baseline {:.3f} (+{:.0%})".format(
+        app, py_version, "-" + variant if variant else "", metric, value, baseline, value / baseline - 1
+    )
+
+
+def new_run_id(label):
+    return "{}-{}".format(label, uuid.uuid4().hex[:12])
+
+
+def git_commit(path):
+    try:
+        run = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=path, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+    except OSError:
+        return None
+    if run.returncode != 0:
+        return None
+    return run.stdout.decode().strip()
+
+
+def override_revision(zappa_override):
+    """what identifies the code of a Zappa override: a local git checkout's HEAD commit (plus "-dirty" when it has
+    uncommitted edits), otherwise the override itself (a pip requirement, which pins its own commit)"""
+    if not zappa_override:
+        return None
+    path = os.path.expanduser(zappa_override)
+    commit = git_commit(path) if os.path.isdir(path) else None
+    if commit is None:
+        return zappa_override
+    run = subprocess.run(["git", "status", "--porcelain"], cwd=path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return "{}@{}{}".format(zappa_override, commit, "-dirty" if run.stdout.strip() else "")
+
+
+def changed_files(diff_range, path=None):
+    """repo-relative paths changed in a git diff range, e.g. "origin/master...HEAD"
+
+    a single revision is compared with the working tree, untracked files included, so local edits count too"""
+    path = path or os.path.dirname(APPS_DIR)
+    commands = [["git", "diff", "--name-only", "--no-renames", diff_range, "--"]]
+    if ".." not in diff_range:
+        commands.append(["git", "ls-files", "--others", "--exclude-standard"])
+    changed = set()
+    for args in commands:
+        run = subprocess.run(args, cwd=path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if run.returncode != 0:
+            raise ValueError("{} failed: {}".format(" ".join(args), run.stderr.decode(errors="replace").strip()))
+        changed.update(line for line in run.stdout.decode().splitlines() if line)
+    return sorted(changed)
+
+
+def _harness_file(rel_path):
+    # everything outside apps/ is shared by every app, except docs and the harness's own unit tests
+    return (
+        not rel_path.startswith(("apps/", "tests/"))
+        and not rel_path.endswith(".md")
+        and rel_path != ".gitignore"
+    )
+
+
+def affected_apps(changed, app_names, override_change=None):
+    """{app name: why it has to run, or None when the change does not affect it}
+
+    changed: repo-relative paths from changed_files(); override_change: why the Zappa override counts as changed"""
+    harness = [rel_path for rel_path in changed if _harness_file(rel_path)]
+    if harness:
+        reason = "harness changed: " + _some(harness)
+        return dict((name, reason) for name in app_names)
+    if override_change:
+        return dict((name, override_change) for name in app_names)
+
+    by_app = {}
+    for rel_path in changed:
+        parts = rel_path.split("/")
+        if parts[0] == "apps" and len(parts) > 2:
+            by_app.setdefault(parts[1], []).append(rel_path)
+    return dict(
+        (name, "changed: " + _some(by_app[name]) if name in by_app else None) for name in app_names
+    )
+
+
+def _some(paths, shown=3):
+    if len(paths) <= shown:
+        return ", ".join(paths)
+    return "{} and {} more".format(", ".join(paths[:shown]), len(paths) - shown)
+
+
+def override_change(perf_db, revision):
+    """why the Zappa override counts as changed since the last recorded run, or None"""
+    found, last = perf_db.last_override()
+    if not found:
+        return "Zappa override {} has no earlier run to compare with".format(revision) if revision else None
+    if revision == last:
+        return None
+    return "Zappa override changed: {} -> {}".format(last or "(none)", revision or "(none)")
+
+
+def select_apps(diff_range, perf_db, zappa_override, apps_dir=None):
+    apps_dir = apps_dir or APPS_DIR
+    app_names = sorted(
+        name for name in os.listdir(apps_dir) if os.path.isfile(os.path.join(apps_dir, name, "zappa_settings.json.j2"))
+    )
+    return affected_apps(
+        changed_files(diff_range), app_names, override_change(perf_db, override_revision(zappa_override))
+    )
+
+
+_LIST_FUNCTIONS = """
+import json, boto3
+names = []
+for page in boto3.client("lambda").get_paginator("list_functions").paginate():
+    names.extend(function["FunctionName"] for function in page["Functions"])
+print(json.dumps(names))
+"""
+
+
+class Sweeper:
+    # the Lambda name of an e2e deployment: <app>-<python version without the dot>[-<variant>]-<stage>
+    FUNCTION_NAME = r"^(?P<app>.+?)-(?P<py>\d{{2,3}})(?:-(?P<variant>[a-z0-9-]+))?-{stage}$"
+
+    def __init__(self, venv_dir, apps_dir=None, stage="test", workers=8, work_dir=None):
+        """Sweeper
+
+        finds and undeploys every e2e deployment without running the suite: renders each app's settings for every
+        Python version and matrix combination into a bare work dir, checks `zappa status` for all of them at once and
+        undeploys the deployed ones in parallel, all with one Zappa-only venv. Also lists Lambda functions that look
+        like e2e deployments but match no rendered settings, e.g. from an app directory that has since been removed."""
+        self.venv_dir = venv_dir
+        self.apps_dir = apps_dir or APPS_DIR
+        self.stage = stage
+        self.workers = workers
+        self.work_dir = work_dir or os.path.join(tempfile.gettempdir(), "zappa-e2e", "sweep")
+
+    def targets(self):
+        """[{label, app, py_version, variant, function_name, work_dir}] for every app, python version and combination"""
+        targets = []
+        for app in sorted(os.listdir(self.apps_dir)):
+            template_file = os.path.join(self.apps_dir, app, "zappa_settings.json.j2")
+            if not os.path.isfile(template_file):
+                continue
+            for py_version in app_runtimes(os.path.join(self.apps_dir, app)):
+                for combination in settings_matrix(os.path.join(self.apps_dir, app)):
+                    variant = variant_name(combination)
+                    label = "{}-py{}{}".format(app, py_version, "-" + variant if variant else "")
+                    work_dir = os.path.join(self.work_dir, label)
+                    os.makedirs(work_dir, exist_ok=True)
+                    settings_file = os.path.join(work_dir, "zappa_settings.json")
+                    render_settings(template_file, settings_file, py_version, combination, self.stage)
+                    targets.append(
+                        {
+                            "label": label,
+                            "app": app,
+                            "py_version": py_version,
+                            "variant": variant,
+                            "function_name": "{}-{}".format(
+                                load_settings(settings_file)[self.stage]["project_name"], self.stage
+                            ),
+                            "work_dir": work_dir,
+                        }
+                    )
+        return targets
+
+    def _zappa(self, target, params):
+        with TRACER.context(app=target["app"], py_version=target["py_version"], variant=target["variant"], stage="sweep"):
+            return zappa_cmd(self.venv_dir, params, cwd=target["work_dir"])
+
+    def _map(self, fn, targets):
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            return list(pool.map(fn, targets))
+
+    def deployed(self, targets):
+        """the targets `zappa status` finds"""
+        statuses = self._map(lambda target: self._zappa(target, ["status", self.stage])[0], targets)
+        return [target for target, ret in zip(targets, statuses) if ret == 0]
+
+    def undeploy(self, targets):
+        """[(target, returncode, stderr)] of `zappa undeploy` for each target, run in parallel"""
+        results = self._map(lambda target: self._zappa(target, ["undeploy", "-y", self.stage]), targets)
+        return [(target, ret, err) for target, (ret, out, err) in zip(targets, results)]
+
+    def orphans(self, targets):
+        """[(function name, reason)] of e2e-looking functions that no rendered settings account for"""
+        ret, out, err = venv_cmd(self.venv_dir, "python", ["-c", _LIST_FUNCTIONS])
+        if ret != 0:
+            raise EnvironmentError("Could not list Lambda functions:\n{}".format(err.decode()))
+        apps = set(target["app"] for target in targets)
+        known = set(target["function_name"] for target in targets)
+        pattern = re.compile(self.FUNCTION_NAME.format(stage=re.escape(self.stage)))
+        found = []
+        for name in sorted(json.loads(out.decode())):
+            match = pattern.match(name)
+            if not match or name in known:
+                continue
+            if match.group("app") in apps:
+                found.append((name, "no matching Python version or matrix combination"))
+            else:
+                found.append((name, "no app directory"))
+        return found
+
+
+def sweep_venv(root=None, zappa_override=None):
+    """a Zappa-only venv for the sweep, built once and reused; status and undeploy need no app requirements"""
+    venv_dir = root or os.path.join(tempfile.gettempdir(), "zappa-e2e", "sweep-venv")
+    if not os.path.isfile(os.path.join(venv_dir, "bin", "zappa")):
+        with TRACER.span("virtualenv"):
+            ret, out, err = OUTPUT_LOGS.run(["virtualenv", "-p", sys.executable, venv_dir])
+        if ret != 0:
+            raise EnvironmentError("Could not create the sweep virtualenv:\n{}".format(err.decode()))
+        with TRACER.span("pip install", requirement="zappa"):
+            venv_cmd(venv_dir, "pip", ["install", zappa_override or ENV_CONFIG["zappa_override"] or "zappa"], check=True)
+    return venv_dir
+
+
+def _sweep(args):
+    if args.backend == "local" and LocalAWS.active is None:
+        if not args.endpoint:
+            # a fresh emulator would have nothing deployed to sweep
+            print(
+                "--backend local sweeps a running emulator: pass --endpoint or set ZAPPA_E2E_AWS_ENDPOINT",
+                file=sys.stderr,
+            )
+            return 2
+        with LocalAWS(endpoint=args.endpoint):
+            return _sweep_all(args)
+    return _sweep_all(args)
+
+
+def _sweep_all(args):
+    sweeper = Sweeper(args.venv or sweep_venv(), workers=args.workers)
+    targets = sweeper.targets()
+    deployed = sweeper.deployed(targets)
+    for target in deployed:
+        print("deployed: {label} ({function_name})".format(**target))
+
+    failed = []
+    if not args.dry_run:
+        for target, ret, err in sweeper.undeploy(deployed):
+            if ret == 0:
+                print("undeployed: {label}".format(**target))
+            else:
+                failed.append(target)
+                print("failed to undeploy: {label}\n{err}".format(err=err.decode(errors="replace"), **target))
+
+    orphans = sweeper.orphans(targets)
+    for name, reason in orphans:
+        print("orphan: {} ({})".format(name, reason))
+    print(
+        "{} settings checked, {} deployed, {} {}, {} orphaned functions".format(
+            len(targets),
+            len(deployed),
+            len(deployed) - len(failed),
+            "would be undeployed" if args.dry_run else "undeployed",
+            len(orphans),
+        )
+    )
+    return 1 if failed else 0
+
+
+def _affected(args):
+    try:
+        selection = select_apps(args.range, PerfDB(args.db), ENV_CONFIG["zappa_override"])
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    for name in sorted(selection):
+        print("{}: {} ({})".format("run" if selection[name] else "skip", name, selection[name] or "unchanged"))
+    print("{} of {} apps affected by {}".format(sum(1 for r in selection.values() if r), len(selection), args.range))
+    return 0
+
+
+def parse_shard(value):
+    """"2/4" -> (2, 4); shards are numbered from 1"""
+    match = re.match(r"^\s*(\d+)\s*/\s*(\d+)\s*$", value or "")
+    if not match:
+        raise ValueError("shard must look like i/N, e.g. 2/4; got {!r}".format(value))
+    index, count = int(match.group(1)), int(match.group(2))
+    if not 1 <= index <= count:
+        raise ValueError("shard index must be between 1 and {}; got {}".format(count, index))
+    return index, count
+
+
+def partition(keys, durations, count):
+    """split keys into count shards, longest-processing-time first; returns (shards, estimated seconds per shard)
+
+    items without history are assumed to take the median known duration. Ties are broken by key, so the same keys
+    and durations always give the same shards, whichever machine computes them."""
+    known = [durations[key] for key in keys if key in durations]
+    default = statistics.median(known) if known else 1.0
+    shards = [[] for _ in range(count)]
+    loads = [0.0] * count
+    for key in sorted(keys, key=lambda key: (-durations.get(key, default), key)):
+        shard = min(range(count), key=lambda i: (loads[i], i))
+        shards[shard].append(key)
+        loads[shard] += durations.get(key, default)
+    return shards, loads
+
+
+def shard_plan(keys, durations):
+    """hash of what partition() was given: the items and their durations. Shards only add up to the whole suite when
+    every machine partitioned the same plan"""
+    h = hashlib.sha256()
+    for key in sorted(keys):
+        h.update("{}\0{!r}\0".format(key, durations.get(key)).encode())
+    return h.hexdigest()[:16]
+
+
+def merge_shard_reports(reports):
+    """one report out of the per-shard ones written by `py.test --shard i/N`"""
+    merged = {"shards": [], "items": [], "outcomes": {}, "preserved": [], "durations": {}}
+    for report in sorted(reports, key=lambda report: report["shard"]):
+        merged["shards"].append(
+            dict((k, report.get(k)) for k in ("shard", "count", "host", "wall_seconds", "estimated_seconds", "plan"))
+        )
+        for item in report["items"]:
+            merged["items"].append(item)
+            merged["outcomes"][item["outcome"]] = merged["outcomes"].get(item["outcome"], 0) + 1
+            if item.get("preserved"):
+                merged["preserved"].append(item["preserved"])
+            if item.get("duration") is not None:
+                merged["durations"][item["nodeid"]] = item["duration"]
+    counts = set(shard["count"] for shard in merged["shards"])
+    if len(counts) > 1:
+        raise ValueError("shard reports come from different shard counts: {}".format(sorted(counts)))
+    plans = set(shard["plan"] for shard in merged["shards"])
+    if len(plans) > 1:
+        raise ValueError(
+            "shard reports were partitioned from different items or durations ({}), so their shards may overlap or "
+            "leave items out; run every shard with the same --shard-durations file".format(
+                ", ".join("shard {shard} on {host}: {plan}".format(**shard) for shard in merged["shards"])
+            )
+        )
+    found = set(shard["shard"] for shard in merged["shards"])
+    merged["missing_shards"] = sorted(set(range(1, max(counts or [0]) + 1)) - found)
+    merged["items"].sort(key=lambda item: item["nodeid"])
+    merged["preserved"].sort()
+    merged["wall_seconds"] = max([shard["wall_seconds"] for shard in merged["shards"]] or [0])
+    return merged
+
+
+def _merge(args):
+    reports = []
+    for path in args.report:
+        with open(path) as f:
+            reports.append(json.load(f))
+    merged = merge_shard_reports(reports)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(merged, f, indent=2, sort_keys=True)
+    if not args.no_durations:
+        PerfDB(args.db).record_durations(merged["durations"])
+
+    for shard in merged["shards"]:
+        print(
+            "shard {shard}/{count} on {host}: {wall_seconds:.0f}s (estimated {estimated_seconds:.0f}s)".format(**shard)
+        )
+    for item in merged["items"]:
+        if item["outcome"] != "passed":
+            print("{outcome}: {nodeid}".format(**item))
+    for path in merged["preserved"]:
+        print("preserved: " + path)
+    print(
+        "{} items: {}; slowest shard {:.0f}s".format(
+            len(merged["items"]),
+            ", ".join("{} {}".format(n, outcome) for outcome, n in sorted(merged["outcomes"].items())),
+            merged["wall_seconds"],
+        )
+    )
+    if merged["missing_shards"]:
+        print("missing shards: " + ", ".join(str(i) for i in merged["missing_shards"]))
+        return 1
+    return 1 if set(merged["outcomes"]) - {"passed", "skipped"} else 0
+
+
+def _compare(args):
+    perf_db = PerfDB(args.db)
+    run_ids = args.run_id or perf_db.latest_run_ids()
+    regressions = []
+    for run_id in run_ids:
+        regressions.extend(perf_db.regressions(run_id, args.threshold))
+    for regression in regressions:
+        print(format_regression(regression))
+    print(
+        "{} regressed metrics across {} runs (threshold {:.0%})".format(
+            len(regressions),
+            len(run_ids),
+            ENV_CONFIG["perf_threshold"] if args.threshold is None else args.threshold,
+        )
+    )
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="zappa_e2e.py", description="Zappa end-to-end test harness tools")
+    commands = parser.add_subparsers(dest="command")
+
+    compare = commands.add_parser(
+        "compare", help="flag metrics that regressed against their rolling baseline in the perf DB"
+    )
+    compare.add_argument("--db", default=None, help="perf DB path (default: ZAPPA_E2E_PERF_DB)")
+    compare.add_argument("--threshold", type=float, default=None, help="e.g. 0.2 for 20%% worse")
+    compare.add_argument("run_id", nargs="*", help="runs to check (default: the latest of every app)")
+    compare.set_defaults(func=_compare)
+
+    merge = commands.add_parser(
+        "merge", help="combine the reports of `py.test --shard i/N` runs and keep their durations for balancing"
+    )
+    merge.add_argument("report", nargs="+", help="shard report files")
+    merge.add_argument("--output", default=None, help="write the merged report here")
+    merge.add_argument("--db", default=None, help="perf DB to record item durations in (default: ZAPPA_E2E_PERF_DB)")
+    merge.add_argument("--no-durations", action="store_true", help="do not record item durations")
+    merge.set_defaults(func=_merge)
+
+    sweep = commands.add_parser(
+        "sweep", help="undeploy every deployed e2e app in parallel, and list orphaned e2e functions"
+    )
+    sweep.add_argument("--dry-run", action="store_true", help="only list what is deployed")
+    sweep.add_argument(
+        "--venv", default=None, help="a venv with Zappa to use (default: one built once in <tmp>/zappa-e2e/sweep-venv)"
+    )
+    sweep.add_argument("--workers", type=int, default=8, help="status/undeploy calls at once (default: 8)")
+    sweep.add_argument(
+        "--backend",
+        choices=("aws", "local"),
+        default=ENV_CONFIG["backend"],
+        help="sweep AWS, or the local emulator at --endpoint (default: ZAPPA_E2E_BACKEND)",
+    )
+    sweep.add_argument(
+        "--endpoint",
+        default=ENV_CONFIG["local_aws_endpoint"],
+        help="URL of the running moto server to sweep with --backend local (default: ZAPPA_E2E_AWS_ENDPOINT)",
+    )
+    sweep.set_defaults(func=_sweep)
+
+    affected = commands.add_parser(
+        "affected", help="list the apps `py.test --affected RANGE` would run, and why (a dry run)"
+    )
+    affected.add_argument("range", help="git diff range, e.g. origin/master...HEAD; a single revision includes local edits")
+    affected.add_argument("--db", default=None, help="perf DB with the last run's Zappa override (default: ZAPPA_E2E_PERF_DB)")
+    affected.set_defaults(func=_affected)
 
-    if not found["3.6"] and out and found["3.6"] is None:
-        out, cmd = _try_run_python("python3")
-        if out.startswith("Python 3.6"):
-            found["3.6"] = cmd
+    args = parser.parse_args(argv)
+    if not getattr(args, "func", None):
+        parser.print_help()
+        return 2
+    return args.func(args)
 
-    if ENV_CONFIG['skip_python_27']:
-        del found["2.7"]
-    if ENV_CONFIG['skip_python_36']:
-        del found["3.6"]
 
-    return found
+if __name__ == "__main__":
+    sys.exit(main())
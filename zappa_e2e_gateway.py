@@ -0,0 +1,62 @@
+"""Zappa E2E local gateway
+
+stands in for API Gateway + Lambda when the harness runs against a local AWS emulator (ZAPPA_E2E_BACKEND=local).
+Runs inside an app's virtualenv (so it must stay Python 2.7 compatible), imports the app's app_function from the
+app directory and serves it under /<stage>, with the stage as SCRIPT_NAME, the way Zappa's handler sees requests
+that come through API Gateway. Prints the port it listens on, then serves until it is terminated.
+
+usage: python zappa_e2e_gateway.py <app dir> <app_function> <stage> [port]
+"""
+import importlib
+import os
+import sys
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+try:
+    from socketserver import ThreadingMixIn
+except ImportError:  # Python 2.7
+    from SocketServer import ThreadingMixIn
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def stage_app(app, stage):
+    prefix = "/" + stage
+
+    def gateway(environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        if path != prefix and not path.startswith(prefix + "/"):
+            # what API Gateway answers for paths outside the stage
+            start_response("403 Forbidden", [("Content-Type", "application/json")])
+            return [b'{"message":"Missing Authentication Token"}']
+        environ["SCRIPT_NAME"] = prefix
+        environ["PATH_INFO"] = path[len(prefix) :] or "/"
+        return app(environ, start_response)
+
+    return gateway
+
+
+def main():
+    app_dir, app_function, stage = sys.argv[1:4]
+    port = int(sys.argv[4]) if len(sys.argv) > 4 else 0
+    os.chdir(app_dir)
+    sys.path.insert(0, app_dir)
+    module_name, attr = app_function.rsplit(".", 1)
+    app = getattr(importlib.import_module(module_name), attr)
+
+    server = make_server("127.0.0.1", port, stage_app(app, stage), ThreadingWSGIServer, QuietHandler)
+    sys.stdout.write("{}\n".format(server.server_port))
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+"""Zappa E2E local AWS shim
+
+put on PYTHONPATH of every venv process when ZAPPA_E2E_BACKEND=local: points every botocore client that doesn't
+ask for an endpoint of its own at the local AWS emulator in ZAPPA_E2E_AWS_ENDPOINT. Must stay Python 2.7
+compatible, and must not fail when botocore isn't installed (pip, virtualenv, run_tests).
+"""
+import os
+
+_ENDPOINT = os.environ.get("ZAPPA_E2E_AWS_ENDPOINT")
+
+if _ENDPOINT:
+    try:
+        import botocore.session
+    except ImportError:
+        pass
+    else:
+        _create_client = botocore.session.Session.create_client
+
+        def create_client(self, service_name, *args, **kwargs):
+            # positionally, endpoint_url comes fifth after service_name
+            if len(args) < 5 and kwargs.get("endpoint_url") is None:
+                kwargs["endpoint_url"] = _ENDPOINT
+            return _create_client(self, service_name, *args, **kwargs)
+
+        botocore.session.Session.create_client = create_client
@@ -0,0 +1,88 @@
+"""Zappa E2E worker
+
+runs inside an app's virtualenv (so it must stay Python 2.7 compatible): imports the Zappa CLI once, then runs one
+command per JSON line on stdin. Each command's stdout/stderr go to the files named in the request, at the file
+descriptor level so subprocesses Zappa starts are captured too. Replies go out on a dup of the original stdout.
+"""
+import json
+import os
+import sys
+import time
+import traceback
+
+
+def _native(value):
+    if sys.version_info[0] == 2 and not isinstance(value, str):
+        return value.encode("utf-8")
+    return value
+
+
+def _send(channel, message):
+    channel.write(json.dumps(message) + "\n")
+    channel.flush()
+
+
+def run(cli_class, request):
+    os.chdir(request["cwd"])
+    os.environ.clear()
+    os.environ.update(
+        dict((_native(k), _native(v)) for k, v in request["env"].items())
+    )
+    sys.argv = ["zappa"] + [_native(a) for a in request["args"]]
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_stdout, saved_stderr = os.dup(1), os.dup(2)
+    out_fd = os.open(request["stdout"], os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    err_fd = os.open(request["stderr"], os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    os.dup2(out_fd, 1)
+    os.dup2(err_fd, 2)
+    try:
+        cli = cli_class()
+        try:
+            code = cli.handle(sys.argv[1:])
+        except SystemExit as e:
+            code = e.code
+        except Exception:
+            # what zappa.cli.handle() would print on its way out
+            traceback.print_exc()
+            code = 1
+        finally:
+            try:
+                cli.on_exit()
+            except Exception:
+                pass
+
+        if code is None:
+            code = 0
+        elif not isinstance(code, int):
+            sys.stderr.write("{}\n".format(code))
+            code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved_stdout, 1)
+        os.dup2(saved_stderr, 2)
+        for fd in (out_fd, err_fd, saved_stdout, saved_stderr):
+            os.close(fd)
+
+    return code
+
+
+def main():
+    started = time.time()
+    from zappa.cli import ZappaCLI
+
+    channel = os.fdopen(os.dup(1), "w")
+    # nothing but replies may reach the channel
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+
+    _send(channel, {"ready": True, "import_seconds": time.time() - started})
+    for line in iter(sys.stdin.readline, ""):
+        _send(channel, {"returncode": run(ZappaCLI, json.loads(line))})
+
+
+if __name__ == "__main__":
+    main()